@@ -17,16 +17,21 @@ import functools
 import re
 import typing
 
-import build_info_pbtxt_py
-import config_pb2
 import version_py
 
-from labm8.py import pbutil
+if typing.TYPE_CHECKING:
+  import config_pb2
 
 
 @functools.lru_cache()
-def GetBuildInfo() -> config_pb2.BuildInfo:
+def GetBuildInfo() -> "config_pb2.BuildInfo":
   """Return the build state."""
+  # The build info proto is imported on first use, so that programs which need
+  # only the Version() do not pay the cost of importing protobuf.
+  import build_info_pbtxt_py
+  import config_pb2
+  from labm8.py import pbutil
+
   return pbutil.FromString(
     build_info_pbtxt_py.STRING, config_pb2.BuildInfo(), uninitialized_okay=False
   )
@@ -24,7 +24,6 @@ from glob import iglob
 
 from send2trash import send2trash
 
-from labm8.py import humanize
 from labm8.py import labtypes
 
 
@@ -510,6 +509,10 @@ def du(*components, **kwargs):
     raise Error("file '{}' not found".format(_path))
   size = os.stat(_path).st_size
   if human_readable:
+    # humanize is imported on first use, since it is expensive to import and
+    # is not needed by most users of this module.
+    from labm8.py import humanize
+
     return humanize.BinaryPrefix(size, "B")
   else:
     return size
@@ -669,9 +672,10 @@ def Write(
 
 def AtomicWrite(
   filename: typing.Union[str, pathlib.Path],
-  contents: bytes,
+  contents: typing.Union[bytes, typing.Iterable[bytes]],
   mode: int = 0o0666,
   gid: int = None,
+  fsync: bool = False,
 ) -> None:
   """Create a file 'filename' with 'contents' atomically.
 
@@ -683,9 +687,11 @@ def AtomicWrite(
 
   Args:
     filename: the name of the file
-    contents: the data to write to the file
+    contents: the data to write to the file, or an iterable of chunks of data.
+      If the iterable raises an exception, the file is not modified.
     mode: permissions with which to create the file (default is 0666 octal)
     gid: group id with which to create the file
+    fsync: if true, flush the file and its directory to disk before returning
   """
   # Adapted from <https://github.com/google/google-apputils>.
   # Copyright 2007 Google Inc. All Rights Reserved.
@@ -701,22 +707,35 @@ def AtomicWrite(
   # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
   # See the License for the specific language governing permissions and
   # limitations under the License.
-  fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename))
-  try:
-    os.write(fd, contents)
-  finally:
-    os.close(fd)
+  if isinstance(contents, bytes):
+    contents = [contents]
+  dirname = os.path.dirname(filename)
+  fd, tmp_filename = tempfile.mkstemp(dir=dirname)
   try:
+    with os.fdopen(fd, "wb") as f:
+      for chunk in contents:
+        f.write(chunk)
+      if fsync:
+        f.flush()
+        os.fsync(f.fileno())
     os.chmod(tmp_filename, mode)
     if gid is not None:
       os.chown(tmp_filename, -1, gid)
-    os.rename(tmp_filename, filename)
-  except OSError as exc:
+    os.replace(tmp_filename, filename)
+  except BaseException as exc:
     try:
       os.remove(tmp_filename)
     except OSError as e:
-      exc = OSError("%s. Additional errors cleaning up: %s" % (exc, e))
-    raise exc
+      raise OSError("%s. Additional errors cleaning up: %s" % (exc, e))
+    raise
+
+  if fsync:
+    # Flush the directory entry of the renamed file.
+    dir_fd = os.open(dirname or ".", os.O_RDONLY)
+    try:
+      os.fsync(dir_fd)
+    finally:
+      os.close(dir_fd)
 
 
 @contextlib.contextmanager
@@ -23,9 +23,13 @@ import threading
 import typing
 
 from labm8.py import app
-from labm8.py import bazelutil
-from labm8.py import pbutil
-from labm8.py import sqlutil
+
+if typing.TYPE_CHECKING:
+  # These modules are imported on first use, since they are expensive to
+  # import and are not needed by users of the lightweight utilities in this
+  # module, such as ThreadedIterator.
+  from labm8.py import pbutil
+  from labm8.py import sqlutil
 
 FLAGS = app.FLAGS
 
@@ -61,7 +65,7 @@ class _MapWorker(object):
   """
 
   def __init__(
-    self, id: int, cmd: typing.List[str], input_proto: pbutil.ProtocolBuffer,
+    self, id: int, cmd: typing.List[str], input_proto: "pbutil.ProtocolBuffer",
   ):
     """Create a map worker.
 
@@ -75,10 +79,10 @@ class _MapWorker(object):
     # We store the input proto in wire format (as a serialized string) rather
     # than as a class object as pickle can get confused by the types.
     # See: https://stackoverflow.com/a/1413299
-    self._input_proto: typing.Optional[pbutil.ProtocolBuffer] = None
+    self._input_proto: "typing.Optional[pbutil.ProtocolBuffer]" = None
     self._input_proto_string = input_proto.SerializeToString()
     self._output_proto_string: typing.Optional[str] = None
-    self._output_proto: typing.Optional[pbutil.ProtocolBuffer] = None
+    self._output_proto: "typing.Optional[pbutil.ProtocolBuffer]" = None
     self._output_proto_decoded = False
     self._returncode: typing.Optional[int] = None
     self._done = False
@@ -107,7 +111,7 @@ class _MapWorker(object):
       self._output_proto_string = stdout
 
   def SetProtos(
-    self, input_proto: pbutil.ProtocolBuffer, output_proto_class: typing.Type,
+    self, input_proto: "pbutil.ProtocolBuffer", output_proto_class: typing.Type,
   ) -> None:
     """Set the input protocol buffer, and decode the output protocol buffer.
 
@@ -138,12 +142,12 @@ class _MapWorker(object):
     """Return the numeric ID of the map worker."""
     return self._id
 
-  def input(self) -> pbutil.ProtocolBuffer:
+  def input(self) -> "pbutil.ProtocolBuffer":
     """Get the input protocol buffer."""
     assert self._done
     return self._input_proto
 
-  def output(self) -> typing.Optional[pbutil.ProtocolBuffer]:
+  def output(self) -> "typing.Optional[pbutil.ProtocolBuffer]":
     """Get the protocol buffer decoded from stdout of the executed binary.
 
     If the process failed (e.g. not _MapWorker.ok()), None is returned.
@@ -176,7 +180,7 @@ def _RunNativeProtoProcessingWorker(map_worker: _MapWorker) -> _MapWorker:
 
 def MapNativeProtoProcessingBinary(
   binary_data_path: str,
-  input_protos: typing.List[pbutil.ProtocolBuffer],
+  input_protos: "typing.List[pbutil.ProtocolBuffer]",
   output_proto_class: typing.Type,
   binary_args: typing.Optional[typing.List[str]] = None,
   pool: typing.Optional[multiprocessing.Pool] = None,
@@ -196,6 +200,8 @@ def MapNativeProtoProcessingBinary(
   Returns:
     A generator of _MapWorker instances. The order is random.
   """
+  from labm8.py import bazelutil
+
   binary_path = bazelutil.DataPath(binary_data_path)
   binary_args = binary_args or []
   cmd = [str(binary_path)] + binary_args
@@ -221,7 +227,7 @@ def MapNativeProtoProcessingBinary(
 
 def MapNativeProcessingBinaries(
   binaries: typing.List[str],
-  input_protos: typing.List[pbutil.ProtocolBuffer],
+  input_protos: "typing.List[pbutil.ProtocolBuffer]",
   output_proto_classes: typing.List[typing.Type],
   pool: typing.Optional[multiprocessing.Pool] = None,
   num_processes: typing.Optional[int] = None,
@@ -243,6 +249,8 @@ def MapNativeProcessingBinaries(
   if not len(binaries) == len(input_protos):
     raise ValueError("Number of binaries does not equal protos")
 
+  from labm8.py import bazelutil
+
   cmds = [[bazelutil.DataPath(b)] for b in binaries]
 
   # Read all inputs to a list. We need the inputs in a list so that we can
@@ -276,7 +284,7 @@ BatchCallback = typing.Callable[[int], None]
 
 def MapDatabaseRowBatchProcessor(
   work_unit: WorkUnitType,
-  query: sqlutil.Query,
+  query: "sqlutil.Query",
   generate_work_unit_args: WorkUnitArgGenerator = lambda rows: rows,
   work_unit_result_callback: ResultCallback = lambda result: None,
   start_of_batch_callback: BatchCallback = lambda i: None,
@@ -313,6 +321,8 @@ def MapDatabaseRowBatchProcessor(
     Foo.
   """
 
+  from labm8.py import sqlutil
+
   pool = pool or multiprocessing.Pool()
 
   i = start_at
@@ -30,7 +30,7 @@ def GetCacheDir() -> pathlib.Path:
   else:
     cache_dir = pathlib.Path(
       appdirs.user_cache_dir(
-        "phd_format", "Chris Cummins", version=build_info.GetBuildInfo().version
+        "phd_format", "Chris Cummins", version=build_info.Version()
       )
     )
   cache_dir.mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,744 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module defines the storage backends of the persistent format cache.
+
+A store is a persistent map from the absolute path of a file to the mtime that
+it had when it was last formatted, and the day that it was last visited. A
+store also holds a small table of integer metadata, and the historical timings
+of formatters. Two stores are implemented:
+
+  * SqliteStore, an sqlite database accessed using the sqlite3 module.
+  * MmapStore, an open addressing hash table in a memory-mapped file.
+"""
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import pathlib
+import sqlite3
+import struct
+import time
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import fasteners
+from labm8.py import app
+from labm8.py import fs
+
+FLAGS = app.FLAGS
+
+
+class CacheStore(object):
+  """Base class for cache stores.
+
+  Writes and iteration of file entries must be made within a Transaction(),
+  which holds the lock on the store and commits the changes on exit.
+  Transactions may be nested, in which case only the outermost transaction
+  commits. The other methods may be called outside of a transaction.
+
+  A store may be shared by many processes. Transactions should be kept short,
+  since a transaction blocks writers in other processes until it ends.
+  """
+
+  class BusyError(OSError):
+    """Raised if the store is locked by another process for longer than the
+    timeout."""
+
+  # The name of the cache file, relative to the cache directory.
+  filename: str = None
+
+  def __init__(self, cache_dir: pathlib.Path, timeout: float = 10):
+    """Constructor.
+
+    Args:
+      cache_dir: The directory containing the cache files.
+      timeout: The number of seconds to wait for a lock held by another
+        process before raising a BusyError.
+    """
+    self.path = cache_dir / self.filename
+    self.timeout = timeout
+
+  def Transaction(self):
+    """Return a context manager for a transaction.
+
+    Raises:
+      BusyError: If the store lock cannot be acquired.
+    """
+    raise NotImplementedError
+
+  def Get(self, path: str) -> Optional[int]:
+    """Return the mtime of a file, or None if it is not in the store.
+
+    Outside of a transaction, this reads the most recently committed entry.
+    """
+    raise NotImplementedError
+
+  def PutMany(self, entries: Iterable[Tuple[str, int, int]]) -> None:
+    """Insert or replace <path, mtime, last_seen> entries."""
+    raise NotImplementedError
+
+  def TouchMany(self, paths: Iterable[str], last_seen: int) -> None:
+    """Set the last-seen time of files which were last seen before it."""
+    raise NotImplementedError
+
+  def DeleteMany(self, paths: Iterable[str]) -> None:
+    """Remove files from the store."""
+    raise NotImplementedError
+
+  def Items(self) -> Iterator[Tuple[str, int, int]]:
+    """Iterate over the <path, mtime, last_seen> entries of the store."""
+    raise NotImplementedError
+
+  def __len__(self) -> int:
+    """Return the number of files in the store."""
+    raise NotImplementedError
+
+  def GetDirectoryCount(self) -> int:
+    """Return the number of directories containing files in the store."""
+    with self.Transaction():
+      return len({os.path.dirname(path) for path, _, _ in self.Items()})
+
+  def GetTimings(self) -> Dict[str, List[float]]:
+    """Return a mapping from formatter name to its regression sums."""
+    raise NotImplementedError
+
+  def SetTimings(self, timings: Dict[str, List[float]]) -> None:
+    """Insert or replace the regression sums of formatters."""
+    raise NotImplementedError
+
+  def GetMeta(self, key: str) -> Optional[int]:
+    """Read a value from the metadata table."""
+    raise NotImplementedError
+
+  def SetMeta(self, key: str, value: int) -> None:
+    """Write a value to the metadata table."""
+    raise NotImplementedError
+
+  def Compact(self) -> None:
+    """Reclaim the space used by deleted entries."""
+    raise NotImplementedError
+
+  @property
+  def size_in_bytes(self) -> int:
+    """The size of the store on disk."""
+    return self.path.stat().st_size if self.path.is_file() else 0
+
+
+class SqliteStore(CacheStore):
+  """A cache store in an sqlite database.
+
+  To reduce the size of keys, paths are split into a directory and a file
+  name, and each directory path is stored once in an interned "directories"
+  table. The database uses write-ahead logging, so that readers do not block
+  on a writer, and a writer does not block on readers. Writers wait for each
+  other using sqlite's busy timeout.
+  """
+
+  filename = "cache.sqlite.db"
+
+  def __init__(self, cache_dir: pathlib.Path, timeout: float = 10):
+    super(SqliteStore, self).__init__(cache_dir, timeout=timeout)
+    # Transactions are managed explicitly, rather than by the sqlite3 module.
+    # The connection may be used by a thread other than the one which created
+    # it, but never by more than one thread at a time.
+    self.db = sqlite3.connect(
+      str(self.path),
+      timeout=timeout,
+      isolation_level=None,
+      check_same_thread=False,
+    )
+    with self._RaiseBusyErrors():
+      self.db.execute("PRAGMA journal_mode = WAL")
+    # With write-ahead logging, transactions are durable once the log is
+    # checkpointed, which is safe against database corruption.
+    self.db.execute("PRAGMA synchronous = NORMAL")
+    self._transaction_depth = 0
+    # A mapping from directory path to interned directory ID. This is reset
+    # at the start of every transaction, since directories may be removed by
+    # other processes.
+    self._directory_ids: Dict[str, int] = {}
+    with self._RaiseBusyErrors():
+      self._CreateTables()
+
+  @contextlib.contextmanager
+  def _RaiseBusyErrors(self):
+    """Translate the sqlite errors of a locked database to BusyErrors."""
+    try:
+      yield
+    except sqlite3.OperationalError as e:
+      if "locked" in str(e) or "busy" in str(e):
+        raise self.BusyError(f"Cache database is locked: {self.path}") from e
+      raise
+
+  def _CreateTables(self) -> None:
+    """Create the cache tables and migrate legacy data, if required."""
+    self.db.executescript(
+      """
+    CREATE TABLE IF NOT EXISTS directories(
+      id INTEGER NOT NULL PRIMARY KEY,
+      path TEXT NOT NULL UNIQUE
+    );
+    CREATE TABLE IF NOT EXISTS files(
+      directory_id INTEGER NOT NULL,
+      name TEXT NOT NULL,
+      mtime INTEGER NOT NULL,
+      last_seen INTEGER NOT NULL,
+      PRIMARY KEY (directory_id, name)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS timings(
+      formatter TEXT NOT NULL PRIMARY KEY,
+      n REAL NOT NULL,
+      sum_x REAL NOT NULL,
+      sum_y REAL NOT NULL,
+      sum_xx REAL NOT NULL,
+      sum_xy REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS meta(
+      key TEXT NOT NULL PRIMARY KEY,
+      value INTEGER NOT NULL
+    );
+    """
+    )
+
+    # Migrate the contents of the legacy cache table, which used the full
+    # absolute path of files as keys.
+    has_legacy_table = self.db.execute(
+      "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'cache'"
+    ).fetchone()
+    if has_legacy_table:
+      app.Log(2, "Migrating legacy cache table")
+      # Migrated entries are marked as seen today, so that they are not all
+      # evicted by the next prune.
+      now = int(time.time())
+      today = now - now % (24 * 60 * 60)
+      with self.Transaction():
+        self.PutMany(
+          (path, mtime, today)
+          for path, mtime in self.db.execute(
+            "SELECT path, mtime FROM cache"
+          ).fetchall()
+        )
+        self.db.execute("DROP TABLE cache")
+
+  @contextlib.contextmanager
+  def Transaction(self):
+    if self._transaction_depth:
+      self._transaction_depth += 1
+      try:
+        yield
+      finally:
+        self._transaction_depth -= 1
+      return
+
+    # The write lock is acquired at the start of the transaction, rather than
+    # on the first write, so that a transaction which has read the database
+    # never needs to wait for a lock, which could deadlock.
+    with self._RaiseBusyErrors():
+      self.db.execute("BEGIN IMMEDIATE")
+    self._transaction_depth = 1
+    self._directory_ids = {}
+    try:
+      yield
+      with self._RaiseBusyErrors():
+        self.db.execute("COMMIT")
+    except BaseException:
+      if self.db.in_transaction:
+        self.db.execute("ROLLBACK")
+      raise
+    finally:
+      self._transaction_depth = 0
+
+  def _GetDirectoryId(self, directory: str, create: bool) -> Optional[int]:
+    """Lookup the interned ID of a directory path.
+
+    Args:
+      directory: The directory path.
+      create: If True, add the directory to the table if it is not found.
+
+    Returns:
+      The directory ID, or None if not found and create is False.
+    """
+    directory_id = self._directory_ids.get(directory)
+    if directory_id is not None:
+      return directory_id
+
+    row = self.db.execute(
+      "SELECT id FROM directories WHERE path = ?", (directory,)
+    ).fetchone()
+    if row:
+      directory_id = row[0]
+    elif create:
+      directory_id = self.db.execute(
+        "INSERT INTO directories (path) VALUES (?)", (directory,)
+      ).lastrowid
+    else:
+      return None
+
+    self._directory_ids[directory] = directory_id
+    return directory_id
+
+  def _GetKey(self, path: str, create: bool) -> Optional[Tuple[int, str]]:
+    """Return the <directory_id, name> key of a path."""
+    directory, name = os.path.split(path)
+    directory_id = self._GetDirectoryId(directory, create=create)
+    return None if directory_id is None else (directory_id, name)
+
+  def Get(self, path: str) -> Optional[int]:
+    # The directory ID is not cached, since outside of a transaction the
+    # directory may be removed by another process.
+    directory, name = os.path.split(path)
+    with self._RaiseBusyErrors():
+      row = self.db.execute(
+        """
+      SELECT files.mtime
+      FROM files
+      INNER JOIN directories ON files.directory_id = directories.id
+      WHERE directories.path = ? AND files.name = ?
+      """,
+        (directory, name),
+      ).fetchone()
+    return row[0] if row else None
+
+  def PutMany(self, entries: Iterable[Tuple[str, int, int]]) -> None:
+    self.db.executemany(
+      "REPLACE INTO files (directory_id, name, mtime, last_seen) "
+      "VALUES (?, ?, ?, ?)",
+      (
+        self._GetKey(path, create=True) + (mtime, last_seen)
+        for path, mtime, last_seen in entries
+      ),
+    )
+
+  def TouchMany(self, paths: Iterable[str], last_seen: int) -> None:
+    # Only rows which have not already been seen are updated, so that a no-op
+    # run does not rewrite the entire table.
+    keys = [self._GetKey(path, create=False) for path in paths]
+    self.db.executemany(
+      "UPDATE files SET last_seen = ? WHERE directory_id = ? AND name = ? "
+      "AND last_seen < ?",
+      ((last_seen,) + key + (last_seen,) for key in keys if key),
+    )
+
+  def DeleteMany(self, paths: Iterable[str]) -> None:
+    keys = [self._GetKey(path, create=False) for path in paths]
+    self.db.executemany(
+      "DELETE FROM files WHERE directory_id = ? AND name = ?",
+      (key for key in keys if key),
+    )
+    self.db.execute(
+      "DELETE FROM directories "
+      "WHERE id NOT IN (SELECT DISTINCT directory_id FROM files)"
+    )
+    self._directory_ids = {}
+
+  def Items(self) -> Iterator[Tuple[str, int, int]]:
+    for directory, name, mtime, last_seen in self.db.execute(
+      """
+    SELECT directories.path, files.name, files.mtime, files.last_seen
+    FROM files
+    INNER JOIN directories ON files.directory_id = directories.id
+    """
+    ):
+      yield os.path.join(directory, name), mtime, last_seen
+
+  def __len__(self) -> int:
+    return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+  def GetDirectoryCount(self) -> int:
+    return self.db.execute("SELECT COUNT(*) FROM directories").fetchone()[0]
+
+  def GetTimings(self) -> Dict[str, List[float]]:
+    return {
+      row[0]: list(row[1:])
+      for row in self.db.execute(
+        "SELECT formatter, n, sum_x, sum_y, sum_xx, sum_xy FROM timings"
+      )
+    }
+
+  def SetTimings(self, timings: Dict[str, List[float]]) -> None:
+    with self.Transaction():
+      self.db.executemany(
+        "REPLACE INTO timings (formatter, n, sum_x, sum_y, sum_xx, sum_xy) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        ([formatter] + list(sums) for formatter, sums in timings.items()),
+      )
+
+  def GetMeta(self, key: str) -> Optional[int]:
+    row = self.db.execute(
+      "SELECT value FROM meta WHERE key = ?", (key,)
+    ).fetchone()
+    return row[0] if row else None
+
+  def SetMeta(self, key: str, value: int) -> None:
+    with self.Transaction():
+      self.db.execute(
+        "REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+      )
+
+  def Compact(self) -> None:
+    with self.Transaction():
+      self.db.execute(
+        "DELETE FROM files "
+        "WHERE directory_id NOT IN (SELECT id FROM directories)"
+      )
+    with self._RaiseBusyErrors():
+      self.db.execute("VACUUM")
+
+
+# The layout of the MmapStore file header: a magic number, the number of slots
+# in the hash table, the number of live entries, the number of slots which are
+# not empty (live entries plus deleted entries), and the number of bytes used
+# in the keys file.
+_MMAP_HEADER = struct.Struct("<8sQQQQ")
+_MMAP_MAGIC = b"FMTCACH1"
+# The magic number of a table which has been replaced by a rebuilt table.
+_MMAP_STALE_MAGIC = b"FMTSTALE"
+# The layout of a hash table slot: the hash of the path, the mtime, the last
+# seen time, and the offset of the path in the keys file.
+_MMAP_SLOT = struct.Struct("<Qqqq")
+# The fields of a slot, for reading and writing them individually.
+_MMAP_HASH = struct.Struct("<Q")
+_MMAP_TIMES = struct.Struct("<qq")
+_MMAP_LAST_SEEN = struct.Struct("<q")
+_MMAP_HASH_AND_MTIME = struct.Struct("<Qq")
+# The last seen time follows the hash and the mtime, which have the same size.
+_MMAP_LAST_SEEN_OFFSET = _MMAP_HASH.size + _MMAP_LAST_SEEN.size
+# The layout of the header of a path in the keys file: its length in bytes.
+_MMAP_KEY_HEADER = struct.Struct("<I")
+# Reserved hash values which mark empty and deleted slots.
+_MMAP_EMPTY = 0
+_MMAP_DELETED = 1
+# The permissions of the MmapStore files. These are set explicitly rather than
+# through the umask, so they must not be writable by other users.
+_FILE_MODE = 0o644
+_MMAP_MIN_CAPACITY = 1024
+# The maximum fraction of slots which may be used before the table is grown.
+_MMAP_MAX_LOAD = 0.7
+
+
+class MmapStore(CacheStore):
+  """A cache store in a memory-mapped hash table.
+
+  The store is an open addressing hash table with linear probing, keyed by a
+  64-bit hash of the path, which is stored in a memory-mapped file. Lookups
+  and updates are made in place, without parsing or copying the table. The
+  paths themselves are stored in a separate append-only keys file, which is
+  only read when iterating over the store. The metadata and timings tables are
+  small, and are stored as a JSON file.
+
+  Transactions hold an exclusive inter-process lock. Updates are not
+  journaled, but a slot is written before its hash, so that a partially
+  written slot is never matched by a lookup.
+
+  Lookups do not take the lock. A table is only ever grown or compacted by
+  replacing its file, after marking the old file as stale, so a lookup reads
+  from the memory map of the file it has open until it sees the mark. A slot
+  which is read twice with different results, because it was being written
+  concurrently, is read again under the lock.
+  """
+
+  filename = "cache.mmap.db"
+
+  def __init__(self, cache_dir: pathlib.Path, timeout: float = 10):
+    super(MmapStore, self).__init__(cache_dir, timeout=timeout)
+    self.keys_path = self.path.with_suffix(".keys")
+    self.meta_path = self.path.with_suffix(".json")
+    self._lock = fasteners.InterProcessLock(str(self.path.with_suffix(".lock")))
+    self._transaction_depth = 0
+    # The open data file, its memory map, and the inode that it was opened
+    # from. The files are reopened if the table is rebuilt by another process.
+    self._data_fd: Optional[int] = None
+    self._mmap: Optional[mmap.mmap] = None
+    self._inode: Optional[int] = None
+    self._keys_fd: Optional[int] = None
+    # The contents of the JSON file, and whether they have been modified.
+    self._meta: Optional[Dict[str, Dict]] = None
+    self._meta_modified = False
+
+  @contextlib.contextmanager
+  def Transaction(self):
+    if self._transaction_depth:
+      self._transaction_depth += 1
+      try:
+        yield
+      finally:
+        self._transaction_depth -= 1
+      return
+
+    if not self._lock.acquire(timeout=self.timeout):
+      raise self.BusyError(f"Cache is locked: {self.path}")
+    self._transaction_depth = 1
+    try:
+      self._Open()
+      yield
+      if self._meta_modified:
+        fs.AtomicWrite(
+          self.meta_path,
+          json.dumps(self._meta).encode("utf-8"),
+          mode=_FILE_MODE,
+        )
+    finally:
+      self._meta = None
+      self._meta_modified = False
+      self._transaction_depth = 0
+      self._lock.release()
+
+  def _Open(self) -> None:
+    """Open the store files, or reopen them if they have been replaced."""
+    try:
+      inode = os.stat(self.path).st_ino
+    except FileNotFoundError:
+      self._Write(self.path, self.keys_path, _MMAP_MIN_CAPACITY, [], b"")
+      inode = os.stat(self.path).st_ino
+    if inode != self._inode:
+      self._Close()
+      self._data_fd = os.open(self.path, os.O_RDWR)
+      self._mmap = mmap.mmap(self._data_fd, 0)
+      self._keys_fd = os.open(self.keys_path, os.O_RDWR | os.O_CREAT, 0o644)
+      self._inode = inode
+      magic, *_ = _MMAP_HEADER.unpack_from(self._mmap)
+      if magic != _MMAP_MAGIC:
+        raise OSError(f"Cache file is corrupt: {self.path}")
+
+  def _Close(self) -> None:
+    """Close the store files."""
+    if self._mmap:
+      self._mmap.close()
+      os.close(self._data_fd)
+      os.close(self._keys_fd)
+    self._mmap = self._data_fd = self._keys_fd = self._inode = None
+
+  @staticmethod
+  def _Write(
+    path: pathlib.Path,
+    keys_path: pathlib.Path,
+    capacity: int,
+    slots: List[Tuple[int, int, int, int]],
+    keys: bytes,
+  ) -> None:
+    """Write a new table containing the given slots and keys file."""
+    data = bytearray(_MMAP_HEADER.size + capacity * _MMAP_SLOT.size)
+    _MMAP_HEADER.pack_into(
+      data, 0, _MMAP_MAGIC, capacity, len(slots), len(slots), len(keys)
+    )
+    for slot in slots:
+      index = _FindEmptySlot(data, capacity, slot[0])
+      _MMAP_SLOT.pack_into(data, _SlotOffset(index), *slot)
+    # The keys file is replaced first. Other processes only read either file
+    # while holding the lock, and reopen both when the table is replaced.
+    fs.AtomicWrite(keys_path, keys, mode=_FILE_MODE)
+    fs.AtomicWrite(path, bytes(data), mode=_FILE_MODE)
+
+  def _Rebuild(self, capacity: int) -> None:
+    """Rebuild the table with a new capacity, dropping deleted entries."""
+    slots, keys = [], bytearray()
+    for path, mtime, last_seen in self.Items():
+      key = os.fsencode(path)
+      slots.append((_PathHash(path), mtime, last_seen, len(keys)))
+      keys += _MMAP_KEY_HEADER.pack(len(key)) + key
+    self._Write(self.path, self.keys_path, capacity, slots, bytes(keys))
+    # Tell the other processes which have the old table open to reopen it.
+    self._mmap[: len(_MMAP_STALE_MAGIC)] = _MMAP_STALE_MAGIC
+    self._Open()
+
+  def _Header(self) -> Tuple[int, int, int, int]:
+    """Return the <capacity, count, used, keys_size> of the table."""
+    return _MMAP_HEADER.unpack_from(self._mmap)[1:]
+
+  def _Find(self, path_hash: int) -> Tuple[Optional[int], int]:
+    """Find the slot of a hash.
+
+    Returns:
+      A tuple of the index of the slot containing the hash, or None if not
+      found, and the index of the first slot in which the hash can be inserted.
+    """
+    capacity = self._Header()[0]
+    index = path_hash & (capacity - 1)
+    free = None
+    while True:
+      (slot_hash,) = _MMAP_HASH.unpack_from(self._mmap, _SlotOffset(index))
+      if slot_hash == path_hash:
+        return index, index
+      elif slot_hash == _MMAP_EMPTY:
+        return None, index if free is None else free
+      elif slot_hash == _MMAP_DELETED and free is None:
+        free = index
+      index = (index + 1) & (capacity - 1)
+
+  def Get(self, path: str) -> Optional[int]:
+    path_hash = _PathHash(path)
+    magic_size = len(_MMAP_MAGIC)
+    if self._mmap is not None and self._mmap[:magic_size] == _MMAP_MAGIC:
+      index, _ = self._Find(path_hash)
+      if index is None:
+        return None
+      # Read the hash and mtime of the slot twice, and accept them if they are
+      # unchanged, so that a concurrent update is not read half written.
+      offset = _SlotOffset(index)
+      slot = _MMAP_HASH_AND_MTIME.unpack_from(self._mmap, offset)
+      if slot == _MMAP_HASH_AND_MTIME.unpack_from(self._mmap, offset):
+        if slot[0] == path_hash:
+          return slot[1]
+
+    # The table has not been opened, or has been replaced, or the slot was
+    # modified while it was read.
+    with self.Transaction():
+      index, _ = self._Find(path_hash)
+      if index is None:
+        return None
+      return _MMAP_SLOT.unpack_from(self._mmap, _SlotOffset(index))[1]
+
+  def PutMany(self, entries: Iterable[Tuple[str, int, int]]) -> None:
+    for path, mtime, last_seen in entries:
+      path_hash = _PathHash(path)
+      index, free = self._Find(path_hash)
+      if index is not None:
+        _MMAP_TIMES.pack_into(
+          self._mmap, _SlotOffset(index) + _MMAP_HASH.size, mtime, last_seen
+        )
+        continue
+
+      capacity, count, used, keys_size = self._Header()
+      if used + 1 > capacity * _MMAP_MAX_LOAD:
+        self._Rebuild(capacity * 2)
+        _, free = self._Find(path_hash)
+        capacity, count, used, keys_size = self._Header()
+
+      key = os.fsencode(path)
+      os.pwrite(
+        self._keys_fd, _MMAP_KEY_HEADER.pack(len(key)) + key, keys_size
+      )
+      # Write the slot contents before the hash which makes it visible.
+      offset = _SlotOffset(free)
+      (slot_hash,) = _MMAP_HASH.unpack_from(self._mmap, offset)
+      _MMAP_SLOT.pack_into(
+        self._mmap, offset, slot_hash, mtime, last_seen, keys_size
+      )
+      _MMAP_HASH.pack_into(self._mmap, offset, path_hash)
+      _MMAP_HEADER.pack_into(
+        self._mmap,
+        0,
+        _MMAP_MAGIC,
+        capacity,
+        count + 1,
+        used + (slot_hash == _MMAP_EMPTY),
+        keys_size + _MMAP_KEY_HEADER.size + len(key),
+      )
+
+  def TouchMany(self, paths: Iterable[str], last_seen: int) -> None:
+    for path in paths:
+      index, _ = self._Find(_PathHash(path))
+      if index is not None:
+        offset = _SlotOffset(index) + _MMAP_LAST_SEEN_OFFSET
+        if _MMAP_LAST_SEEN.unpack_from(self._mmap, offset)[0] < last_seen:
+          _MMAP_LAST_SEEN.pack_into(self._mmap, offset, last_seen)
+
+  def DeleteMany(self, paths: Iterable[str]) -> None:
+    for path in paths:
+      index, _ = self._Find(_PathHash(path))
+      if index is not None:
+        _MMAP_HASH.pack_into(self._mmap, _SlotOffset(index), _MMAP_DELETED)
+        capacity, count, used, keys_size = self._Header()
+        _MMAP_HEADER.pack_into(
+          self._mmap, 0, _MMAP_MAGIC, capacity, count - 1, used, keys_size
+        )
+
+  def Items(self) -> Iterator[Tuple[str, int, int]]:
+    capacity = self._Header()[0]
+    for index in range(capacity):
+      path_hash, mtime, last_seen, key_offset = _MMAP_SLOT.unpack_from(
+        self._mmap, _SlotOffset(index)
+      )
+      if path_hash > _MMAP_DELETED:
+        (length,) = _MMAP_KEY_HEADER.unpack(
+          os.pread(self._keys_fd, _MMAP_KEY_HEADER.size, key_offset)
+        )
+        key_offset += _MMAP_KEY_HEADER.size
+        key = os.pread(self._keys_fd, length, key_offset)
+        yield os.fsdecode(key), mtime, last_seen
+
+  def __len__(self) -> int:
+    with self.Transaction():
+      return self._Header()[1]
+
+  def _GetMeta(self) -> Dict[str, Dict]:
+    """Read the contents of the JSON file."""
+    if self._meta is None:
+      try:
+        self._meta = json.loads(fs.Read(self.meta_path))
+      except FileNotFoundError:
+        self._meta = {"meta": {}, "timings": {}}
+    return self._meta
+
+  def GetTimings(self) -> Dict[str, List[float]]:
+    with self.Transaction():
+      return dict(self._GetMeta()["timings"])
+
+  def SetTimings(self, timings: Dict[str, List[float]]) -> None:
+    with self.Transaction():
+      self._GetMeta()["timings"].update(timings)
+      self._meta_modified = True
+
+  def GetMeta(self, key: str) -> Optional[int]:
+    with self.Transaction():
+      return self._GetMeta()["meta"].get(key)
+
+  def SetMeta(self, key: str, value: int) -> None:
+    with self.Transaction():
+      self._GetMeta()["meta"][key] = value
+      self._meta_modified = True
+
+  def Compact(self) -> None:
+    with self.Transaction():
+      capacity = _MMAP_MIN_CAPACITY
+      while len(self) + 1 > capacity * _MMAP_MAX_LOAD / 2:
+        capacity *= 2
+      self._Rebuild(capacity)
+
+  @property
+  def size_in_bytes(self) -> int:
+    return sum(
+      path.stat().st_size if path.is_file() else 0
+      for path in (self.path, self.keys_path, self.meta_path)
+    )
+
+
+def _PathHash(path: str) -> int:
+  """Return the 64-bit hash of a path, excluding the reserved values."""
+  path_hash = int.from_bytes(
+    hashlib.blake2b(os.fsencode(path), digest_size=8).digest(), "little"
+  )
+  return max(path_hash, _MMAP_DELETED + 1)
+
+
+def _SlotOffset(index: int) -> int:
+  """Return the byte offset of a slot in the table."""
+  return _MMAP_HEADER.size + index * _MMAP_SLOT.size
+
+
+def _FindEmptySlot(data: bytearray, capacity: int, path_hash: int) -> int:
+  """Return the index of the first empty slot for a hash in a new table."""
+  index = path_hash & (capacity - 1)
+  while _MMAP_HASH.unpack_from(data, _SlotOffset(index))[0]:
+    index = (index + 1) & (capacity - 1)
+  return index
+
+
+# The available cache stores, by name.
+STORES = {"sqlite": SqliteStore, "mmap": MmapStore}
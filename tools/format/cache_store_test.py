@@ -0,0 +1,264 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format:cache_store."""
+import pathlib
+import sqlite3
+from typing import List
+from typing import Tuple
+
+from labm8.py import test
+from tools.format import cache_store
+
+FLAGS = test.FLAGS
+
+
+@test.Fixture(scope="function", params=sorted(cache_store.STORES))
+def store_class(request) -> type:
+  return cache_store.STORES[request.param]
+
+
+@test.Fixture(scope="function")
+def store(store_class: type, tempdir: pathlib.Path) -> cache_store.CacheStore:
+  return store_class(tempdir)
+
+
+def test_Get_empty_store(store: cache_store.CacheStore):
+  with store.Transaction():
+    assert store.Get("/a/b") is None
+  assert len(store) == 0
+
+
+def test_PutMany_Get(store: cache_store.CacheStore):
+  with store.Transaction():
+    store.PutMany([("/a/b", 1, 10), ("/a/c", 2, 10), ("/d", 3, 10)])
+  with store.Transaction():
+    assert store.Get("/a/b") == 1
+    assert store.Get("/a/c") == 2
+    assert store.Get("/d") == 3
+    assert store.Get("/a") is None
+  assert len(store) == 3
+  assert store.GetDirectoryCount() == 2
+
+
+def test_PutMany_replaces_entries(store: cache_store.CacheStore):
+  with store.Transaction():
+    store.PutMany([("/a", 1, 10)])
+    store.PutMany([("/a", 2, 20)])
+    assert store.Get("/a") == 2
+    assert list(store.Items()) == [("/a", 2, 20)]
+  assert len(store) == 1
+
+
+def test_TouchMany(store: cache_store.CacheStore):
+  with store.Transaction():
+    store.PutMany([("/a", 1, 10), ("/b", 1, 30)])
+    store.TouchMany(["/a", "/b", "/c"], 20)
+    assert sorted(store.Items()) == [("/a", 1, 20), ("/b", 1, 30)]
+
+
+def test_DeleteMany(store: cache_store.CacheStore):
+  with store.Transaction():
+    store.PutMany([("/a/b", 1, 10), ("/c/d", 2, 10)])
+    store.DeleteMany(["/a/b", "/e"])
+    assert store.Get("/a/b") is None
+    assert store.Get("/c/d") == 2
+  assert len(store) == 1
+  assert store.GetDirectoryCount() == 1
+
+
+def test_DeleteMany_reinsert(store: cache_store.CacheStore):
+  with store.Transaction():
+    store.PutMany([("/a", 1, 10)])
+    store.DeleteMany(["/a"])
+    store.PutMany([("/a", 2, 10)])
+    assert store.Get("/a") == 2
+  assert len(store) == 1
+
+
+def test_Transaction_rollback(store: cache_store.CacheStore):
+  with store.Transaction():
+    store.PutMany([("/a", 1, 10)])
+  with test.Raises(ValueError):
+    with store.Transaction():
+      store.PutMany([("/b", 1, 10)])
+      raise ValueError("error")
+  if isinstance(store, cache_store.SqliteStore):
+    # Only the sqlite store is journaled.
+    with store.Transaction():
+      assert store.Get("/b") is None
+  with store.Transaction():
+    assert store.Get("/a") == 1
+
+
+def test_PutMany_many_entries(store: cache_store.CacheStore):
+  """Test that a store grows beyond its initial capacity."""
+  entries = [(f"/dir{i % 10}/file{i}", i, 10) for i in range(5000)]
+  with store.Transaction():
+    store.PutMany(entries)
+  with store.Transaction():
+    assert all(store.Get(path) == mtime for path, mtime, _ in entries)
+    assert sorted(store.Items()) == sorted(entries)
+  assert len(store) == 5000
+
+
+def test_persistence(store_class: type, tempdir: pathlib.Path):
+  store = store_class(tempdir)
+  with store.Transaction():
+    store.PutMany([("/a", 1, 10)])
+  store.SetMeta("key", 5)
+  store.SetTimings({"black": [1, 2, 3, 4, 5]})
+
+  store = store_class(tempdir)
+  with store.Transaction():
+    assert store.Get("/a") == 1
+  assert store.GetMeta("key") == 5
+  assert store.GetTimings() == {"black": [1, 2, 3, 4, 5]}
+
+
+def test_concurrent_stores(store_class: type, tempdir: pathlib.Path):
+  """Test that updates by one store are visible to another."""
+  a, b = store_class(tempdir), store_class(tempdir)
+  with a.Transaction():
+    a.PutMany([("/a", 1, 10)])
+  with b.Transaction():
+    assert b.Get("/a") == 1
+    b.PutMany([(f"/b{i}", i, 10) for i in range(2000)])
+  with a.Transaction():
+    assert a.Get("/b1999") == 1999
+  assert len(a) == 2001
+
+
+def test_MmapStore_Get_does_not_wait_for_lock(tempdir: pathlib.Path):
+  a = cache_store.MmapStore(tempdir)
+  b = cache_store.MmapStore(tempdir, timeout=0.1)
+  with a.Transaction():
+    a.PutMany([("/a", 1, 10)])
+  assert b.Get("/a") == 1
+  with a.Transaction():
+    a.PutMany([("/a", 2, 10)])
+    assert b.Get("/a") == 2
+    assert b.Get("/b") is None
+
+
+def test_MmapStore_Get_reopens_rebuilt_table(tempdir: pathlib.Path):
+  a, b = cache_store.MmapStore(tempdir), cache_store.MmapStore(tempdir)
+  with a.Transaction():
+    a.PutMany([("/a", 1, 10)])
+  assert b.Get("/a") == 1
+  # Inserting many entries grows the table, which replaces its file.
+  with a.Transaction():
+    a.PutMany([(f"/b{i}", i, 10) for i in range(2000)])
+  assert b.Get("/b1999") == 1999
+  a.Compact()
+  assert b.Get("/a") == 1
+
+
+def test_MmapStore_files_are_not_world_writable(tempdir: pathlib.Path):
+  store = cache_store.MmapStore(tempdir)
+  with store.Transaction():
+    store.PutMany([("/a", 1, 10)])
+    store.SetMeta("key", 1)
+  for path in (store.path, store.keys_path, store.meta_path):
+    assert path.stat().st_mode & 0o777 == 0o644
+
+
+def test_GetMeta_missing(store: cache_store.CacheStore):
+  assert store.GetMeta("key") is None
+
+
+def test_Compact(store: cache_store.CacheStore):
+  with store.Transaction():
+    store.PutMany([(f"/a{i}", i, 10) for i in range(2000)])
+    store.DeleteMany([f"/a{i}" for i in range(1, 2000)])
+  store.Compact()
+  with store.Transaction():
+    assert list(store.Items()) == [("/a0", 0, 10)]
+  assert store.size_in_bytes > 0
+
+
+def test_SqliteStore_migrates_legacy_table(tempdir: pathlib.Path):
+  db = sqlite3.connect(str(tempdir / cache_store.SqliteStore.filename))
+  db.execute("CREATE TABLE cache (path TEXT PRIMARY KEY, mtime INTEGER)")
+  db.execute("INSERT INTO cache VALUES ('/a/b', 5)")
+  db.commit()
+  db.close()
+
+  store = cache_store.SqliteStore(tempdir)
+  with store.Transaction():
+    assert store.Get("/a/b") == 5
+    # Migrated entries are not evicted by the next prune.
+    ((_, _, last_seen),) = list(store.Items())
+    assert last_seen > 0
+
+
+# The number of entries in the benchmark stores, which is the size of a large
+# source tree.
+BENCHMARK_ENTRY_COUNT = 20000
+
+
+@test.Fixture(scope="function")
+def benchmark_entries() -> List[Tuple[str, int, int]]:
+  return [
+    (f"/src/dir{i % 500}/file{i}.py", i, 10)
+    for i in range(BENCHMARK_ENTRY_COUNT)
+  ]
+
+
+def test_benchmark_open(
+  benchmark, store_class: type, tempdir: pathlib.Path, benchmark_entries
+):
+  """Benchmark opening a populated store and making a single lookup."""
+  store = store_class(tempdir)
+  with store.Transaction():
+    store.PutMany(benchmark_entries)
+
+  def Benchmark():
+    store = store_class(tempdir)
+    with store.Transaction():
+      store.Get("/src/dir0/file0.py")
+
+  benchmark(Benchmark)
+
+
+def test_benchmark_PutMany(
+  benchmark, store_class: type, tempdir: pathlib.Path, benchmark_entries
+):
+  """Benchmark inserting entries into an empty store."""
+
+  def Benchmark():
+    store = store_class(tempdir)
+    with store.Transaction():
+      store.PutMany(benchmark_entries)
+      store.DeleteMany(path for path, _, _ in benchmark_entries)
+
+  benchmark(Benchmark)
+
+
+def test_benchmark_Get(
+  benchmark, store: cache_store.CacheStore, benchmark_entries
+):
+  """Benchmark looking up every entry in a store."""
+  with store.Transaction():
+    store.PutMany(benchmark_entries)
+
+  def Benchmark():
+    with store.Transaction():
+      for path, _, _ in benchmark_entries:
+        store.Get(path)
+
+  benchmark(Benchmark)
+
+
+if __name__ == "__main__":
+  test.Main()
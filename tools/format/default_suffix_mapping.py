@@ -11,49 +11,194 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""This module defines the mapping from file names to formatters."""
+"""This module defines the mapping from file names to formatters.
+
+Formatters are registered by the import path of their class, and are imported
+only when a file of that type is first formatted, so that the cost of
+importing a formatter's dependencies is paid only by the invocations which use
+it. Third-party formatters may be registered using the "phd_format.formatters"
+entry point group, where the name of the entry point is the suffix and its
+value is the formatter class, e.g. in setup.py:
+
+    entry_points={
+      "phd_format.formatters": [".rs = my_package.rust:FormatRust"],
+    }
+"""
+import collections.abc
+import importlib
+import threading
+import time
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+
 from labm8.py import app
-from tools.format.formatters import bazel
-from tools.format.formatters import cxx
-from tools.format.formatters import go
-from tools.format.formatters import java
-from tools.format.formatters import javascript
-from tools.format.formatters import json
-from tools.format.formatters import protobuf
-from tools.format.formatters import python
-from tools.format.formatters import shell
-from tools.format.formatters import sql
-from tools.format.formatters import text
 
 FLAGS = app.FLAGS
 
-# The mapping from path suffixes to FileFormatter classes. To look up the formatter
-# for a path, key into this dictionary first by pathlib.Path.suffix, or by
-# pathlib.Path.name if there is no suffix.
-mapping = {
-  ".bats": shell.FormatShell,
-  ".BUILD": bazel.FormatBuild,
-  ".bzl": python.FormatPython,
-  ".c": cxx.FormatCxx,
-  ".cc": cxx.FormatCxx,
-  ".cpp": cxx.FormatCxx,
-  ".css": javascript.FormatJavaScript,
-  ".cxx": cxx.FormatCxx,
-  ".formatignore": text.FormatText,
-  ".go": go.FormatGo,
-  ".h": cxx.FormatCxx,
-  ".hpp": cxx.FormatCxx,
-  ".html": javascript.FormatJavaScript,
-  ".ino": cxx.FormatCxx,
-  ".java": java.FormatJava,
-  ".js": javascript.FormatJavaScript,
-  ".json": json.FormatJson,
-  ".md": text.FormatText,
-  ".proto": protobuf.FormatProtobuf,
-  ".py": python.FormatPython,
-  ".sh": shell.FormatShell,
-  ".sql": sql.FormatSql,
-  ".txt": text.FormatText,
-  "BUILD": bazel.FormatBuild,
-  "WORKSPACE": bazel.FormatBuild,
-}
+# The entry point group for third-party formatters.
+ENTRY_POINT_GROUP = "phd_format.formatters"
+
+
+class LazySuffixMapping(collections.abc.Mapping):
+  """A mapping from path suffixes to formatter classes.
+
+  Values are registered as "module:Class" strings, and the module is imported
+  on the first lookup of a suffix which uses it. Testing whether a suffix is in
+  the mapping does not import anything. The time taken to import each
+  formatter is recorded in import_seconds.
+
+  Iterating over the mapping discovers the formatters registered as entry
+  points, which is slow. Use RegisteredKeys() to list the keys without doing
+  so, and LoadEntryPoints() to discover the rest when they are needed.
+  """
+
+  def __init__(
+    self, registry: Dict[str, str], entry_point_group: Optional[str] = None
+  ):
+    """Constructor.
+
+    Args:
+      registry: A map from suffix to "module:Class" strings.
+      entry_point_group: The name of an entry point group to discover
+        additional formatters from. Entry points are discovered on the first
+        lookup of a suffix which is not in the registry. Formatters in the
+        registry take precedence over entry points.
+    """
+    self._registry = dict(registry)
+    self._entry_point_group = entry_point_group
+    self._entry_points_loaded = entry_point_group is None
+    # A map from "module:Class" strings to imported classes.
+    self._classes: Dict[str, type] = {}
+    # The time taken to import each formatter, in seconds.
+    self.import_seconds: Dict[str, float] = {}
+    # Re-entrant, since importing a formatter may perform lookups.
+    self._lock = threading.RLock()
+
+  def __getitem__(self, key: str) -> type:
+    class_path = self._GetClassPath(key)
+    if class_path is None:
+      raise KeyError(key)
+    return self._classes.get(class_path) or self.Import(class_path)
+
+  def __contains__(self, key: str) -> bool:
+    return self._GetClassPath(key) is not None
+
+  def __iter__(self) -> Iterator[str]:
+    self.LoadEntryPoints()
+    return iter(self._registry)
+
+  def __len__(self) -> int:
+    self.LoadEntryPoints()
+    return len(self._registry)
+
+  def RegisteredKeys(self) -> List[str]:
+    """Return the keys of the mapping, without discovering entry points.
+
+    Returns:
+      The keys of the registry, and of any entry points which have already
+      been discovered.
+    """
+    with self._lock:
+      return list(self._registry)
+
+  def Import(self, class_path: str) -> type:
+    """Import and return a formatter class from a "module:Class" string."""
+    with self._lock:
+      if class_path not in self._classes:
+        module_name, _, class_name = class_path.partition(":")
+        start_time = time.time()
+        module = importlib.import_module(module_name)
+        self._classes[class_path] = getattr(module, class_name)
+        self.import_seconds[class_path] = time.time() - start_time
+        app.Log(
+          2,
+          "Imported %s in %d ms",
+          class_path,
+          self.import_seconds[class_path] * 1000,
+        )
+      return self._classes[class_path]
+
+  def _GetClassPath(self, key: str) -> Optional[str]:
+    """Return the "module:Class" string for a suffix, or None."""
+    if key not in self._registry and not self._entry_points_loaded:
+      self.LoadEntryPoints()
+    return self._registry.get(key)
+
+  def LoadEntryPoints(self) -> None:
+    """Add the formatters registered as entry points to the registry.
+
+    Entry points are discovered once. Subsequent calls do nothing.
+    """
+    with self._lock:
+      if self._entry_points_loaded:
+        return
+      self._entry_points_loaded = True
+      for entry_point in _GetEntryPoints(self._entry_point_group):
+        if entry_point.name in self._registry:
+          app.Warning(
+            "Ignoring formatter entry point %s = %s, suffix is already "
+            "formatted by %s",
+            entry_point.name,
+            entry_point.value,
+            self._registry[entry_point.name],
+          )
+          continue
+        self._registry[entry_point.name] = entry_point.value
+
+
+def _GetEntryPoints(group: str) -> Iterable[Any]:
+  """Return the entry points in a group, or nothing if unsupported."""
+  try:
+    from importlib import metadata
+  except ImportError:
+    # Python < 3.8.
+    try:
+      import importlib_metadata as metadata
+    except ImportError:
+      return []
+  entry_points = metadata.entry_points()
+  if hasattr(entry_points, "select"):
+    return entry_points.select(group=group)
+  return entry_points.get(group, [])
+
+
+# The mapping from path suffixes to FileFormatter classes. Keys are suffixes,
+# globs, or file names. To look up the formatter for a path, match its name to
+# a key using tools.format.suffix_matcher.SuffixMatcher.
+mapping = LazySuffixMapping(
+  {
+    ".bats": "tools.format.formatters.shell:FormatShell",
+    ".BUILD": "tools.format.formatters.bazel:FormatBuild",
+    ".BUILD.bazel": "tools.format.formatters.bazel:FormatBuild",
+    ".bzl": "tools.format.formatters.python:FormatPython",
+    ".c": "tools.format.formatters.cxx:FormatCxx",
+    ".cc": "tools.format.formatters.cxx:FormatCxx",
+    ".cpp": "tools.format.formatters.cxx:FormatCxx",
+    ".css": "tools.format.formatters.javascript:FormatJavaScript",
+    ".cxx": "tools.format.formatters.cxx:FormatCxx",
+    ".formatignore": "tools.format.formatters.text:FormatText",
+    ".go": "tools.format.formatters.go:FormatGo",
+    ".h": "tools.format.formatters.cxx:FormatCxx",
+    ".hpp": "tools.format.formatters.cxx:FormatCxx",
+    ".html": "tools.format.formatters.javascript:FormatJavaScript",
+    ".ino": "tools.format.formatters.cxx:FormatCxx",
+    ".java": "tools.format.formatters.java:FormatJava",
+    ".js": "tools.format.formatters.javascript:FormatJavaScript",
+    ".json": "tools.format.formatters.json:FormatJson",
+    ".md": "tools.format.formatters.text:FormatText",
+    ".proto": "tools.format.formatters.protobuf:FormatProtobuf",
+    ".py": "tools.format.formatters.python:FormatPython",
+    ".sh": "tools.format.formatters.shell:FormatShell",
+    ".sql": "tools.format.formatters.sql:FormatSql",
+    ".txt": "tools.format.formatters.text:FormatText",
+    "BUILD": "tools.format.formatters.bazel:FormatBuild",
+    "BUILD.bazel": "tools.format.formatters.bazel:FormatBuild",
+    "WORKSPACE": "tools.format.formatters.bazel:FormatBuild",
+    "WORKSPACE.bazel": "tools.format.formatters.bazel:FormatBuild",
+  },
+  entry_point_group=ENTRY_POINT_GROUP,
+)
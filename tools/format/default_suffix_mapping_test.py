@@ -0,0 +1,79 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format:default_suffix_mapping."""
+import collections
+
+from labm8.py import test
+from tools.format import default_suffix_mapping
+from tools.format.formatters.base import base_formatter
+
+FLAGS = test.FLAGS
+
+EntryPoint = collections.namedtuple("EntryPoint", ["name", "value"])
+
+
+def test_mapping_formatters_are_importable():
+  """Test that every registered formatter resolves to a formatter class."""
+  for suffix in default_suffix_mapping.mapping:
+    assert issubclass(
+      default_suffix_mapping.mapping[suffix], base_formatter.BaseFormatter
+    )
+
+
+def test_LazySuffixMapping_contains_does_not_import():
+  mapping = default_suffix_mapping.LazySuffixMapping(
+    {".x": "tools.format.no_such_module:FormatX"}
+  )
+  assert ".x" in mapping
+  assert ".y" not in mapping
+  assert not mapping.import_seconds
+
+
+def test_LazySuffixMapping_getitem_imports_once():
+  mapping = default_suffix_mapping.LazySuffixMapping(
+    {
+      ".txt": "tools.format.formatters.text:FormatText",
+      ".md": "tools.format.formatters.text:FormatText",
+    }
+  )
+  assert mapping[".txt"].__name__ == "FormatText"
+  assert mapping[".md"] is mapping[".txt"]
+  assert list(mapping.import_seconds) == [
+    "tools.format.formatters.text:FormatText"
+  ]
+  with test.Raises(KeyError):
+    mapping[".y"]
+
+
+def test_LazySuffixMapping_entry_points(monkeypatch):
+  monkeypatch.setattr(
+    default_suffix_mapping,
+    "_GetEntryPoints",
+    lambda group: [
+      EntryPoint(".plugin", "tools.format.formatters.text:FormatText"),
+      EntryPoint(".txt", "tools.format.no_such_module:FormatX"),
+    ],
+  )
+  mapping = default_suffix_mapping.LazySuffixMapping(
+    {".txt": "tools.format.formatters.text:FormatText"},
+    entry_point_group="group",
+  )
+  assert mapping[".plugin"].__name__ == "FormatText"
+  # Registered formatters take precedence over entry points.
+  assert mapping[".txt"].__name__ == "FormatText"
+  assert sorted(mapping) == [".plugin", ".txt"]
+
+
+if __name__ == "__main__":
+  test.Main()
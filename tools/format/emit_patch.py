@@ -0,0 +1,351 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module defines the --emit=patch mode, which prints the changes that
+formatting would make as a patch, rather than modifying files.
+
+Files are formatted in memory by worker processes, in chunks which are
+formatted together, and each worker diffs the files that it formats. The patch
+is a unified diff with git headers, and paths relative to the working
+directory, so it can be applied with `git apply` or `patch -p1` from the
+directory that format was run in:
+
+    $ format --emit=patch . > format.patch
+    $ git apply format.patch
+"""
+import collections
+import concurrent.futures
+import difflib
+import multiprocessing
+import os
+import pathlib
+import sys
+import time
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import TextIO
+from typing import Tuple
+
+from labm8.py import app
+from tools.format import app_paths
+from tools.format import format_cache
+from tools.format import format_outcome
+from tools.format import format_paths
+from tools.format import suffix_matcher
+from tools.format.default_suffix_mapping import (
+  mapping as default_suffix_mapping,
+)
+from tools.format.formatters.base import base_formatter
+
+FLAGS = app.FLAGS
+
+# The number of files sent to a worker process at a time.
+_CHUNK_SIZE = 8
+
+# The formatter instances of a worker process, keyed by formatter class name.
+_formatters: Dict[str, base_formatter.BaseFormatter] = {}
+
+
+def EmitPatchOrDie(
+  paths: Iterable[pathlib.Path], out: Optional[TextIO] = None
+) -> List[pathlib.Path]:
+  """Write a patch of the changes that formatting would make to files.
+
+  Files are not modified. The paths of the files which would be modified are
+  printed to stderr, and any formatting errors cause this function to crash
+  the process with an error.
+
+  Args:
+    paths: The paths of the files to format.
+    out: The file to write the patch to. Defaults to stdout.
+
+  Returns:
+    The list of paths which would be modified.
+  """
+  return format_paths.ReportOutcomesOrDie(
+    EmitPatch(paths, out or sys.stdout), file=sys.stderr
+  )
+
+
+def EmitPatch(
+  paths: Iterable[pathlib.Path], out: TextIO
+) -> Iterable[format_outcome.FormatOutcome]:
+  """Write a patch of the changes that formatting would make to files.
+
+  The patches of files are written in the order of the paths.
+
+  Args:
+    paths: The paths of the files to format.
+    out: The file to write the patch to.
+
+  Returns:
+    An iterator over the outcomes of the files which have formatters.
+  """
+  for outcome, patch in _FormatAndDiffPaths(paths):
+    out.write(patch)
+    yield outcome
+    # If a formatter failed to initialize then stop what we're doing.
+    if isinstance(outcome.error, base_formatter.BaseFormatter.InitError):
+      break
+
+
+def _FormatAndDiffPaths(
+  paths: Iterable[pathlib.Path],
+) -> Iterable[Tuple[format_outcome.FormatOutcome, str]]:
+  """Format and diff files in worker processes.
+
+  Files are sent to the workers as they are enumerated, in chunks.
+
+  Args:
+    paths: The paths of the files to format.
+
+  Returns:
+    An iterator over tuples of the outcome and the patch of each file which
+    has a formatter. The results of files which are formatted are returned in
+    the order of the paths.
+  """
+  matcher = suffix_matcher.SuffixMatcher(default_suffix_mapping)
+  cache = format_cache.FormatCache(app_paths.GetCacheDir())
+
+  # Worker processes are spawned rather than forked, and parse the flags of
+  # this process when they start.
+  with cache.Session(), concurrent.futures.ProcessPoolExecutor(
+    max_workers=multiprocessing.cpu_count(),
+    mp_context=multiprocessing.get_context("spawn"),
+    initializer=_InitWorker,
+    initargs=(FLAGS.flags_into_string().splitlines(),),
+  ) as executor:
+    # The chunks submitted to the workers, in order.
+    pending: collections.deque = collections.deque()
+    chunk: List[Tuple[pathlib.Path, str, str]] = []
+    # The mtimes of the submitted files, which are cached if the files are
+    # already formatted.
+    mtimes: Dict[pathlib.Path, int] = {}
+
+    def Results(
+      future: concurrent.futures.Future,
+    ) -> List[Tuple[format_outcome.FormatOutcome, str]]:
+      """Return the results of a chunk, and cache the unchanged files."""
+      results = future.result()
+      for outcome, _ in results:
+        mtime = mtimes.pop(outcome.path, None)
+        if (
+          mtime is not None
+          and outcome.formatter
+          and outcome.status == format_outcome.FormatStatus.UNCHANGED
+        ):
+          cache.SetMtime(outcome.path, mtime)
+      return results
+
+    try:
+      for path in paths:
+        key = matcher.Match(path.name)
+        if key is None:
+          continue
+        # Files which have not changed since they were last formatted have no
+        # changes to emit.
+        if FLAGS.with_cache:
+          try:
+            stat = os.stat(path)
+          except OSError as e:
+            yield (
+              format_outcome.FormatOutcome(
+                path=path, status=format_outcome.FormatStatus.ERROR, error=e
+              ),
+              "",
+            )
+            continue
+          mtime = int(stat.st_mtime * 1e6)
+          if cache.Lookup(path, mtime) == mtime:
+            yield (
+              format_outcome.FormatOutcome(
+                path=path,
+                status=format_outcome.FormatStatus.CACHED,
+                bytes_before=stat.st_size,
+                bytes_after=stat.st_size,
+                cache_hit=True,
+              ),
+              "",
+            )
+            continue
+          mtimes[path] = mtime
+
+        chunk.append((path, key, os.path.relpath(path)))
+        if len(chunk) == _CHUNK_SIZE:
+          pending.append(executor.submit(_FormatAndDiffFiles, chunk))
+          chunk = []
+        # Return the results of the chunks which have completed, in order.
+        while pending and pending[0].done():
+          for result in Results(pending.popleft()):
+            yield result
+
+      if chunk:
+        pending.append(executor.submit(_FormatAndDiffFiles, chunk))
+      while pending:
+        for result in Results(pending.popleft()):
+          yield result
+    finally:
+      # Cancel the remaining chunks if iteration is stopped early.
+      for future in pending:
+        future.cancel()
+
+
+def MakePatch(text: str, formatted_text: str, relpath: str) -> str:
+  """Return the unified diff of the changes to a file, with git headers.
+
+  Args:
+    text: The contents of the file.
+    formatted_text: The new contents of the file.
+    relpath: The path of the file used in the patch headers.
+
+  Returns:
+    The patch of the file, or an empty string if the contents are equal.
+  """
+  if text == formatted_text:
+    return ""
+  lines = [f"diff --git a/{relpath} b/{relpath}\n"]
+  for line in difflib.unified_diff(
+    _SplitLines(text),
+    _SplitLines(formatted_text),
+    f"a/{relpath}",
+    f"b/{relpath}",
+  ):
+    lines.append(line)
+    if not line.endswith("\n"):
+      lines.append("\n\\ No newline at end of file\n")
+  return "".join(lines)
+
+
+def _SplitLines(text: str) -> List[str]:
+  """Split text into lines, keeping line endings.
+
+  Unlike str.splitlines(), only "\\n" ends a line, as it does for diff.
+  """
+  lines = [line + "\n" for line in text.split("\n")]
+  lines[-1] = lines[-1][:-1]
+  if not lines[-1]:
+    lines.pop()
+  return lines
+
+
+def _InitWorker(flags: List[str]) -> None:
+  """Parse the flags of the parent process in a spawned worker process."""
+  FLAGS(["format"] + flags, known_only=True)
+
+
+def _FormatAndDiffFiles(
+  files: List[Tuple[pathlib.Path, str, str]]
+) -> List[Tuple[format_outcome.FormatOutcome, str]]:
+  """Format files in memory, and return their outcomes and patches.
+
+  This is run in a worker process. The files of each formatter are written to
+  a scratch directory and formatted together, so that batched formatters
+  process the chunk in as few runs as they can.
+
+  Args:
+    files: A list of tuples of the absolute path of a file, its suffix mapping
+      key, and its path in the patch.
+
+  Returns:
+    A list of tuples of the outcome and the patch of each file, in order.
+  """
+  results: List[Optional[Tuple[format_outcome.FormatOutcome, str]]] = [
+    None
+  ] * len(files)
+
+  # Group the files by formatter. Files are named in the scratch directory by
+  # their index in the chunk, keeping their original names for formatters
+  # which are sensitive to them.
+  files_by_formatter: Dict[type, Dict[str, Tuple[int, bytes]]] = {}
+  for i, (path, key, _) in enumerate(files):
+    try:
+      data = path.read_bytes()
+    except OSError as e:
+      results[i] = (
+        format_outcome.FormatOutcome(
+          path=path, status=format_outcome.FormatStatus.ERROR, error=e
+        ),
+        "",
+      )
+      continue
+    try:
+      data.decode("utf-8")
+    except UnicodeDecodeError:
+      app.Log(1, "Skipping binary file %s", path)
+      results[i] = (
+        format_outcome.FormatOutcome(
+          path=path,
+          status=format_outcome.FormatStatus.UNCHANGED,
+          bytes_before=len(data),
+          bytes_after=len(data),
+        ),
+        "",
+      )
+      continue
+    files_by_formatter.setdefault(default_suffix_mapping[key], {})[
+      f"{i}/{path.name}"
+    ] = (i, data)
+
+  for formatter_class, contents in files_by_formatter.items():
+    name = formatter_class.__name__
+    start_time = time.time()
+    try:
+      form = _formatters.get(name)
+      if form is None:
+        form = formatter_class(app_paths.GetCacheDir())
+        _formatters[name] = form
+      formatted, errors = form.FormatContents(
+        {scratch_path: data for scratch_path, (_, data) in contents.items()}
+      )
+    except base_formatter.BaseFormatter.InitError as e:
+      formatted, errors = {}, {scratch_path: e for scratch_path in contents}
+    # Apportion the runtime of the formatter between the files.
+    duration = (time.time() - start_time) / len(contents)
+
+    for scratch_path, (i, data) in contents.items():
+      path, _, relpath = files[i]
+      if scratch_path in errors:
+        results[i] = (
+          format_outcome.FormatOutcome(
+            path=path,
+            status=format_outcome.FormatStatus.ERROR,
+            formatter=name,
+            bytes_before=len(data),
+            error=errors[scratch_path],
+          ),
+          "",
+        )
+        continue
+
+      formatted_data = formatted[scratch_path]
+      patch = MakePatch(
+        data.decode("utf-8"), formatted_data.decode("utf-8"), relpath
+      )
+      results[i] = (
+        format_outcome.FormatOutcome(
+          path=path,
+          status=(
+            format_outcome.FormatStatus.MODIFIED
+            if patch
+            else format_outcome.FormatStatus.UNCHANGED
+          ),
+          formatter=name,
+          duration=duration,
+          bytes_before=len(data),
+          bytes_after=len(formatted_data),
+        ),
+        patch,
+      )
+  return results
@@ -0,0 +1,153 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format:emit_patch."""
+import io
+import os
+import pathlib
+import subprocess
+
+from labm8.py import test
+from tools.format import emit_patch
+from tools.format import format_outcome
+
+FLAGS = test.FLAGS
+
+
+@test.Parametrize(
+  "text,formatted_text,patch",
+  (
+    ("a\n", "a\n", ""),
+    (
+      "a  \nb\n",
+      "a\nb\n",
+      "diff --git a/f.txt b/f.txt\n"
+      "--- a/f.txt\n"
+      "+++ b/f.txt\n"
+      "@@ -1,2 +1,2 @@\n"
+      "-a  \n"
+      "+a\n"
+      " b\n",
+    ),
+    # A missing newline at the end of the file is marked.
+    (
+      "a",
+      "a\n",
+      "diff --git a/f.txt b/f.txt\n"
+      "--- a/f.txt\n"
+      "+++ b/f.txt\n"
+      "@@ -1 +1 @@\n"
+      "-a\n"
+      "\\ No newline at end of file\n"
+      "+a\n",
+    ),
+    # Only newlines end lines.
+    (
+      "a\fb \n",
+      "a\fb\n",
+      "diff --git a/f.txt b/f.txt\n"
+      "--- a/f.txt\n"
+      "+++ b/f.txt\n"
+      "@@ -1 +1 @@\n"
+      "-a\fb \n"
+      "+a\fb\n",
+    ),
+  ),
+)
+def test_MakePatch(text: str, formatted_text: str, patch: str):
+  assert emit_patch.MakePatch(text, formatted_text, "f.txt") == patch
+
+
+def test_EmitPatchOrDie(tempdir: pathlib.Path):
+  os.chdir(tempdir)
+  (tempdir / "sub").mkdir()
+  paths = [tempdir / "sub" / f"{i:02d}.txt" for i in range(20)]
+  for i, path in enumerate(paths):
+    # Every other file needs formatting.
+    path.write_text("a  \n" if i % 2 else "a\n")
+  (tempdir / "ignored.unknown").write_text("a  \n")
+
+  out = io.StringIO()
+  modified = emit_patch.EmitPatchOrDie(
+    paths + [tempdir / "ignored.unknown"], out=out
+  )
+
+  assert sorted(modified) == paths[1::2]
+  # Files are not modified.
+  assert all(path.read_text() == "a  \n" for path in paths[1::2])
+  # The patches of files are in the order of the paths.
+  patch = out.getvalue()
+  headers = [line for line in patch.split("\n") if line.startswith("diff")]
+  assert headers == [
+    f"diff --git a/sub/{path.name} b/sub/{path.name}" for path in paths[1::2]
+  ]
+
+  # The patch can be applied to format the files.
+  subprocess.run(["git", "apply"], input=patch.encode("utf-8"), check=True)
+  assert all(path.read_text() == "a\n" for path in paths)
+  assert (tempdir / "ignored.unknown").read_text() == "a  \n"
+
+
+def test_EmitPatchOrDie_files_with_the_same_name(tempdir: pathlib.Path):
+  os.chdir(tempdir)
+  paths = [tempdir / d / "a.txt" for d in ("x", "y", "z")]
+  for i, path in enumerate(paths):
+    path.parent.mkdir()
+    path.write_text(f"{i}  \n")
+
+  out = io.StringIO()
+  assert emit_patch.EmitPatchOrDie(paths, out=out) == paths
+
+  subprocess.run(
+    ["git", "apply"], input=out.getvalue().encode("utf-8"), check=True
+  )
+  assert [path.read_text() for path in paths] == ["0\n", "1\n", "2\n"]
+
+
+def test_EmitPatchOrDie_no_changes(tempdir: pathlib.Path):
+  os.chdir(tempdir)
+  (tempdir / "a.txt").write_text("a\n")
+
+  out = io.StringIO()
+  assert emit_patch.EmitPatchOrDie([tempdir / "a.txt"], out=out) == []
+  assert out.getvalue() == ""
+
+  # The file is cached as formatted, so it is skipped on the next run.
+  outcomes = list(emit_patch.EmitPatch([tempdir / "a.txt"], out=out))
+  assert [o.status for o in outcomes] == [format_outcome.FormatStatus.CACHED]
+
+
+@test.Parametrize("with_cache", (False, True))
+def test_EmitPatch_unreadable_file(tempdir: pathlib.Path, with_cache: bool):
+  os.chdir(tempdir)
+  (tempdir / "a.txt").write_text("a  \n")
+  old_with_cache = FLAGS.with_cache
+  FLAGS.with_cache = with_cache
+  try:
+    out = io.StringIO()
+    outcomes = list(
+      emit_patch.EmitPatch([tempdir / "missing.txt", tempdir / "a.txt"], out)
+    )
+  finally:
+    FLAGS.with_cache = old_with_cache
+
+  assert [o.status for o in outcomes] == [
+    format_outcome.FormatStatus.ERROR,
+    format_outcome.FormatStatus.MODIFIED,
+  ]
+  assert isinstance(outcomes[0].error, FileNotFoundError)
+  assert "diff --git a/a.txt b/a.txt" in out.getvalue()
+
+
+if __name__ == "__main__":
+  test.Main()
@@ -23,10 +23,16 @@ Features:
 
   * Consistent code styling of C/C++, Python, Java, SQL, JavaScript, HTML,
     Protocol Buffers, CSS, go, and JSON files.
-  * A git-aware `--pre_commit` mode which formats changed files and signs off
-    commits. Commites are rejected if a partially-staged file is modified.
+  * A git-aware `--pre_commit` mode which formats the staged contents of
+    changed files and signs off commits.
     Enforce the use of pre-commit mode (and add a "Signed off" footer to
     commits) by running `--install_pre_commit_hook`.
+  * An `--emit=patch` mode which prints the changes that formatting would make
+    as a patch for `git apply`, rather than modifying files.
+  * A `--since=<ref>` mode which formats only the files changed on the
+    current branch, e.g. `format --since=origin/master`.
+  * Sharding of large format runs across processes or machines, using
+    `--shard_workers=<n>`, or `--num_shards` and `--shard_index`.
   * Fast incremental formats of large code bases using a "last modified"
     time stamp cache.
   * Support for `.formatignore` files to mark files to be excluded from
@@ -35,30 +41,39 @@ Features:
     patterns beginning with `!` are un-ignored.
   * Safe execution using inter-process locking to prevent multiple formatters
     modifying files simultaneously.
+  * A `--lsp` mode which runs a Language Server Protocol server on stdin and
+    stdout, so that editors can format their buffers on save.
+  * Formatter subprocesses that hang are killed after `--formatter_timeout`
+    seconds, and the file responsible is reported as an error.
 
 The type of formatting applied to a file is determined by its suffix. See
 format --print_suffixes for a list of suffixes which are formatted.
 
 This program uses a filesystem cache to store various attributes such as a
 database of file modified times. See `format --print_cache_path` to print the
-path of the cache. Included in the cache is a file lock which prevents mulitple
-instances of this program from modifying files at the same time, irrespective
-of the files being formatted.
+path of the cache, `format --cache_stats` to print its size and hit rate, and
+`format --cache_prune` to remove the entries of files that no longer exist. The
+cache database is periodically compacted. Included in the cache is a file lock
+which prevents mulitple instances of this program from modifying files at the
+same time, irrespective of the files being formatted.
 """
 import sys
 
 from labm8.py import app
 from tools.format import app_paths
+from tools.format import format_cache
 from tools.format import format_paths
 from tools.format import path_generator as path_generators
-from tools.format import pre_commit
-
-if sys.platform != "darwin":
-  from tools.format import watch
+from tools.format import sharding
 from tools.format.default_suffix_mapping import (
   mapping as default_suffix_mapping,
 )
 
+# Modules which are only needed by a single mode of the program, and which do
+# not define flags, are imported by that mode rather than here. This program is
+# run by editors and git hooks many times a day, so its startup time matters.
+# Use --profile_startup to measure it.
+
 
 FLAGS = app.FLAGS
 
@@ -71,13 +86,26 @@ app.DEFINE_boolean(
   "Check for, and exclude, git submodules from path expansion. This causes the "
   "formatter to respect git submodule boundaries, so that running format "
   "from within a git repository won't create dirty submodule states. You can "
-  "still visit git submodules by naming them as arguments.",
+  "still visit git submodules by naming them as arguments. Submodules are "
+  "those declared in the .gitmodules file of a repository.",
 )
 app.DEFINE_boolean(
   "print_cache_path",
   False,
   "Print the path of the persistent filesystem cache and exit.",
 )
+app.DEFINE_boolean(
+  "cache_stats",
+  False,
+  "Print statistics about the persistent filesystem cache and exit.",
+)
+app.DEFINE_boolean(
+  "cache_prune",
+  False,
+  "Remove stale entries from the persistent filesystem cache and exit. An "
+  "entry is stale if the file no longer exists, or if it has not been visited "
+  "in --cache_prune_max_age_days days.",
+)
 app.DEFINE_boolean(
   "print_suffixes",
   False,
@@ -89,15 +117,44 @@ app.DEFINE_boolean(
   "Only print the paths of files that will be formatted, without formatting "
   "them.",
 )
+app.DEFINE_string(
+  "emit",
+  "files",
+  "What to do with the formatted files. One of: files, patch. With "
+  "--emit=files, files are formatted in place. With --emit=patch, files are "
+  "not modified. Instead, a patch of the changes that formatting would make is "
+  "written to stdout, which can be applied using `git apply`, and the paths of "
+  "the files that would be modified are printed to stderr.",
+  validator=lambda emit: emit in {"files", "patch"},
+)
 app.DEFINE_boolean(
   "pre_commit",
   False,
-  "Run formatter in pre-commit mode. When in pre-commit mode, all files that "
-  "are staged for commit are formatted. If a formatter modifies a file that "
-  "was staged for commit, the new changes are automatically staged. If a file "
-  "was only partially staged for commit, then this program exits with a "
-  "non-zero returncode, requiring you to review the formatter's changes "
-  "before re-running the commit.",
+  "Run formatter in pre-commit mode. When in pre-commit mode, the staged "
+  "contents of all files that are staged for commit are formatted, and the "
+  "formatted contents are staged. Files which are fully staged are also "
+  "updated in the working tree. The working tree copies of partially staged "
+  "files are not modified, so their unstaged changes are preserved.",
+)
+app.DEFINE_string(
+  "since",
+  None,
+  "Format only the files that have changed since a git ref, e.g. "
+  "--since=origin/master. This formats the files changed since the common "
+  "ancestor of the ref and HEAD, including uncommitted changes, without "
+  "walking the tree.",
+)
+app.DEFINE_boolean(
+  "profile_startup",
+  False,
+  "Run the program with the rest of the given arguments, and print a report "
+  "of the time taken to import its modules.",
+)
+app.DEFINE_boolean(
+  "lsp",
+  False,
+  "Run a Language Server Protocol server on stdin and stdout which implements "
+  "the textDocument/formatting and textDocument/rangeFormatting requests.",
 )
 app.DEFINE_boolean(
   "install_pre_commit_hook",
@@ -109,15 +166,42 @@ app.DEFINE_boolean(
 
 def Main(argv):
   """Main entry point."""
-  if FLAGS.print_cache_path:
+  if FLAGS.profile_startup:
+    from tools.format import startup_profile
+
+    profile = startup_profile.ProfileStartup(sys.argv)
+    profile.PrintReport()
+    sys.exit(profile.returncode)
+  elif FLAGS.print_cache_path:
     print(app_paths.GetCacheDir())
     return
+  elif FLAGS.cache_stats:
+    format_cache.FormatCache(app_paths.GetCacheDir()).PrintStats()
+    return
+  elif FLAGS.cache_prune:
+    from labm8.py import humanize
+
+    cache = format_cache.FormatCache(app_paths.GetCacheDir())
+    file_count, directory_count = cache.Prune(FLAGS.cache_prune_max_age_days)
+    print(
+      f"Pruned {humanize.Plural(file_count, 'file')} and "
+      f"{humanize.Plural(directory_count, 'directory', 'directories')} "
+      "from the cache"
+    )
+    return
   elif FLAGS.print_suffixes:
     print("\n".join(sorted(default_suffix_mapping.keys())))
     return
   elif FLAGS.install_pre_commit_hook:
+    from tools.format import pre_commit
+
     pre_commit.InstallPreCommitHookOrDie()
     return
+  elif FLAGS.merge_shard_manifests:
+    format_paths.ReportOutcomesOrDie(
+      sharding.MergeManifestsOrDie(FLAGS.merge_shard_manifests)
+    )
+    return
 
   args = argv[1:]
 
@@ -125,24 +209,74 @@ def Main(argv):
   if FLAGS.pre_commit:
     if args:
       raise app.UsageError("--pre_commit takes no arguments")
+    from tools.format import pre_commit
+
     pre_commit.Main()
     return
 
+  # Run the language server.
+  if FLAGS.lsp:
+    if args:
+      raise app.UsageError("--lsp takes no arguments")
+    from tools.format import lsp_server
+
+    sys.exit(lsp_server.Main())
+
   # Start the inotify watcher.
   if FLAGS.watch:
     if sys.platform == "darwin":
       app.FatalWithoutStackTrace("--watch is not supported on macOS")
+    from tools.format import watch
+
     watch.Main(args)
     return
 
-  if not args:
-    raise app.UsageError("No paths were provided to format.")
+  if FLAGS.shard_index >= FLAGS.num_shards:
+    raise app.UsageError("--shard_index must be less than --num_shards")
+
+  if FLAGS.emit == "patch" and (
+    FLAGS.shard_workers or FLAGS.num_shards > 1 or FLAGS.shard_manifest
+  ):
+    raise app.UsageError("--emit=patch does not support sharding")
+
+  # Run the shards of the format in worker processes. The workers enumerate
+  # and filter the paths themselves.
+  if FLAGS.shard_workers:
+    if not args and not FLAGS.since:
+      raise app.UsageError("No paths were provided to format.")
+    sharding.RunShardWorkersOrDie(sys.argv, FLAGS.shard_workers)
+    return
 
   path_generator = path_generators.PathGenerator(
     ".formatignore", skip_git_submodules=FLAGS.skip_git_submodules
   )
-  paths = path_generator.GeneratePaths(args)
-  format_paths.FormatPathsOrDie(paths, dry_run=FLAGS.dry_run)
+
+  # Format the files changed since a git ref.
+  if FLAGS.since:
+    if args:
+      raise app.UsageError("--since takes no arguments")
+    from tools.format import git_util
+
+    paths = git_util.GetChangedPathsSinceOrDie(FLAGS.since, path_generator)
+  elif args:
+    paths = path_generator.GeneratePaths(args)
+  else:
+    raise app.UsageError("No paths were provided to format.")
+
+  if FLAGS.emit == "patch":
+    from tools.format import emit_patch
+
+    emit_patch.EmitPatchOrDie(paths)
+  elif FLAGS.num_shards > 1 or FLAGS.shard_manifest:
+    sharding.FormatShardOrDie(
+      paths,
+      FLAGS.shard_index,
+      FLAGS.num_shards,
+      manifest_path=FLAGS.shard_manifest,
+      dry_run=FLAGS.dry_run,
+    )
+  else:
+    format_paths.FormatPathsOrDie(paths, dry_run=FLAGS.dry_run)
 
 
 if __name__ == "__main__":
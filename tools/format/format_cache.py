@@ -0,0 +1,404 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module defines the persistent cache of file modified times."""
+import contextlib
+import datetime
+import os
+import pathlib
+import random
+import time
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from labm8.py import app
+from tools.format import cache_store
+
+FLAGS = app.FLAGS
+
+app.DEFINE_integer(
+  "cache_prune_max_age_days",
+  90,
+  "When pruning the cache with --cache_prune, remove the entries for files "
+  "that have not been visited by the formatter in this many days.",
+)
+app.DEFINE_integer(
+  "cache_vacuum_interval_days",
+  7,
+  "The number of days between automatic compactions of the cache store.",
+)
+
+app.DEFINE_string(
+  "cache_store",
+  "sqlite",
+  "The storage backend of the cache. One of: "
+  f"{', '.join(sorted(cache_store.STORES))}.",
+  validator=lambda name: name in cache_store.STORES,
+)
+app.DEFINE_float(
+  "cache_flush_interval",
+  5,
+  "The maximum number of seconds that cache updates are buffered for before "
+  "they are written to the cache.",
+)
+app.DEFINE_float(
+  "cache_lock_timeout",
+  10,
+  "The number of seconds to wait for a cache lock held by another format "
+  "process. If the lock cannot be acquired, cache updates are deferred, and "
+  "discarded at the end of the run.",
+)
+
+# The number of seconds in a day. Last-seen timestamps are recorded with day
+# granularity so that repeated runs on the same day do not rewrite rows.
+_SECONDS_IN_DAY = 24 * 60 * 60
+
+# The number of attempts to make for a write to a busy cache store, and the
+# maximum delay in seconds before the first retry, which doubles after each
+# attempt. The delay is randomized so that waiting processes do not retry in
+# lockstep.
+_WRITE_ATTEMPTS = 3
+_RETRY_DELAY = 0.1
+
+# The maximum number of visited paths to buffer before their last-seen times
+# are written to the store, regardless of the flush interval.
+_MAX_SEEN_PATHS = 10000
+
+
+class FormatCache(object):
+  """A persistent cache of the modified times of formatted files.
+
+  The cache maps file paths to the mtime that they had when they were last
+  formatted. The cache is stored in a cache_store.CacheStore, selected by the
+  --cache_store flag.
+
+  Cache lookups and updates must be made within a Session():
+
+      cache = FormatCache(cache_dir)
+      with cache.Session():
+        cached_mtime = cache.Lookup(path, mtime)
+        ...
+        cache.SetMtime(path, new_mtime)
+
+  Many format processes may share a cache. Lookups do not hold a lock on the
+  cache store, and updates are buffered and written to the store in short
+  batched transactions, every --cache_flush_interval seconds and at the end of
+  the session. If the store is locked by another process, the write is retried
+  and then deferred to the next flush, so that the formatter never waits on a
+  contended cache for long.
+
+  At the end of a session, the hit rate of the session is recorded so that it
+  can be reported by PrintStats(), and the "last seen" times of visited files
+  are updated, which is used by Prune() to evict stale entries.
+  """
+
+  def __init__(self, cache_dir: pathlib.Path, store: Optional[str] = None):
+    """Constructor.
+
+    Args:
+      cache_dir: The directory containing the cache files.
+      store: The name of the cache store to use. Defaults to --cache_store.
+    """
+    self.store = cache_store.STORES[store or FLAGS.cache_store](
+      cache_dir, timeout=FLAGS.cache_lock_timeout
+    )
+    self.path = self.store.path
+
+    # Whether a session is active.
+    self._in_session = False
+    # The mtimes of files set in the active session, which have not yet been
+    # written to the store.
+    self._pending: Dict[str, int] = {}
+    # The paths of files visited in the active session, whose last-seen times
+    # have not yet been written to the store.
+    self._seen: Set[str] = set()
+    # The time of the last write of buffered updates.
+    self._last_flush_time = 0
+    # Counters for the active session.
+    self.lookup_count = 0
+    self.hit_count = 0
+
+  @contextlib.contextmanager
+  def Session(self) -> "FormatCache":
+    """Begin a session of cache lookups and updates.
+
+    The buffered updates of the session are written to the store on exit.
+    """
+    if self._in_session:
+      raise TypeError("Cache session is already active")
+
+    self._in_session = True
+    self._pending = {}
+    self._seen = set()
+    self._last_flush_time = time.time()
+    self.lookup_count = 0
+    self.hit_count = 0
+    try:
+      yield self
+      self._EndSession()
+    finally:
+      self._in_session = False
+
+  def _EndSession(self) -> None:
+    """Write the buffered updates and the session statistics."""
+    try:
+      self._Retry(self._Write)
+    except cache_store.CacheStore.BusyError as e:
+      app.Warning(
+        "%s. Discarding %d cache updates",
+        e,
+        len(self._pending) + len(self._seen),
+      )
+    self._pending, self._seen = {}, set()
+
+  def Flush(self) -> bool:
+    """Write the buffered updates of the session to the store.
+
+    Returns:
+      True if the updates were written, or False if the store is busy, in
+      which case the updates remain buffered.
+    """
+    self._last_flush_time = time.time()
+    if not self._pending and not self._seen:
+      return True
+    try:
+      self._Retry(self._Write)
+    except cache_store.CacheStore.BusyError as e:
+      app.Log(1, "%s. Deferring cache updates", e)
+      return False
+    self._pending, self._seen = {}, set()
+    return True
+
+  def _MaybeFlush(self) -> None:
+    """Write the buffered updates if the flush interval has elapsed, or if
+    too many visited paths are buffered."""
+    if len(self._seen) >= _MAX_SEEN_PATHS:
+      if not self.Flush():
+        # Last-seen times are only used to evict stale entries, so they are
+        # discarded rather than buffered without bound while the store is busy.
+        app.Log(1, "Discarding %d last-seen updates", len(self._seen))
+        self._seen = set()
+    elif time.time() - self._last_flush_time >= FLAGS.cache_flush_interval:
+      self.Flush()
+
+  def _Write(self) -> None:
+    """Write the buffered updates to the store in a single transaction."""
+    today = self.Today()
+    with self.store.Transaction():
+      if self._pending:
+        self.store.PutMany(
+          (path, mtime, today) for path, mtime in self._pending.items()
+        )
+      if self._seen:
+        self.store.TouchMany(self._seen, today)
+      if self.lookup_count:
+        self.store.SetMeta("last_run_timestamp", int(time.time()))
+        self.store.SetMeta("last_run_lookup_count", self.lookup_count)
+        self.store.SetMeta("last_run_hit_count", self.hit_count)
+
+  @staticmethod
+  def _Retry(write: Callable[[], None]) -> None:
+    """Call a write function, retrying if the store is busy.
+
+    Raises:
+      BusyError: If the store is still busy after the final attempt.
+    """
+    for attempt in range(_WRITE_ATTEMPTS):
+      try:
+        return write()
+      except cache_store.CacheStore.BusyError:
+        if attempt + 1 == _WRITE_ATTEMPTS:
+          raise
+        time.sleep(random.uniform(0, _RETRY_DELAY * 2 ** attempt))
+
+  def Lookup(self, path: pathlib.Path, mtime: int) -> Optional[int]:
+    """Lookup the cached mtime of a file.
+
+    Args:
+      path: The absolute path of a file.
+      mtime: The current mtime of the file. If this is equal to the cached
+        mtime, the lookup is recorded as a cache hit.
+
+    Returns:
+      The mtime of the file when it was last formatted, or None if the file is
+      not in the cache.
+    """
+    self.lookup_count += 1
+    path = str(path)
+    cached_mtime = self._pending.get(path)
+    if cached_mtime is None:
+      cached_mtime = self.store.Get(path)
+    if cached_mtime is None:
+      return None
+
+    self._seen.add(path)
+    if cached_mtime == mtime:
+      self.hit_count += 1
+    self._MaybeFlush()
+    return cached_mtime
+
+  def SetMtime(self, path: pathlib.Path, mtime: int) -> None:
+    """Record the mtime of a formatted file.
+
+    Args:
+      path: The absolute path of a file.
+      mtime: The mtime of the file after formatting.
+    """
+    self._pending[str(path)] = mtime
+    self._MaybeFlush()
+
+  def GetTimings(self) -> Dict[str, List[float]]:
+    """Read the historical formatter timings.
+
+    Returns:
+      A mapping from formatter name to the regression sums of its timings. See
+      tools.format.scheduler.CostModel for details.
+    """
+    return self.store.GetTimings()
+
+  def SetTimings(self, timings: Dict[str, List[float]]) -> None:
+    """Record the historical formatter timings.
+
+    Args:
+      timings: A mapping from formatter name to the regression sums of its
+        timings.
+    """
+    if not timings:
+      return
+    try:
+      self._Retry(lambda: self.store.SetTimings(timings))
+    except cache_store.CacheStore.BusyError as e:
+      app.Log(1, "%s. Discarding formatter timings", e)
+
+  def GetMeta(self, key: str, default: Optional[int] = None) -> Optional[int]:
+    """Read a value from the metadata table."""
+    value = self.store.GetMeta(key)
+    return default if value is None else value
+
+  def SetMeta(self, key: str, value: int) -> None:
+    """Write a value to the metadata table."""
+    self.store.SetMeta(key, value)
+
+  def Prune(self, max_age_days: int) -> Tuple[int, int]:
+    """Remove stale entries from the cache and compact the store.
+
+    An entry is stale if the file no longer exists, or if the file has not
+    been visited by the formatter in the given number of days.
+
+    Args:
+      max_age_days: The maximum number of days since an entry was last seen.
+
+    Returns:
+      A tuple of the number of file entries and directory entries removed.
+    """
+    oldest_allowed = self.Today() - max_age_days * _SECONDS_IN_DAY
+    with self.store.Transaction():
+      items = list(self.store.Items())
+    # Files are tested for existence outside of the transaction, so that other
+    # processes are not blocked on the filesystem.
+    stale = {
+      path: (mtime, last_seen)
+      for path, mtime, last_seen in items
+      if last_seen < oldest_allowed or not os.path.isfile(path)
+    }
+    with self.store.Transaction():
+      # Entries which were updated by another process since they were read
+      # are not stale, so only entries which are unchanged are deleted.
+      to_delete = [
+        path
+        for path, mtime, last_seen in self.store.Items()
+        if stale.get(path) == (mtime, last_seen)
+      ]
+      directory_count = self.store.GetDirectoryCount()
+      self.store.DeleteMany(to_delete)
+      deleted_directory_count = (
+        directory_count - self.store.GetDirectoryCount()
+      )
+
+    self.Vacuum()
+    return len(to_delete), deleted_directory_count
+
+  def Vacuum(self) -> None:
+    """Compact the cache store."""
+    app.Log(2, "Compacting cache store %s", self.path)
+    self.store.Compact()
+    self.SetMeta("last_vacuum_timestamp", int(time.time()))
+
+  def MaybeVacuum(self) -> None:
+    """Compact the cache store if it hasn't been compacted recently.
+
+    If the store is in use by another process, compaction is skipped.
+    """
+    try:
+      last_vacuum = self.GetMeta("last_vacuum_timestamp")
+      if last_vacuum is None:
+        # Don't compact a freshly created cache, just start the clock.
+        self.SetMeta("last_vacuum_timestamp", int(time.time()))
+      elif (
+        time.time() - last_vacuum
+        > FLAGS.cache_vacuum_interval_days * _SECONDS_IN_DAY
+      ):
+        self.Vacuum()
+    except cache_store.CacheStore.BusyError as e:
+      app.Log(1, "%s. Skipping compaction", e)
+
+  def GetStats(self) -> Dict[str, Optional[int]]:
+    """Return a dictionary of cache statistics."""
+    return {
+      "size_in_bytes": self.store.size_in_bytes,
+      "file_count": len(self.store),
+      "directory_count": self.store.GetDirectoryCount(),
+      "last_run_timestamp": self.GetMeta("last_run_timestamp"),
+      "last_run_lookup_count": self.GetMeta("last_run_lookup_count", 0),
+      "last_run_hit_count": self.GetMeta("last_run_hit_count", 0),
+      "last_vacuum_timestamp": self.GetMeta("last_vacuum_timestamp"),
+    }
+
+  def PrintStats(self) -> None:
+    """Print a human-readable summary of the cache statistics."""
+    from labm8.py import humanize
+
+    stats = self.GetStats()
+    print("Cache path:", self.path)
+    print("Cache size:", humanize.BinaryPrefix(stats["size_in_bytes"], "B"))
+    print("Cached files:", humanize.Commas(stats["file_count"]))
+    print("Cached directories:", humanize.Commas(stats["directory_count"]))
+    if stats["last_run_timestamp"]:
+      lookup_count = stats["last_run_lookup_count"]
+      hit_count = stats["last_run_hit_count"]
+      print("Last run:", _FormatTimestamp(stats["last_run_timestamp"]))
+      print(
+        "Last run hit rate:",
+        f"{hit_count / max(lookup_count, 1):.1%}",
+        f"({humanize.Commas(hit_count)} of",
+        f"{humanize.Commas(lookup_count)} lookups)",
+      )
+    if stats["last_vacuum_timestamp"]:
+      print(
+        "Last compacted:", _FormatTimestamp(stats["last_vacuum_timestamp"])
+      )
+
+  @staticmethod
+  def Today() -> int:
+    """Return the timestamp of the start of the current day."""
+    now = int(time.time())
+    return now - now % _SECONDS_IN_DAY
+
+
+def _FormatTimestamp(timestamp: int) -> str:
+  """Format a unix timestamp as a human-readable date."""
+  return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M")
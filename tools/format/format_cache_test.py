@@ -0,0 +1,287 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format:format_cache."""
+import pathlib
+import sqlite3
+import subprocess
+import sys
+
+from labm8.py import test
+from tools.format import cache_store
+from tools.format import format_cache
+
+FLAGS = test.FLAGS
+
+
+@test.Fixture(scope="function", params=sorted(cache_store.STORES))
+def store(request) -> str:
+  return request.param
+
+
+@test.Fixture(scope="function")
+def cache(store: str, tempdir: pathlib.Path) -> format_cache.FormatCache:
+  return format_cache.FormatCache(tempdir, store=store)
+
+
+def test_Lookup_empty_cache(
+  cache: format_cache.FormatCache, tempdir2: pathlib.Path
+):
+  with cache.Session():
+    assert cache.Lookup(tempdir2 / "a", 1) is None
+  assert cache.lookup_count == 1
+  assert cache.hit_count == 0
+
+
+def test_SetMtime_Lookup_hit(
+  cache: format_cache.FormatCache, tempdir2: pathlib.Path
+):
+  with cache.Session():
+    cache.SetMtime(tempdir2 / "a", 1)
+  with cache.Session():
+    assert cache.Lookup(tempdir2 / "a", 1) == 1
+  assert cache.hit_count == 1
+
+
+def test_SetMtime_Lookup_miss(
+  cache: format_cache.FormatCache, tempdir2: pathlib.Path
+):
+  with cache.Session():
+    cache.SetMtime(tempdir2 / "a", 1)
+  with cache.Session():
+    assert cache.Lookup(tempdir2 / "a", 2) == 1
+  assert cache.hit_count == 0
+
+
+def test_SetMtime_directories_are_interned(
+  cache: format_cache.FormatCache, tempdir2: pathlib.Path
+):
+  with cache.Session():
+    cache.SetMtime(tempdir2 / "a", 1)
+    cache.SetMtime(tempdir2 / "b", 1)
+    cache.SetMtime(tempdir2 / "c" / "d", 1)
+  stats = cache.GetStats()
+  assert stats["file_count"] == 3
+  assert stats["directory_count"] == 2
+
+
+def test_GetStats_last_run_hit_rate(
+  cache: format_cache.FormatCache, tempdir2: pathlib.Path
+):
+  with cache.Session():
+    cache.SetMtime(tempdir2 / "a", 1)
+  with cache.Session():
+    cache.Lookup(tempdir2 / "a", 1)
+    cache.Lookup(tempdir2 / "b", 1)
+  stats = cache.GetStats()
+  assert stats["last_run_lookup_count"] == 2
+  assert stats["last_run_hit_count"] == 1
+
+
+def test_Prune_removes_missing_files(
+  cache: format_cache.FormatCache, tempdir2: pathlib.Path
+):
+  (tempdir2 / "a").touch()
+  with cache.Session():
+    cache.SetMtime(tempdir2 / "a", 1)
+    cache.SetMtime(tempdir2 / "b", 1)
+    cache.SetMtime(tempdir2 / "c" / "d", 1)
+
+  assert cache.Prune(max_age_days=1) == (2, 1)
+
+  with cache.Session():
+    assert cache.Lookup(tempdir2 / "a", 1) == 1
+    assert cache.Lookup(tempdir2 / "b", 1) is None
+
+
+def test_Prune_removes_stale_files(
+  cache: format_cache.FormatCache, tempdir2: pathlib.Path
+):
+  (tempdir2 / "a").touch()
+  with cache.Session():
+    cache.SetMtime(tempdir2 / "a", 1)
+
+  assert cache.Prune(max_age_days=-1) == (1, 1)
+
+
+def test_Prune_keeps_files_updated_concurrently(
+  monkeypatch,
+  store: str,
+  cache: format_cache.FormatCache,
+  tempdir: pathlib.Path,
+  tempdir2: pathlib.Path,
+):
+  with cache.Session():
+    cache.SetMtime(tempdir2 / "a", 1)
+
+  # Another process formats the file while it is being tested for existence.
+  def IsFile(path: str) -> bool:
+    (tempdir2 / "a").touch()
+    other_cache = format_cache.FormatCache(tempdir, store=store)
+    with other_cache.Session():
+      other_cache.SetMtime(tempdir2 / "a", 2)
+    return False
+
+  monkeypatch.setattr(format_cache.os.path, "isfile", IsFile)
+  assert cache.Prune(max_age_days=1) == (0, 0)
+  assert cache.store.Get(str(tempdir2 / "a")) == 2
+
+
+def test_SetMtime_Lookup_same_session(
+  cache: format_cache.FormatCache, tempdir2: pathlib.Path
+):
+  with cache.Session():
+    cache.SetMtime(tempdir2 / "a", 1)
+    assert cache.Lookup(tempdir2 / "a", 1) == 1
+
+
+def test_GetTimings_SetTimings(cache: format_cache.FormatCache):
+  cache.SetTimings({"black": [1, 2, 3, 4, 5]})
+  assert cache.GetTimings() == {"black": [1, 2, 3, 4, 5]}
+
+
+@test.Fixture(scope="function")
+def short_lock_timeout():
+  """Set a short cache lock timeout for the duration of a test."""
+  old_timeout = FLAGS.cache_lock_timeout
+  FLAGS.cache_lock_timeout = 0.1
+  yield
+  FLAGS.cache_lock_timeout = old_timeout
+
+
+@test.Fixture(scope="function")
+def locked_cache(short_lock_timeout, tempdir: pathlib.Path):
+  """Return an sqlite cache which is locked by another connection, and a
+  function which releases the lock."""
+  cache = format_cache.FormatCache(tempdir, store="sqlite")
+  db = sqlite3.connect(str(cache.path), isolation_level=None)
+  db.execute("BEGIN IMMEDIATE")
+  yield cache, lambda: db.execute("ROLLBACK")
+  db.close()
+
+
+def test_concurrent_sessions(
+  store: str,
+  cache: format_cache.FormatCache,
+  tempdir: pathlib.Path,
+  tempdir2: pathlib.Path,
+):
+  """Test that overlapping sessions by two caches do not block each other."""
+  other_cache = format_cache.FormatCache(tempdir, store=store)
+  with cache.Session():
+    cache.SetMtime(tempdir2 / "a", 1)
+    with other_cache.Session():
+      other_cache.SetMtime(tempdir2 / "b", 2)
+    cache.SetMtime(tempdir2 / "c", 3)
+
+  with cache.Session():
+    assert cache.Lookup(tempdir2 / "a", 1) == 1
+    assert cache.Lookup(tempdir2 / "b", 2) == 2
+    assert cache.Lookup(tempdir2 / "c", 3) == 3
+
+
+def test_Flush_writes_buffered_updates(
+  store: str,
+  cache: format_cache.FormatCache,
+  tempdir: pathlib.Path,
+  tempdir2: pathlib.Path,
+):
+  other_cache = format_cache.FormatCache(tempdir, store=store)
+  with cache.Session():
+    cache.SetMtime(tempdir2 / "a", 1)
+    with other_cache.Session():
+      assert other_cache.Lookup(tempdir2 / "a", 1) is None
+    assert cache.Flush()
+    with other_cache.Session():
+      assert other_cache.Lookup(tempdir2 / "a", 1) == 1
+
+
+def test_SetMtime_flush_interval(
+  cache: format_cache.FormatCache, tempdir2: pathlib.Path
+):
+  old_interval = FLAGS.cache_flush_interval
+  FLAGS.cache_flush_interval = 0
+  try:
+    with cache.Session():
+      cache.SetMtime(tempdir2 / "a", 1)
+      assert cache.store.Get(str(tempdir2 / "a")) == 1
+  finally:
+    FLAGS.cache_flush_interval = old_interval
+
+
+def test_Lookup_flushes_many_seen_paths(
+  monkeypatch, cache: format_cache.FormatCache, tempdir2: pathlib.Path
+):
+  with cache.Session():
+    cache.SetMtime(tempdir2 / "a", 1)
+    cache.SetMtime(tempdir2 / "b", 1)
+
+  monkeypatch.setattr(format_cache, "_MAX_SEEN_PATHS", 2)
+  with cache.Session():
+    cache.Lookup(tempdir2 / "a", 1)
+    cache.Lookup(tempdir2 / "a", 1)
+    assert len(cache._seen) == 1
+    cache.Lookup(tempdir2 / "b", 1)
+    assert not cache._seen
+
+
+def test_Flush_busy_store(locked_cache, tempdir2: pathlib.Path):
+  cache, unlock = locked_cache
+  with cache.Session():
+    cache.SetMtime(tempdir2 / "a", 1)
+    # The update is deferred while the store is locked.
+    assert not cache.Flush()
+    assert cache.Lookup(tempdir2 / "a", 1) == 1
+    unlock()
+    assert cache.Flush()
+  assert cache.store.Get(str(tempdir2 / "a")) == 1
+
+
+def test_Session_busy_store_discards_updates(
+  locked_cache, tempdir2: pathlib.Path
+):
+  cache, unlock = locked_cache
+  with cache.Session():
+    cache.SetMtime(tempdir2 / "a", 1)
+  unlock()
+  assert cache.store.Get(str(tempdir2 / "a")) is None
+
+
+def test_MmapStore_busy_store(short_lock_timeout, tempdir: pathlib.Path):
+  cache = format_cache.FormatCache(tempdir, store="mmap")
+  # Hold the lock of the store in another process.
+  process = subprocess.Popen(
+    [
+      sys.executable,
+      "-c",
+      "import fcntl, sys, time; "
+      "f = open(sys.argv[1], 'a'); "
+      "fcntl.lockf(f, fcntl.LOCK_EX); "
+      "print(flush=True); "
+      "time.sleep(60)",
+      str(cache.path.with_suffix(".lock")),
+    ],
+    stdout=subprocess.PIPE,
+  )
+  try:
+    process.stdout.readline()
+    with cache.Session():
+      cache.SetMtime(tempdir / "a", 1)
+      assert not cache.Flush()
+  finally:
+    process.kill()
+    process.wait()
+
+
+if __name__ == "__main__":
+  test.Main()
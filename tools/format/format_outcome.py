@@ -0,0 +1,66 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module defines the outcomes of formatting files."""
+import enum
+import pathlib
+from typing import NamedTuple
+from typing import Optional
+
+
+class FormatStatus(enum.Enum):
+  """The status of a formatted file."""
+
+  # The formatter modified the file.
+  MODIFIED = "modified"
+  # The formatter ran but did not modify the file.
+  UNCHANGED = "unchanged"
+  # The file was not modified since it was last formatted, so the formatter was
+  # not run.
+  CACHED = "cached"
+  # The file would be formatted, but formatting was skipped by --dry_run.
+  DRY_RUN = "dry_run"
+  # An error was encountered.
+  ERROR = "error"
+
+
+class FormatOutcome(NamedTuple):
+  """The outcome of formatting a single file.
+
+  An error outcome may not be tied to a path, for example if a formatter fails
+  to initialize, or if a batched formatter fails in such a way that the error
+  cannot be attributed to a single file.
+  """
+
+  # The absolute path of the file.
+  path: Optional[pathlib.Path]
+  status: FormatStatus
+  # The name of the formatter class, or None if no formatter ran.
+  formatter: Optional[str] = None
+  # The wall time spent formatting the file, in seconds. When a formatter
+  # processes multiple files in a single batch, the runtime of the batch is
+  # apportioned between the files in proportion to their size.
+  duration: float = 0
+  # The size of the file before and after formatting, in bytes.
+  bytes_before: Optional[int] = None
+  bytes_after: Optional[int] = None
+  # Whether the file was found in the mtime cache. A file may be in the cache
+  # and still be formatted if it has been modified since it was cached.
+  cache_hit: bool = False
+  # The error raised by the formatter, if status is ERROR.
+  error: Optional[Exception] = None
+
+  @property
+  def modified(self) -> bool:
+    """Return whether the file was, or in --dry_run mode would be, modified."""
+    return self.status in {FormatStatus.MODIFIED, FormatStatus.DRY_RUN}
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """This module defines the Format class for formatting files."""
+import collections
 import concurrent.futures
 import multiprocessing
 import os
@@ -19,17 +20,27 @@ import pathlib
 import queue
 import sys
 import threading
+import time
+from typing import Callable
 from typing import Dict
 from typing import Iterable
 from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from typing import TextIO
+from typing import Tuple
 from typing import Union
 
-import sqlalchemy as sql
 from labm8.py import app
 from labm8.py import ppar
 from labm8.py import shell
-from labm8.py import sqlutil
 from tools.format import app_paths
+from tools.format import format_cache
+from tools.format import format_outcome
+from tools.format import git_index
+from tools.format import scheduler
+from tools.format import suffix_matcher
 from tools.format.default_suffix_mapping import (
   mapping as default_suffix_mapping,
 )
@@ -46,6 +57,26 @@ app.DEFINE_boolean(
   "skipped. Running the formatter with --nowith_cache forces all files to be "
   "formatted, even if they have not changed.",
 )
+app.DEFINE_integer(
+  "git_index_stat_threshold",
+  1000,
+  "Once this many files have been visited, read the mtimes of the remaining "
+  "files from the git index, rather than stat()-ing each file. Only files "
+  "which git reports as clean are read from the index. Set to 0 to always "
+  "stat() files.",
+  lower_bound=0,
+)
+
+
+class _PendingPath(NamedTuple):
+  """A path which has been passed to a formatter."""
+
+  path: pathlib.Path
+  # The mtime and size of the file before formatting.
+  mtime: int
+  size: int
+  # The cached mtime of the file, if any.
+  cached_mtime: Optional[int]
 
 
 class FormatPaths(object):
@@ -61,10 +92,25 @@ class FormatPaths(object):
 
   This object then manages the execution of formatter actions, overlapping their
   asynchronous execution through thread-level parallelism, and caches the mtime
-  of visited files.
-
-  An instance of this formatter can be iterated over to receive a stream of
-  formatting outcomes. A formatting outcome is either a pathlib.Path of a
+  of visited files. Actions are executed in order of their expected cost, which
+  is estimated from the historical timings of each formatter. See
+  tools/format/scheduler.py.
+
+  The Outcomes() method returns a stream of FormatOutcome tuples, one for every
+  file visited, which describe the formatter that was run, its result, and how
+  long it took. Outcomes are returned as soon as they are known: files which are
+  skipped because they are unchanged since they were last formatted are
+  returned immediately, and the files processed by a formatter action are
+  returned as soon as that action completes. Example usage:
+
+      for outcome in FormatPaths(paths_to_format).Outcomes():
+        if outcome.status == format_outcome.FormatStatus.ERROR:
+          print("ERROR:", outcome.error)
+        elif outcome.status == format_outcome.FormatStatus.MODIFIED:
+          print("Modified file:", outcome.path, "in", outcome.duration, "s")
+
+  Alternatively, an instance of this formatter can be iterated over to receive a
+  simpler stream of outcomes. Each outcome is either a pathlib.Path of a
   modified file, or the Exception instance of an error that was encountered.
   Files that are visited but not modified are not returned by this iterator.
   Example usage:
@@ -75,8 +121,9 @@ class FormatPaths(object):
         else:
           print("Modified file:", outcome)
 
-  If you don't want to iterate over the results, you can instead use the Join()
-  method to block until all formatting actions have completed:
+  Outcomes can only be consumed once, so use either Outcomes() or the iterator,
+  not both. If you don't want to iterate over the results, you can instead use
+  the Join() method to block until all formatting actions have completed:
 
     formatter = FormatPaths(paths_to_format)
     formatter.Join()
@@ -89,15 +136,18 @@ class FormatPaths(object):
     suffix_mapping: Dict[
       str, base_formatter.BaseFormatter
     ] = default_suffix_mapping,
+    start: bool = True,
   ):
     """Constructor.
 
     Args:
       dry_run: Yield only the paths that would be formatted, without running the
         formatters themselves.
+      start: Start formatting immediately. If False, Start() must be called.
     """
     self.dry_run = dry_run
     self.suffix_mapping = suffix_mapping
+    self.suffix_matcher = suffix_matcher.SuffixMatcher(suffix_mapping)
 
     # A lazily-instantiated mapping from formatter class name to formatter
     # instance. Each key is the __name__ of a class from the
@@ -107,98 +157,135 @@ class FormatPaths(object):
     # single formatter of each type is instantiated.
     self.formatter_instances = {}
 
-    self.cache_path = app_paths.GetCacheDir()
+    # A mapping from formatter class name to the list of paths that have been
+    # passed to the formatter but not yet scheduled.
+    self._pending_paths: Dict[
+      str, List[_PendingPath]
+    ] = collections.defaultdict(list)
 
-    # A queue of elements to return from the iterator.
+    self.cache_path = app_paths.GetCacheDir()
+    self.cache = format_cache.FormatCache(self.cache_path)
+
+    # A map from path to the mtime and size of clean files, read from the git
+    # index, and the directories whose files have been read from the index.
+    self._index_stats: Dict[str, Tuple[int, int]] = {}
+    self._index_directories: Set[str] = set()
+    # The number of visited paths which were not found in the index stats, and
+    # their deepest common directory. See GetMtimeAndSize().
+    self._unindexed_count = 0
+    self._unindexed_directory: Optional[str] = None
+
+    # A queue of outcomes to return from the iterator.
     self._queue = queue.Queue()
+    # A queue of <path, mtime> tuples produced by formatter actions, which
+    # are written to the cache by the thread which owns the cache session.
+    self._cache_updates = queue.Queue()
 
-    # Create a threaded iterator to filter the list of incoming paths.
-    paths = ppar.ThreadedIterator(
-      PathsWithFormatters(paths, self.suffix_mapping), max_queue_size=0
-    )
-
-    self._thread = threading.Thread(target=lambda: self.Run(paths))
-    self._thread.start()
-
-  def GetDatabaseEngine(self) -> sql.engine.Engine:
-    """Construct the database engine."""
-    engine = sqlutil.CreateEngine(
-      f"sqlite:///{self.cache_path}/cache.sqlite.db"
-    )
+    # An unexpected exception raised by the background thread, which is
+    # re-raised by Outcomes().
+    self._error: Optional[Exception] = None
 
-    engine.execute(
-      """
-    CREATE TABLE IF NOT EXISTS cache(
-      path VARCHAR(4096) NOT NULL PRIMARY KEY,
-      mtime INTEGER NOT NULL
-    );
-    """
-    )
+    self.paths = paths
+    self._thread = threading.Thread(target=self._RunThread)
+    if start:
+      self.Start()
 
-    return engine
+  def Start(self) -> None:
+    """Start formatting in a background thread."""
+    self._thread.start()
 
-  def Run(
-    self, paths: Iterable[pathlib.Path]
-  ) -> Iterable[Union[pathlib.Path, Exception]]:
-    """Read the input paths and format them as required.."""
-    with concurrent.futures.ThreadPoolExecutor(
-      max_workers=multiprocessing.cpu_count()
-    ) as executor, self.GetDatabaseEngine().begin() as connection:
-      # A list of
+  def _RunThread(self) -> None:
+    """The background thread."""
+    # Create a threaded iterator to filter the list of incoming paths.
+    try:
+      self.Run(
+        ppar.ThreadedIterator(
+          PathsWithFormatters(self.paths, self.suffix_matcher),
+          max_queue_size=0,
+        )
+      )
+    except Exception as e:
+      self._error = e
+
+  def Run(self, paths: Iterable[pathlib.Path]) -> None:
+    """Read the input paths and format them as required."""
+    cost_model = scheduler.CostModel(self.cache.GetTimings())
+    with scheduler.ActionScheduler(
+      cost_model, max_workers=multiprocessing.cpu_count()
+    ) as action_scheduler, self.cache.Session():
+      # A list of the scheduled formatter actions.
       futures: List[concurrent.futures.Future] = []
 
       try:
         for path in paths:
-          needs_formatting, cached_mtime = self.NeedsFormatting(
-            connection, path
-          )
-          if needs_formatting:
-            if self.dry_run:
-              self._queue.put(path)
-            else:
-              try:
-                action = self.MaybeFormat(path, cached_mtime)
-                if action:
-                  futures.append(executor.submit(action))
-              except base_formatter.BaseFormatter.InitError as init_error:
-                # If a formatter failed to initialize then record the error and
-                # stop what we're doing.
-                self._queue.put(init_error)
-                break
+          self.UpdateCache()
+          try:
+            outcome = self.VisitPath(
+              path,
+              lambda form, action: futures.append(
+                self.Schedule(action_scheduler, form, action)
+              ),
+            )
+          except base_formatter.BaseFormatter.InitError as init_error:
+            # If a formatter failed to initialize then record the error and
+            # stop what we're doing.
+            self._queue.put(
+              format_outcome.FormatOutcome(
+                path=path,
+                status=format_outcome.FormatStatus.ERROR,
+                error=init_error,
+              )
+            )
+            break
+          if outcome:
+            self._queue.put(outcome)
 
         # We have run out of paths to format so finalize the formatters we
         # instantiated.
         for form in self.formatter_instances.values():
           action = form.Finalize()
           if action:
-            futures.append(executor.submit(action))
+            futures.append(self.Schedule(action_scheduler, form, action))
 
-        # Wait for the formatters to complete.
+        # Wait for the formatters to complete, recording the new mtimes of
+        # files in the cache as they arrive. Errors are reported by the
+        # actions, so an exception here is unexpected, but it is reported
+        # rather than abandoning the remaining actions.
         for future in concurrent.futures.as_completed(futures):
-          paths, cached_mtimes, errors = future.result()
-
-          # Accumulate the errors which can be checked later.
-          for error in errors:
-            self._queue.put(error)
-
-          for path, cached_mtime in zip(paths, cached_mtimes):
-            mtime = int(os.path.getmtime(path) * 1e6)
-            if mtime != cached_mtime:
-              self._queue.put(path)
-              if FLAGS.with_cache:
-                connection.execute(
-                  sql.text(
-                    "REPLACE INTO cache (path, mtime) VALUES (:path, :mtime)"
-                  ),
-                  path=str(path),
-                  mtime=mtime,
-                )
+          try:
+            future.result()
+          except Exception as e:
+            self._queue.put(
+              format_outcome.FormatOutcome(
+                path=None, status=format_outcome.FormatStatus.ERROR, error=e
+              )
+            )
+          self.UpdateCache()
+
+        # Update the historical timings used to estimate the cost of actions.
+        self.cache.SetTimings(cost_model.timings)
       finally:
         # End of input loop, terminate.
         self._queue.put(None)
 
-  def __iter__(self) -> Iterable[Union[pathlib.Path, Exception]]:
-    """Return an iterator over modification outcomes."""
+    self.cache.MaybeVacuum()
+
+  def UpdateCache(self) -> None:
+    """Write the pending mtime updates to the cache."""
+    while True:
+      try:
+        path, mtime = self._cache_updates.get_nowait()
+      except queue.Empty:
+        break
+      if FLAGS.with_cache:
+        self.cache.SetMtime(path, mtime)
+
+  def Outcomes(self) -> Iterable[format_outcome.FormatOutcome]:
+    """Return an iterator over the outcomes of all visited files.
+
+    Raises:
+      Exception: If the background thread failed with an unexpected error.
+    """
     while True:
       item = self._queue.get()
       if item is None:
@@ -206,33 +293,128 @@ class FormatPaths(object):
       yield item
 
     self.Join()
+    if self._error:
+      raise self._error
+
+  def __iter__(self) -> Iterable[Union[pathlib.Path, Exception]]:
+    """Return an iterator over modification outcomes."""
+    for outcome in self.Outcomes():
+      if outcome.status == format_outcome.FormatStatus.ERROR:
+        yield outcome.error
+      elif outcome.modified:
+        yield outcome.path
 
   def Join(self):
     self._thread.join()
 
-  def NeedsFormatting(self, connection, path: pathlib.Path):
+  def VisitPath(
+    self,
+    path: pathlib.Path,
+    schedule: Callable[
+      [base_formatter.BaseFormatter, base_formatter.FormatAction], None
+    ],
+  ) -> Optional[format_outcome.FormatOutcome]:
+    """Visit a path and pass it to a formatter if it needs formatting.
+
+    Args:
+      path: The path to visit.
+      schedule: A callback which is called with a formatter and the action
+        that it returns, if any.
+
+    Returns:
+      The outcome of the path if it is known without running a formatter,
+      else None.
+
+    Raises:
+      formatter.Formatter.InitError: If a formatter fails to initialize.
+    """
+    mtime, size = self.GetMtimeAndSize(path)
+    needs_formatting, cached_mtime = self.NeedsFormatting(path, mtime)
+    if not needs_formatting:
+      return format_outcome.FormatOutcome(
+        path=path,
+        status=format_outcome.FormatStatus.CACHED,
+        bytes_before=size,
+        bytes_after=size,
+        cache_hit=True,
+      )
+    elif self.dry_run:
+      return format_outcome.FormatOutcome(
+        path=path,
+        status=format_outcome.FormatStatus.DRY_RUN,
+        bytes_before=size,
+        cache_hit=cached_mtime is not None,
+      )
+
+    form, action = self.MaybeFormat(
+      _PendingPath(path, mtime, size, cached_mtime)
+    )
+    if action:
+      schedule(form, action)
+
+  def GetMtimeAndSize(self, path: pathlib.Path) -> Tuple[int, int]:
+    """Return the mtime, in microseconds, and the size of a file.
+
+    Once --git_index_stat_threshold paths have been visited whose stat data is
+    not known, the stat data of the clean files in their deepest common
+    directory is read from the git index of that directory, so that the
+    remaining files of a large run need not be stat()-ed. The index is read
+    again for the next --git_index_stat_threshold unknown paths, so the files
+    of other repositories, such as submodules, are read from their own index.
+    Files which are not clean are stat()-ed.
+    """
+    stat = self._index_stats.get(str(path))
+    if stat:
+      return stat
+
+    if FLAGS.git_index_stat_threshold:
+      directory = str(path.parent)
+      common = self._unindexed_directory
+      if common is None:
+        self._unindexed_directory = directory
+      elif directory != common and not directory.startswith(
+        os.path.join(common, "")
+      ):
+        self._unindexed_directory = os.path.commonpath([common, directory])
+      self._unindexed_count += 1
+      if self._unindexed_count > FLAGS.git_index_stat_threshold:
+        directory = self._unindexed_directory
+        self._unindexed_count, self._unindexed_directory = 0, None
+        if directory not in self._index_directories:
+          self._index_directories.add(directory)
+          self._index_stats.update(
+            git_index.GetCleanFileStats(pathlib.Path(directory))
+          )
+
+    stat = os.stat(path)
+    return int(stat.st_mtime * 1e6), stat.st_size
+
+  def NeedsFormatting(self, path: pathlib.Path, mtime: int):
     # Determine if the file should be processed.
-    mtime = int(os.path.getmtime(path) * 1e6)
     cached_mtime = None
     if FLAGS.with_cache:
-      query = connection.execute(
-        sql.text("SELECT mtime FROM cache WHERE path = :path"), path=str(path),
-      )
-      result = query.first()
-      if result:
-        cached_mtime = result[0]
+      cached_mtime = self.cache.Lookup(path, mtime)
     # Skip a file that hasn't been modified since the last time it was
     # formatted.
     return mtime != cached_mtime, cached_mtime
 
-  def MaybeFormat(self, path: pathlib.Path, cached_mtime):
+  def MaybeFormat(
+    self, pending_path: _PendingPath
+  ) -> Tuple[
+    base_formatter.BaseFormatter, Optional[base_formatter.FormatAction]
+  ]:
     """Schedule a file to be formatted if required.
 
+    Returns:
+      A tuple of the formatter for this path, and the action returned by the
+      formatter, if any.
+
     Raises:
       formatter.Formatter.InitError: If a formatter fails to initialize.
     """
+    path = pending_path.path
     # Get or create the formatter.
-    formatters_key = path.suffix or path.name
+    formatters_key = self.suffix_matcher.Match(path.name)
     # Lookup the name of the formatter class, which is used to index into the
     # formatter instance cache.
     formatter_cache_key = self.suffix_mapping[formatters_key].__name__
@@ -242,25 +424,168 @@ class FormatPaths(object):
       form = self.suffix_mapping[formatters_key](self.cache_path)
       self.formatter_instances[formatter_cache_key] = form
 
-    return form(path, cached_mtime)
+    # Record the paths passed to this formatter so that we can estimate the
+    # cost of the action which processes them, and report their outcomes.
+    self._pending_paths[formatter_cache_key].append(pending_path)
+
+    return form, form(path, pending_path.cached_mtime)
+
+  def Schedule(
+    self,
+    action_scheduler: scheduler.ActionScheduler,
+    form: base_formatter.BaseFormatter,
+    action: base_formatter.FormatAction,
+  ) -> concurrent.futures.Future:
+    """Submit a formatter action for execution.
+
+    The action is assumed to process all of the files passed to the formatter
+    since its previous action was scheduled.
+
+    Returns:
+      A future which completes once the outcomes of the action have been
+      reported.
+    """
+    formatter_name = type(form).__name__
+    pending_paths = self.PopPendingPaths(form)
+    byte_count = sum(p.size for p in pending_paths)
+    return action_scheduler.Submit(
+      lambda: self.RunAction(action, formatter_name, pending_paths),
+      formatter_name,
+      byte_count,
+      prior=(
+        form.expected_seconds_per_action
+        + form.expected_seconds_per_byte * byte_count
+      ),
+    )
+
+  def PopPendingPaths(
+    self, form: base_formatter.BaseFormatter
+  ) -> List[_PendingPath]:
+    """Return the paths passed to a formatter since it last returned an action.
+    """
+    return self._pending_paths.pop(type(form).__name__, [])
+
+  def RunAction(
+    self,
+    action: base_formatter.FormatAction,
+    formatter_name: str,
+    pending_paths: List[_PendingPath],
+  ) -> None:
+    """Run a formatter action and report the outcomes of its paths.
+
+    This is called from a scheduler worker thread.
+    """
+    start_time = time.time()
+    result = action()
+    elapsed = time.time() - start_time
+    for outcome in self.GetActionOutcomes(
+      formatter_name, pending_paths, result, elapsed
+    ):
+      self._queue.put(outcome)
+
+  def GetActionOutcomes(
+    self,
+    formatter_name: str,
+    pending_paths: List[_PendingPath],
+    result: Tuple[List[pathlib.Path], List[Optional[int]], List[Exception]],
+    elapsed: float,
+  ) -> List[format_outcome.FormatOutcome]:
+    """Determine the outcomes of the paths processed by a formatter action.
+
+    The new mtimes of modified files are queued for writing to the cache by
+    UpdateCache(). This method is thread safe.
+
+    Args:
+      formatter_name: The name of the formatter.
+      pending_paths: The paths processed by the action.
+      result: The value returned by the action.
+      elapsed: The runtime of the action, in seconds.
+
+    Returns:
+      A list of outcomes.
+    """
+    paths, _, errors = result
+    outcomes = []
+
+    # Apportion the runtime of the action between the files in proportion to
+    # their size.
+    total_size = sum(p.size for p in pending_paths)
+
+    def Duration(pending_path: _PendingPath) -> float:
+      if total_size:
+        return elapsed * pending_path.size / total_size
+      return elapsed / max(len(pending_paths), 1)
+
+    succeeded = set(paths)
+    for pending_path in pending_paths:
+      if pending_path.path not in succeeded:
+        continue
+      stat = os.stat(pending_path.path)
+      mtime = int(stat.st_mtime * 1e6)
+      if mtime != pending_path.cached_mtime:
+        self._cache_updates.put((pending_path.path, mtime))
+      outcomes.append(
+        format_outcome.FormatOutcome(
+          path=pending_path.path,
+          status=(
+            format_outcome.FormatStatus.MODIFIED
+            if mtime != pending_path.mtime
+            else format_outcome.FormatStatus.UNCHANGED
+          ),
+          formatter=formatter_name,
+          duration=Duration(pending_path),
+          bytes_before=pending_path.size,
+          bytes_after=stat.st_size,
+          cache_hit=pending_path.cached_mtime is not None,
+        )
+      )
+
+    # Formatters return one error for every file that could not be formatted,
+    # in the order that the files were passed to the formatter. If this is not
+    # the case then we cannot attribute errors to paths.
+    failed = [p for p in pending_paths if p.path not in succeeded]
+    if len(failed) != len(errors):
+      failed = [None] * len(errors)
+    for pending_path, error in zip(failed, errors):
+      outcomes.append(
+        format_outcome.FormatOutcome(
+          path=pending_path.path if pending_path else None,
+          status=format_outcome.FormatStatus.ERROR,
+          formatter=formatter_name,
+          duration=Duration(pending_path) if pending_path else 0,
+          bytes_before=pending_path.size if pending_path else None,
+          cache_hit=(
+            pending_path is not None and pending_path.cached_mtime is not None
+          ),
+          error=error,
+        )
+      )
+
+    return outcomes
 
 
 def PathsWithFormatters(
   paths: Iterable[pathlib.Path],
-  suffix_mapping: Dict[str, base_formatter.BaseFormatter],
+  suffix_mapping: Union[
+    Dict[str, base_formatter.BaseFormatter], suffix_matcher.SuffixMatcher
+  ],
 ) -> Iterable[pathlib.Path]:
   """Filter an iterable of paths for those with corresponding formatters.
 
   Args:
     paths: An iterator of paths.
+    suffix_mapping: A mapping from suffix to formatter class, or a matcher
+      compiled from one.
 
   Returns:
-    An iterator of paths which have entries in the suffix_mapping.formatters
-    dictionary.
+    An iterator of paths which match a key of the suffix mapping.
   """
+  if isinstance(suffix_mapping, suffix_matcher.SuffixMatcher):
+    matcher = suffix_mapping
+  else:
+    matcher = suffix_matcher.SuffixMatcher(suffix_mapping)
   for path in paths:
-    key = path.suffix or path.name
-    if key in suffix_mapping:
+    if matcher.Match(path.name) is not None:
       app.Log(3, "PUT %s", path)
       yield path
 
@@ -274,17 +599,33 @@ def FormatPathsOrDie(
   are processed. Any formatting errors cause this function to crash the process
   with an error.
   """
+  return ReportOutcomesOrDie(FormatPaths(paths, dry_run=dry_run).Outcomes())
+
+
+def ReportOutcomesOrDie(
+  outcomes: Iterable[format_outcome.FormatOutcome],
+  file: Optional[TextIO] = None,
+) -> List[pathlib.Path]:
+  """Print the paths of modified files as they arrive, and terminate on error.
+
+  Args:
+    outcomes: An iterator of format outcomes.
+    file: The file to print the paths of modified files to. Defaults to stdout.
+
+  Returns:
+    The list of modified paths.
+  """
   # Accumulate errors which we print at the end.
   errors = []
   # Accumulate modified paths that are returned at the end.
   modified_paths = []
 
-  for outcome in FormatPaths(paths, dry_run=dry_run):
-    if isinstance(outcome, Exception):
-      errors.append(outcome)
-    else:
-      modified_paths.append(outcome)
-      print(outcome)
+  for outcome in outcomes:
+    if outcome.status == format_outcome.FormatStatus.ERROR:
+      errors.append(outcome.error)
+    elif outcome.modified:
+      modified_paths.append(outcome.path)
+      print(outcome.path, file=file)
 
   if errors:
     print(
@@ -0,0 +1,349 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module defines an asyncio interface for formatting paths.
+
+Example usage:
+
+    async for outcome in FormatPathsAsync(paths, timeout=60):
+      if outcome.status == FormatStatus.ERROR:
+        print(outcome.error)
+"""
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import pathlib
+import signal
+import subprocess
+import threading
+import time
+from typing import AsyncIterator
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from labm8.py import app
+from tools.format import format_outcome
+from tools.format import format_paths
+from tools.format.default_suffix_mapping import (
+  mapping as default_suffix_mapping,
+)
+from tools.format.formatters.base import base_formatter
+
+FLAGS = app.FLAGS
+
+
+class FormatPathsAsync(object):
+  """An asynchronous iterator over the outcomes of formatting paths.
+
+  This is the asyncio counterpart to FormatPaths. The subprocesses of formatter
+  actions are run on the event loop using asyncio.create_subprocess_exec().
+  Formatter actions themselves are plain Python functions, so each running
+  action occupies a thread from a bounded pool, but that thread is only ever
+  blocked waiting on the event loop.
+
+  If iteration is cancelled, or an action exceeds its timeout, the child
+  processes of the affected actions are killed. An action which runs Python
+  code rather than a subprocess cannot be killed, so the outcome of an action
+  which times out is reported once its thread completes. The enumeration of
+  paths and cache lookups are performed in a thread, off the event loop.
+  """
+
+  def __init__(
+    self,
+    paths: Iterable[pathlib.Path],
+    dry_run: bool = False,
+    max_concurrency: Optional[int] = None,
+    timeout: Optional[float] = None,
+    suffix_mapping: Dict[
+      str, base_formatter.BaseFormatter
+    ] = default_suffix_mapping,
+  ):
+    """Constructor.
+
+    Args:
+      paths: The paths to format. Paths are enumerated in a thread, so this
+        may be a generator which performs blocking I/O.
+      dry_run: Yield only the paths that would be formatted, without running the
+        formatters themselves.
+      max_concurrency: The maximum number of formatter actions to run
+        concurrently. Defaults to the number of CPUs.
+      timeout: The maximum runtime of a single formatter action, in seconds. If
+        None, actions may run indefinitely.
+      suffix_mapping: A mapping from suffix to formatter class.
+    """
+    self.max_concurrency = max_concurrency or multiprocessing.cpu_count()
+    self.timeout = timeout
+    # The synchronous implementation is used for the enumeration of paths, the
+    # cache, and the bookkeeping of formatter instances, but is never started.
+    self._format_paths = format_paths.FormatPaths(
+      paths, dry_run=dry_run, suffix_mapping=suffix_mapping, start=False
+    )
+
+  def __aiter__(self) -> AsyncIterator[format_outcome.FormatOutcome]:
+    return self.Outcomes()
+
+  async def Outcomes(self) -> AsyncIterator[format_outcome.FormatOutcome]:
+    """Format the paths and yield the outcome of each file as it completes."""
+    loop = asyncio.get_event_loop()
+    outcomes = asyncio.Queue()
+    semaphore = asyncio.Semaphore(self.max_concurrency)
+    executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=self.max_concurrency
+    )
+    tasks: List[asyncio.Future] = []
+
+    def Schedule(
+      form: base_formatter.BaseFormatter,
+      action: base_formatter.FormatAction,
+      pending_paths: List[format_paths._PendingPath],
+    ) -> None:
+      tasks.append(
+        asyncio.ensure_future(
+          self._RunAction(
+            action,
+            type(form).__name__,
+            pending_paths,
+            semaphore,
+            executor,
+            outcomes,
+          )
+        )
+      )
+
+    producer = asyncio.ensure_future(self._Run(Schedule, tasks, outcomes))
+    try:
+      while True:
+        outcome = await outcomes.get()
+        if outcome is None:
+          break
+        yield outcome
+      # Propagate any exception raised by the producer.
+      await producer
+    finally:
+      # Cancel any outstanding work if iteration was stopped early.
+      for task in [producer] + tasks:
+        task.cancel()
+      await asyncio.gather(producer, *tasks, return_exceptions=True)
+      # Wait for the executor threads while the event loop is still running,
+      # since a thread may be waiting on a subprocess to be run on the loop.
+      # Killed actions cannot start new subprocesses, so this returns as soon as
+      # any running Python code completes.
+      await loop.run_in_executor(None, executor.shutdown)
+
+  async def _Run(self, schedule, tasks: List[asyncio.Future], outcomes):
+    """Read the input paths and schedule formatter actions as required."""
+    loop = asyncio.get_event_loop()
+    fp = self._format_paths
+    # Set to stop the visitor thread if iteration is cancelled.
+    stopped = threading.Event()
+
+    def Put(outcome: format_outcome.FormatOutcome) -> None:
+      """Queue an outcome. Called from the visitor thread."""
+      loop.call_soon_threadsafe(outcomes.put_nowait, outcome)
+
+    def ScheduleThreadsafe(
+      form: base_formatter.BaseFormatter, action: base_formatter.FormatAction
+    ) -> None:
+      """Schedule an action on the event loop. Called from the visitor thread.
+      """
+      if stopped.is_set():
+        return
+      loop.call_soon_threadsafe(
+        schedule, form, action, fp.PopPendingPaths(form)
+      )
+
+    def VisitPaths() -> None:
+      """Enumerate the paths and schedule their formatter actions.
+
+      This walks the filesystem and reads the cache, so it is run in a thread
+      rather than on the event loop.
+      """
+      for path in format_paths.PathsWithFormatters(
+        fp.paths, fp.suffix_matcher
+      ):
+        if stopped.is_set():
+          return
+        fp.UpdateCache()
+        try:
+          outcome = fp.VisitPath(path, ScheduleThreadsafe)
+        except base_formatter.BaseFormatter.InitError as init_error:
+          Put(
+            format_outcome.FormatOutcome(
+              path=path,
+              status=format_outcome.FormatStatus.ERROR,
+              error=init_error,
+            )
+          )
+          return
+        if outcome:
+          Put(outcome)
+
+      for form in fp.formatter_instances.values():
+        action = form.Finalize()
+        if action:
+          ScheduleThreadsafe(form, action)
+
+    try:
+      with fp.cache.Session():
+        visitor = loop.run_in_executor(None, VisitPaths)
+        try:
+          await asyncio.shield(visitor)
+        except asyncio.CancelledError:
+          # Wait for the thread to stop before closing the cache session.
+          stopped.set()
+          await asyncio.wait([visitor])
+          raise
+        # The actions scheduled by the visitor thread are added to the list of
+        # tasks before the thread's completion is delivered to the loop.
+        for task in asyncio.as_completed(tasks):
+          await task
+          await loop.run_in_executor(None, fp.UpdateCache)
+    finally:
+      await outcomes.put(None)
+
+    await loop.run_in_executor(None, fp.cache.MaybeVacuum)
+
+  async def _RunAction(
+    self,
+    action: base_formatter.FormatAction,
+    formatter_name: str,
+    pending_paths: List[format_paths._PendingPath],
+    semaphore: asyncio.Semaphore,
+    executor: concurrent.futures.Executor,
+    outcomes: asyncio.Queue,
+  ) -> None:
+    """Run a formatter action and report the outcomes of its paths."""
+    loop = asyncio.get_event_loop()
+    # The child processes of this action, and a flag which prevents the action
+    # from starting new processes once it has been killed.
+    processes: Set[asyncio.subprocess.Process] = set()
+    killed = threading.Event()
+
+    def ExecHook(
+      cmd: List[str],
+      env: Optional[Dict[str, str]],
+      timeout: Optional[float],
+      preexec_fn: Optional[Callable[[], None]],
+    ) -> Tuple[int, str]:
+      """Run a command on the event loop. Called from the executor thread."""
+      return asyncio.run_coroutine_threadsafe(
+        _ExecAsync(cmd, env, timeout, preexec_fn, processes, killed), loop
+      ).result()
+
+    def RunWithExecHook():
+      """Run the action, routing subprocesses through the event loop."""
+      token = base_formatter.exec_hook.set(ExecHook)
+      try:
+        return action()
+      finally:
+        base_formatter.exec_hook.reset(token)
+
+    async with semaphore:
+      start_time = time.time()
+      future = loop.run_in_executor(executor, RunWithExecHook)
+      try:
+        result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+      except asyncio.TimeoutError:
+        _Kill(processes, killed)
+        # Actions which run Python code, rather than subprocesses, cannot be
+        # interrupted. Wait for the thread to finish, so that the semaphore
+        # continues to count it, and so that the outcome is not reported
+        # while the action can still modify the file.
+        await asyncio.wait([future])
+        result = (
+          [],
+          [],
+          [
+            base_formatter.BaseFormatter.FormatError(
+              f"{formatter_name} timed out after {self.timeout:.1f} seconds "
+              f"formatting {p.path}"
+            )
+            for p in pending_paths
+          ],
+        )
+      except asyncio.CancelledError:
+        _Kill(processes, killed)
+        raise
+      elapsed = time.time() - start_time
+
+    for outcome in self._format_paths.GetActionOutcomes(
+      formatter_name, pending_paths, result, elapsed
+    ):
+      await outcomes.put(outcome)
+
+
+async def _ExecAsync(
+  cmd: List[str],
+  env: Optional[Dict[str, str]],
+  timeout: Optional[float],
+  preexec_fn: Optional[Callable[[], None]],
+  processes: Set[asyncio.subprocess.Process],
+  killed: threading.Event,
+) -> Tuple[int, str]:
+  """Run a command and return its returncode and output.
+
+  This enforces the same subprocess timeout and resource limits as
+  BaseFormatter._Exec().
+
+  Raises:
+    subprocess.TimeoutExpired: If the command runs for longer than timeout
+      seconds, after its process group has been killed.
+  """
+  if killed.is_set():
+    return 1, "Formatter was killed"
+  # The child is started in a new session so that it and any processes it
+  # spawns can be killed as a group.
+  process = await asyncio.create_subprocess_exec(
+    *[str(x) for x in cmd],
+    stdout=asyncio.subprocess.PIPE,
+    stderr=asyncio.subprocess.STDOUT,
+    env=env,
+    start_new_session=True,
+    preexec_fn=preexec_fn,
+  )
+  processes.add(process)
+  # The action may have been killed while the process was starting.
+  if killed.is_set():
+    _Kill(processes, killed)
+  try:
+    stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+  except asyncio.TimeoutError:
+    _KillProcessGroup(process)
+    await process.wait()
+    raise subprocess.TimeoutExpired(cmd, timeout)
+  finally:
+    processes.discard(process)
+  return process.returncode, stdout.decode("utf-8", errors="replace")
+
+
+def _Kill(
+  processes: Set[asyncio.subprocess.Process], killed: threading.Event
+) -> None:
+  """Kill the process groups of the given processes."""
+  killed.set()
+  for process in list(processes):
+    _KillProcessGroup(process)
+
+
+def _KillProcessGroup(process: asyncio.subprocess.Process) -> None:
+  """Kill a process and all members of its process group."""
+  try:
+    os.killpg(process.pid, signal.SIGKILL)
+  except ProcessLookupError:
+    pass
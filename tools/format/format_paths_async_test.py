@@ -0,0 +1,185 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format:format_paths_async."""
+import asyncio
+import pathlib
+import time
+
+from labm8.py import test
+from tools.format import format_outcome
+from tools.format import format_paths_async
+from tools.format.formatters.base import file_formatter
+
+FLAGS = test.FLAGS
+
+
+class FormatAppend(file_formatter.FileFormatter):
+  """A formatter which appends a line to a file using a subprocess."""
+
+  def RunOne(self, path: pathlib.Path) -> None:
+    self._Exec(["sh", "-c", f"echo formatted >> '{path}'"])
+
+
+class FormatSleep(file_formatter.FileFormatter):
+  """A formatter which never completes."""
+
+  def RunOne(self, path: pathlib.Path) -> None:
+    self._Exec(["sleep", "60"])
+
+
+class FormatUlimit(file_formatter.FileFormatter):
+  """A formatter which appends the CPU time limit of a subprocess to a file."""
+
+  def RunOne(self, path: pathlib.Path) -> None:
+    self._Exec(["sh", "-c", f"ulimit -t >> '{path}'"])
+
+
+class FormatSlowPython(file_formatter.FileFormatter):
+  """A formatter which formats a file in-process, slowly."""
+
+  def RunOne(self, path: pathlib.Path) -> None:
+    time.sleep(2)
+    path.write_text("formatted\n")
+
+
+SUFFIX_MAPPING = {
+  ".append": FormatAppend,
+  ".python": FormatSlowPython,
+  ".sleep": FormatSleep,
+  ".ulimit": FormatUlimit,
+}
+
+
+def Collect(formatter: format_paths_async.FormatPathsAsync):
+  """Run the async formatter and return the outcomes."""
+
+  async def _Collect():
+    return [outcome async for outcome in formatter]
+
+  return asyncio.get_event_loop().run_until_complete(_Collect())
+
+
+def test_FormatPathsAsync_modified_file(tempdir: pathlib.Path):
+  path = tempdir / "a.append"
+  path.write_text("hello\n")
+
+  outcomes = Collect(
+    format_paths_async.FormatPathsAsync(
+      [path], suffix_mapping=SUFFIX_MAPPING
+    )
+  )
+
+  assert len(outcomes) == 1
+  assert outcomes[0].path == path
+  assert outcomes[0].status == format_outcome.FormatStatus.MODIFIED
+  assert outcomes[0].formatter == "FormatAppend"
+  assert path.read_text() == "hello\nformatted\n"
+
+
+def test_FormatPathsAsync_timeout_kills_formatter(tempdir: pathlib.Path):
+  (tempdir / "a.sleep").touch()
+  (tempdir / "b.append").touch()
+
+  start_time = time.time()
+  outcomes = Collect(
+    format_paths_async.FormatPathsAsync(
+      [tempdir / "a.sleep", tempdir / "b.append"],
+      timeout=1,
+      suffix_mapping=SUFFIX_MAPPING,
+    )
+  )
+
+  assert time.time() - start_time < 30
+  statuses = {outcome.path.name: outcome.status for outcome in outcomes}
+  assert statuses == {
+    "a.sleep": format_outcome.FormatStatus.ERROR,
+    "b.append": format_outcome.FormatStatus.MODIFIED,
+  }
+
+
+def test_FormatPathsAsync_timeout_waits_for_python_action(
+  tempdir: pathlib.Path,
+):
+  """Test that the outcome of an in-process action which times out is not
+  reported until the action has completed."""
+  path = tempdir / "a.python"
+  path.touch()
+
+  async def _Collect():
+    contents = []
+    async for outcome in format_paths_async.FormatPathsAsync(
+      [path], timeout=0.5, suffix_mapping=SUFFIX_MAPPING
+    ):
+      contents.append((outcome.status, path.read_text()))
+    return contents
+
+  contents = asyncio.get_event_loop().run_until_complete(_Collect())
+  assert contents == [(format_outcome.FormatStatus.ERROR, "formatted\n")]
+
+
+def test_FormatPathsAsync_formatter_timeout(tempdir: pathlib.Path):
+  """Test that --formatter_timeout applies to subprocesses on the event loop."""
+  (tempdir / "a.sleep").touch()
+  old_timeout = FLAGS.formatter_timeout
+  FLAGS.formatter_timeout = 1
+  try:
+    start_time = time.time()
+    outcomes = Collect(
+      format_paths_async.FormatPathsAsync(
+        [tempdir / "a.sleep"], suffix_mapping=SUFFIX_MAPPING
+      )
+    )
+  finally:
+    FLAGS.formatter_timeout = old_timeout
+
+  assert time.time() - start_time < 30
+  assert len(outcomes) == 1
+  assert isinstance(outcomes[0].error, FormatSleep.FormatTimeoutError)
+
+
+def test_FormatPathsAsync_resource_limits(tempdir: pathlib.Path):
+  path = tempdir / "a.ulimit"
+  path.touch()
+  old_max_cpu_seconds = FLAGS.formatter_max_cpu_seconds
+  FLAGS.formatter_max_cpu_seconds = 7
+  try:
+    Collect(
+      format_paths_async.FormatPathsAsync([path], suffix_mapping=SUFFIX_MAPPING)
+    )
+  finally:
+    FLAGS.formatter_max_cpu_seconds = old_max_cpu_seconds
+
+  assert path.read_text() == "7\n"
+
+
+def test_FormatPathsAsync_cancellation(tempdir: pathlib.Path):
+  (tempdir / "a.sleep").touch()
+
+  async def FormatWithDeadline():
+    async def Consume():
+      async for _ in format_paths_async.FormatPathsAsync(
+        [tempdir / "a.sleep"], suffix_mapping=SUFFIX_MAPPING
+      ):
+        pass
+
+    with test.Raises(asyncio.TimeoutError):
+      await asyncio.wait_for(Consume(), 1)
+
+  start_time = time.time()
+  asyncio.get_event_loop().run_until_complete(FormatWithDeadline())
+  assert time.time() - start_time < 30
+
+
+if __name__ == "__main__":
+  test.Main()
@@ -30,3 +30,7 @@ setup() {
 @test "format Java" {
   "$BIN" "$TEST_TMPDIR/src/java/Hello.java"
 }
+
+@test "shard_workers" {
+  "$BIN" --shard_workers=2 "$TEST_TMPDIR"
+}
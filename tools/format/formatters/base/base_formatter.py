@@ -12,21 +12,64 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """This module defines the base classes and utilities for formatters."""
+import contextvars
+import functools
+import itertools
 import os
 import pathlib
+import resource
+import signal
+import stat
 import subprocess
 import tempfile
+from typing import BinaryIO
 from typing import Callable
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
 from typing import Optional
 from typing import Tuple
+from typing import Union
 
 import fasteners
 from labm8.py import app
 from labm8.py import fs
 from tools.format import app_paths
 
+FLAGS = app.FLAGS
+
+app.DEFINE_float(
+  "formatter_timeout",
+  300,
+  "The maximum number of seconds that a formatter subprocess may run before it "
+  "is killed and the files that it was processing are reported as errors. A "
+  "value of zero disables the timeout.",
+)
+app.DEFINE_list(
+  "formatter_timeouts",
+  [],
+  "A list of per-formatter timeouts, in seconds, which override "
+  "--formatter_timeout. For example, "
+  "--formatter_timeouts=FormatJava=600,FormatCxx=30.",
+  validator=lambda timeouts: all(
+    len(t.split("=")) == 2 and t.split("=")[1].replace(".", "", 1).isdigit()
+    for t in timeouts
+  ),
+)
+app.DEFINE_integer(
+  "formatter_max_memory_mb",
+  0,
+  "If set, limit the virtual memory of formatter subprocesses to this many "
+  "megabytes. Note that JVM-based formatters reserve a large amount of virtual "
+  "memory at startup, so set this with care.",
+)
+app.DEFINE_integer(
+  "formatter_max_cpu_seconds",
+  0,
+  "If set, limit the CPU time of formatter subprocesses to this many seconds.",
+)
+
 # A deferred formatter action. Calling a formatter may return one of these
 # actions. An action is a function which takes no arguments and returns the
 # outcome: a list of all paths processed, their original mtimes, and a list of
@@ -35,6 +78,29 @@ FormatAction = Callable[
   [], Tuple[List[pathlib.Path], List[Optional[int]], List[Exception]]
 ]
 
+# The signature of a function which runs a command for BaseFormatter._Exec().
+# It takes the command, its environment, its timeout in seconds (or None), and
+# a function to call in the child process before exec (or None), and returns a
+# tuple of the returncode and output of the command. The command must be run in
+# a new session, and if it exceeds the timeout, its process group must be
+# killed and subprocess.TimeoutExpired raised.
+ExecFunction = Callable[
+  [
+    List[str],
+    Optional[Dict[str, str]],
+    Optional[float],
+    Optional[Callable[[], None]],
+  ],
+  Tuple[int, str],
+]
+
+# An optional override for the way that BaseFormatter._Exec() runs commands.
+# This is used to run the subprocesses of formatter actions on an asyncio event
+# loop, see //tools/format:format_paths_async.
+exec_hook: contextvars.ContextVar[
+  Optional[ExecFunction]
+] = contextvars.ContextVar("exec_hook", default=None)
+
 
 class BaseFormatter(object):
   """Base class for implementing formatters.
@@ -66,6 +132,13 @@ class BaseFormatter(object):
        raise an InitError() if anything is missing.
   """
 
+  # Prior estimates of the runtime of an action of this formatter, used to
+  # schedule actions until historical timings have been recorded. Formatters
+  # with expensive startup costs, such as launching a JVM, should override
+  # these. See tools/format/scheduler.py.
+  expected_seconds_per_action = 0.1
+  expected_seconds_per_byte = 1e-6
+
   def __init__(self, cache_path: pathlib.Path):
     """Constructor.
 
@@ -107,6 +180,13 @@ class BaseFormatter(object):
                                "     " + "\n    ".join(proc.stderr.split("\n"))
     """
 
+  class FormatTimeoutError(FormatError):
+    """An exception raised if a formatter subprocess exceeds its timeout.
+
+    This is a FormatError so that a batched formatter isolates the file which
+    causes the timeout from the rest of its batch.
+    """
+
   class InitError(TypeError):
     """An error value raised if the formatter fails to initialize.
 
@@ -150,22 +230,121 @@ class BaseFormatter(object):
     with tempfile.TemporaryDirectory(
       prefix="format_", dir=app_paths.GetCacheDir()
     ) as d:
-      cache_path = pathlib.Path(d)
-      formatter = cls(cache_path)
+      return cls(pathlib.Path(d)).FormatText(
+        text, assumed_filename or cls.assumed_filename
+      )
+
+  def FormatText(self, text: str, filename: str) -> str:
+    """Run this formatter instance on a string of text.
+
+    Unlike Format(), this reuses an existing formatter instance, avoiding the
+    cost of initializing the formatter for every string. The text is written
+    to a scratch file in the formatter's cache directory. This method is not
+    thread safe.
+
+    Args:
+      text: The text to format.
+      filename: The name of the file used to feed the input to the formatter.
 
-      path = cache_path / (assumed_filename or cls.assumed_filename)
-      fs.Write(path, text.encode("utf-8"))
+    Returns:
+      The formatted text.
+
+    Raises:
+      FormatError: If the formatter fails.
+    """
+    formatted, errors = self.FormatContents({filename: text.encode("utf-8")})
+    if errors:
+      raise errors[filename]
+    return formatted[filename].decode("utf-8")
+
+  def FormatContents(
+    self, contents: Dict[str, bytes]
+  ) -> Tuple[Dict[str, bytes], Dict[str, Exception]]:
+    """Run this formatter instance on the contents of many files.
+
+    The contents are written to scratch files in a single directory, so that a
+    batched formatter formats them in as few runs as it can. The formatted
+    contents are read back as bytes, so line endings are preserved. This method
+    is not thread safe.
+
+    Args:
+      contents: A map from relative paths, which are used to feed the inputs
+        to the formatter, to the contents of the files.
+
+    Returns:
+      A tuple of a map from relative paths to formatted contents, and a map
+      from relative paths to the errors raised formatting them.
+    """
+    with tempfile.TemporaryDirectory(
+      prefix="format_", dir=self.cache_path
+    ) as d:
+      paths: Dict[pathlib.Path, str] = {}
+      for relpath, data in contents.items():
+        path = pathlib.Path(d) / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        paths[path] = relpath
 
-      actions = [formatter(path), formatter.Finalize()]
+      actions = [self(path) for path in paths] + [self.Finalize()]
 
-      # Run the actions and propagate errors.
+      succeeded = set()
+      action_errors = []
       for action in actions:
         if action:
-          _, _, errors = action()
-          if errors:
-            raise errors[0]
+          action_paths, _, errors = action()
+          succeeded.update(action_paths)
+          action_errors += errors
+
+      formatted: Dict[str, bytes] = {
+        relpath: path.read_bytes()
+        for path, relpath in paths.items()
+        if path in succeeded
+      }
+      failed = {
+        path: relpath
+        for path, relpath in paths.items()
+        if path not in succeeded
+      }
+
+      # Errors are attributed to the failed files that their messages name.
+      # An action may report fewer errors than failed files, or errors in any
+      # order, so the remaining errors are reported against every failed file
+      # that is not named by an error.
+      errors: Dict[str, Exception] = {}
+      unattributed: List[Exception] = []
+      for error in action_errors:
+        named = [path for path in failed if str(path) in str(error)]
+        for path in named:
+          errors.setdefault(failed[path], error)
+        if not named:
+          unattributed.append(error)
+      for relpath in failed.values():
+        if relpath in errors:
+          continue
+        if len(unattributed) == 1:
+          errors[relpath] = unattributed[0]
+        else:
+          errors[relpath] = self.FormatError(
+            "\n    ".join(
+              [f"Error formatting: {relpath}"]
+              + [str(error) for error in unattributed]
+            )
+          )
+      return formatted, errors
 
-      return fs.Read(path)
+  @classmethod
+  def GetTimeout(cls) -> Optional[float]:
+    """Return the timeout for subprocesses of this formatter, in seconds.
+
+    Returns:
+      The timeout, or None if subprocesses may run indefinitely.
+    """
+    timeout = FLAGS.formatter_timeout
+    for name_and_timeout in FLAGS.formatter_timeouts:
+      name, value = name_and_timeout.split("=")
+      if name == cls.__name__:
+        timeout = float(value)
+    return timeout or None
 
   def _Exec(self, cmd: List[str], env: Optional[Dict[str, str]] = None):
     """Run the given command silently.
@@ -175,30 +354,90 @@ class BaseFormatter(object):
     At log level 3 and above, the command that is executed is logged. At log
     level 5 and above, both the command and its output are logged.
 
+    The command is run in a new process group, which is killed if the command
+    runs for longer than GetTimeout() seconds. Resource limits on the command
+    are set by --formatter_max_memory_mb and --formatter_max_cpu_seconds.
+
     Args:
       cmd: A list of arguments to subprocess.Popen().
 
     Raises:
+      FormatTimeoutError: If the command times out.
       FormatError: If the command fails.
     """
     if app.GetVerbosity() >= 3 and app.GetVerbosity() < 5:
       app.Log(3, "EXEC $ %s", " ".join(str(x) for x in cmd))
 
-    process = subprocess.Popen(
-      cmd,
-      stdout=subprocess.PIPE,
-      stderr=subprocess.STDOUT,
-      universal_newlines=True,
-      env=env,
-    )
-    stdout, _ = process.communicate()
+    timeout = self.GetTimeout()
+    run = exec_hook.get() or _ExecSubprocess
+    try:
+      returncode, stdout = run(cmd, env, timeout, _GetResourceLimiter())
+    except subprocess.TimeoutExpired:
+      raise self.FormatTimeoutError(
+        f"Formatter timed out after {timeout:.0f} seconds: "
+        f"{' '.join(str(x) for x in cmd)}"
+      )
 
     if app.GetVerbosity() >= 5:
       app.Log(5, "EXEC $ %s\n%s", " ".join(str(x) for x in cmd), stdout)
 
-    if process.returncode:
+    if returncode:
       raise self.FormatError(stdout)
 
+  def _WriteIfChanged(
+    self,
+    path: pathlib.Path,
+    chunks: Iterable[Union[str, bytes]],
+    fsync: bool = False,
+  ) -> bool:
+    """Replace the contents of a file, if they differ.
+
+    This is a utility function for implementing formatters. Formatters should
+    not write files that they have not changed, since the format executor uses
+    file mtimes to determine if a file is modified.
+
+    The new contents are compared against the file as they are produced, so
+    that the file does not need to be read into memory. Once they diverge, the
+    file is atomically replaced with the new contents, preserving its
+    permissions. If the chunks iterable raises an error, the file is not
+    modified.
+
+    Args:
+      path: The path of the file.
+      chunks: The new contents of the file, as an iterable of chunks. Text
+        chunks are UTF-8 encoded.
+      fsync: If true, flush the new file to disk before returning.
+
+    Returns:
+      True if the file was written, else False.
+    """
+    chunks = _Coalesce(
+      chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+      for chunk in chunks
+    )
+    with open(path, "rb") as original:
+      matched_bytes = 0
+      for chunk in chunks:
+        if original.read(len(chunk)) != chunk:
+          contents = itertools.chain(
+            _ReadPrefix(original, matched_bytes), [chunk], chunks
+          )
+          break
+        matched_bytes += len(chunk)
+      else:
+        # The new contents may be a prefix of the file.
+        if not original.read(1):
+          return False
+        contents = _ReadPrefix(original, matched_bytes)
+
+      fs.AtomicWrite(
+        path,
+        contents,
+        mode=stat.S_IMODE(os.fstat(original.fileno()).st_mode),
+        fsync=fsync,
+      )
+    return True
+
   def _Which(self, name: str, install_instructions: Optional[str] = None):
     """Lookup the absolute path of a binary. If not found, abort.
 
@@ -226,3 +465,98 @@ class BaseFormatter(object):
         "dependencies. See INSTALL.md."
       )
     raise self.InitError(error)
+
+
+def _ExecSubprocess(
+  cmd: List[str],
+  env: Optional[Dict[str, str]],
+  timeout: Optional[float],
+  preexec_fn: Optional[Callable[[], None]],
+) -> Tuple[int, str]:
+  """Run a command in a new session, and return its returncode and output.
+
+  Raises:
+    subprocess.TimeoutExpired: If the command times out, after its process
+      group has been killed.
+  """
+  process = subprocess.Popen(
+    cmd,
+    stdout=subprocess.PIPE,
+    stderr=subprocess.STDOUT,
+    universal_newlines=True,
+    env=env,
+    start_new_session=True,
+    preexec_fn=preexec_fn,
+  )
+  try:
+    stdout, _ = process.communicate(timeout=timeout)
+  except BaseException:
+    # Kill the entire process group, since the command may have spawned
+    # children of its own.
+    _KillProcessGroup(process)
+    raise
+  return process.returncode, stdout
+
+
+def _GetResourceLimiter() -> Optional[Callable[[], None]]:
+  """Return a function which sets the resource limits of a subprocess.
+
+  Returns:
+    A function to call in the child process before exec, or None if no limits
+    are set by --formatter_max_memory_mb or --formatter_max_cpu_seconds.
+  """
+  if FLAGS.formatter_max_memory_mb or FLAGS.formatter_max_cpu_seconds:
+    return functools.partial(
+      _SetResourceLimits,
+      FLAGS.formatter_max_memory_mb * 1024 * 1024,
+      FLAGS.formatter_max_cpu_seconds,
+    )
+
+
+def _SetResourceLimits(max_memory_bytes: int, max_cpu_seconds: int) -> None:
+  """Set the resource limits of a formatter subprocess.
+
+  This is called in the child process between fork() and exec(), so it must not
+  acquire any locks.
+  """
+  if max_memory_bytes:
+    resource.setrlimit(resource.RLIMIT_AS, (max_memory_bytes, max_memory_bytes))
+  if max_cpu_seconds:
+    resource.setrlimit(resource.RLIMIT_CPU, (max_cpu_seconds, max_cpu_seconds))
+
+
+def _KillProcessGroup(process: subprocess.Popen) -> None:
+  """Kill a process and all members of its process group, and reap it."""
+  try:
+    os.killpg(process.pid, signal.SIGKILL)
+  except ProcessLookupError:
+    pass
+  process.communicate()
+
+
+# The size of chunks that are compared by BaseFormatter._WriteIfChanged().
+_CHUNK_SIZE = 64 * 1024
+
+
+def _Coalesce(chunks: Iterable[bytes]) -> Iterator[bytes]:
+  """Concatenate a stream of small chunks into chunks of at least _CHUNK_SIZE."""
+  buffer, size = [], 0
+  for chunk in chunks:
+    buffer.append(chunk)
+    size += len(chunk)
+    if size >= _CHUNK_SIZE:
+      yield b"".join(buffer)
+      buffer, size = [], 0
+  if buffer:
+    yield b"".join(buffer)
+
+
+def _ReadPrefix(f: BinaryIO, size: int) -> Iterator[bytes]:
+  """Read the first bytes of a file in chunks."""
+  f.seek(0)
+  while size:
+    chunk = f.read(min(size, _CHUNK_SIZE))
+    if not chunk:
+      break
+    yield chunk
+    size -= len(chunk)
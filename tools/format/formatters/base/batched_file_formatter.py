@@ -101,6 +101,25 @@ class BatchedFileFormatter(file_formatter.FileFormatter):
     """
     try:
       self.RunManyWithLog(paths)
+    except self.FormatTimeoutError as e:
+      # A timed out batch is not bisected, since every half which contains
+      # the file responsible would run until the timeout again. Instead, run
+      # the files one at a time, so that isolating the file costs only one
+      # more timeout.
+      if len(paths) == 1:
+        return [], [], [e]
+      app.Log(
+        2, "TIMEOUT on %s with %s files", type(self).__name__, len(paths)
+      )
+      outcomes = [[], [], []]
+      for path, cached_mtime in zip(paths, cached_mtimes):
+        try:
+          self.RunManyWithLog([path])
+          outcomes[0].append(path)
+          outcomes[1].append(cached_mtime)
+        except self.FormatError as e:
+          outcomes[2].append(e)
+      return tuple(outcomes)
     except self.FormatError as e:
       # Because multiple files have been processed, and a failure may be caused
       # by any one (or multiple) of them, we perform a divide-and-conquer on
@@ -19,6 +19,9 @@ from tools.format.formatters.base import batched_file_formatter
 class FormatJava(batched_file_formatter.BatchedFileFormatter):
   """Format Java sources."""
 
+  # Starting a JVM is expensive.
+  expected_seconds_per_action = 2
+
   def __init__(self, *args, **kwargs):
     super(FormatJava, self).__init__(*args, **kwargs)
     self.java = self._Which("java")
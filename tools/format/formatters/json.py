@@ -13,32 +13,182 @@
 # limitations under the License.
 """This module defines a formatter for JSON files."""
 import json
+import os
+import pathlib
+import re
+from typing import Iterator
+from typing import TextIO
 
 from tools.format.formatters.base import file_formatter
 
 
 class FormatJson(file_formatter.FileFormatter):
-  """Format JSON files."""
+  """Format JSON files.
+
+  The formatted output is that of json.dumps(data, indent=2, sort_keys=True).
+
+  Small files are parsed and serialized in memory. Files larger than
+  streaming_threshold bytes are instead tokenized incrementally and formatted
+  as a stream. Arrays, which make up the bulk of most large JSON datasets, are
+  formatted element by element, so that memory usage is bounded by the size of
+  the largest element rather than the size of the file.
+  """
+
+  # The size of file, in bytes, above which files are formatted by streaming.
+  streaming_threshold = 16 * 1024 * 1024
 
   def RunOne(self, path):
     """Format a json file."""
-    # First, read the entire file into memory, then parse the JSON and serialize
-    # it a formatted string. Compare the input and output strings and, if they
-    # are not equal, write the formatted string.
+    # The formatted output is compared chunk by chunk against the contents of
+    # the file, and the file is only rewritten if they differ.
     #
     # We do this comparison rather than unconditionally writing the formatted
     # JSON output because otherwise the mtime of this file would always change
     # with every call to this function, even if the file contents remain the
     # same. This would create unnecessary mtime cache misses.
-    with open(path, "r+") as f:
-      text = f.read()
+    try:
+      if os.path.getsize(path) > self.streaming_threshold:
+        chunks = _FormatStream(path)
+      else:
+        with open(path, encoding="utf-8") as f:
+          data = json.load(f)
+        chunks = [json.dumps(data, indent=2, sort_keys=True), "\n"]
+      self._WriteIfChanged(path, chunks)
+    except ValueError as e:
+      raise self.FormatError(
+        f"Failed to parse JSON: {path}\n    Parser error: {e}"
+      )
+
+
+# The size of chunks that are read by the streaming tokenizer.
+_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_NUMBER_CHARS = re.compile(r"[-+.0-9eE]*")
+
+# The length of the longest literal, "-Infinity".
+_MAX_LITERAL_LENGTH = 9
+
+_DECODER = json.JSONDecoder()
+
+
+class _Tokenizer(object):
+  """An incremental tokenizer over a text file containing JSON.
+
+  The tokenizer holds a buffer of the unconsumed input, which is refilled from
+  the file as required. Only a single value needs to fit in the buffer at a
+  time.
+  """
+
+  def __init__(self, f: TextIO):
+    self.f = f
+    self.buf = ""
+    # The position of the next unconsumed character in the buffer.
+    self.pos = 0
+    # The offset of the start of the buffer into the file.
+    self.offset = 0
+
+  def Fill(self) -> bool:
+    """Discard the consumed input and read more. Return False at end of file."""
+    # Read at least as much as is already buffered so that a long value is
+    # read in a logarithmic number of passes.
+    chunk = self.f.read(max(_CHUNK_SIZE, len(self.buf) - self.pos))
+    if not chunk:
+      return False
+    self.offset += self.pos
+    self.buf = self.buf[self.pos :] + chunk
+    self.pos = 0
+    return True
+
+  def Error(self, message: str, pos: int):
+    """Raise a parser error at the given position in the buffer."""
+    raise ValueError(f"{message}: char {self.offset + pos}")
+
+  def Peek(self) -> str:
+    """Skip whitespace and return the next character, or '' at end of file."""
+    while True:
+      self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+      if self.pos < len(self.buf):
+        return self.buf[self.pos]
+      if not self.Fill():
+        return ""
+
+  def Decode(self):
+    """Consume a value and return it.
+
+    The value is decoded by the json module's scanner, which is much faster
+    than tokenizing it ourselves.
+    """
+    while True:
       try:
-        data = json.loads(text)
-      except json.decoder.JSONDecodeError as e:
-        raise self.FormatError(
-          f"Failed to parse JSON: {path}\n    Parser error: {e}"
-        )
-      formatted_text = json.dumps(data, indent=2, sort_keys=True) + "\n"
-      if text != formatted_text:
-        f.seek(0)
-        f.write(formatted_text)
+        value, end = _DECODER.raw_decode(self.buf, self.pos)
+      except json.JSONDecodeError as e:
+        # An error may be caused by the value being truncated by the end of
+        # the buffer, in which case we read more and try again.
+        if self._MaybeTruncated(e) and self.Fill():
+          continue
+        self.Error(e.msg, e.pos)
+      # A number which runs to the end of the buffer may continue in the file.
+      if (
+        _NUMBER_CHARS.match(self.buf, end).end() == len(self.buf)
+        and self.Fill()
+      ):
+        continue
+      self.pos = end
+      return value
+
+  def _MaybeTruncated(self, error: json.JSONDecodeError) -> bool:
+    """Return whether a decoder error may be caused by the end of the buffer."""
+    return (
+      error.msg.startswith("Unterminated string")
+      or len(self.buf) - error.pos <= _MAX_LITERAL_LENGTH
+      or _NUMBER_CHARS.match(self.buf, error.pos).end() == len(self.buf)
+    )
+
+
+def _FormatStream(path: pathlib.Path) -> Iterator[str]:
+  """Format a JSON file as a stream of chunks of text."""
+  with open(path, encoding="utf-8", newline="") as f:
+    tokenizer = _Tokenizer(f)
+    yield from _FormatValue(tokenizer, 0)
+    if tokenizer.Peek():
+      tokenizer.Error("Extra data", tokenizer.pos)
+    yield "\n"
+
+
+def _FormatValue(tokenizer: _Tokenizer, depth: int) -> Iterator[str]:
+  """Consume a value and yield its formatted text.
+
+  Arrays are formatted element by element. Any other value is decoded in full
+  and formatted by the json module.
+  """
+  if tokenizer.Peek() == "[":
+    yield from _FormatArray(tokenizer, depth)
+  else:
+    text = json.dumps(tokenizer.Decode(), indent=2, sort_keys=True)
+    # The serialized text of a JSON value cannot contain a literal newline
+    # except as indentation, so it can be indented by text substitution.
+    yield text.replace("\n", "\n" + "  " * depth) if depth else text
+
+
+def _FormatArray(tokenizer: _Tokenizer, depth: int) -> Iterator[str]:
+  """Consume an array and yield its formatted text, element by element."""
+  tokenizer.pos += 1
+  if tokenizer.Peek() == "]":
+    tokenizer.pos += 1
+    yield "[]"
+    return
+
+  newline_indent = "\n" + "  " * (depth + 1)
+  yield "[" + newline_indent
+  while True:
+    yield from _FormatValue(tokenizer, depth + 1)
+    c = tokenizer.Peek()
+    if c == "]":
+      tokenizer.pos += 1
+      break
+    elif c != ",":
+      tokenizer.Error("Expecting ',' delimiter", tokenizer.pos)
+    tokenizer.pos += 1
+    yield "," + newline_indent
+  yield "\n" + "  " * depth + "]"
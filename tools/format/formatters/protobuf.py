@@ -35,6 +35,9 @@ class FormatProtobuf(file_formatter.FileFormatter):
 
   assumed_filename = "input.proto"
 
+  # Each file is processed by two runs of prototool.
+  expected_seconds_per_action = 0.5
+
   def __init__(self, *args, **kwargs):
     super(FormatProtobuf, self).__init__(*args, **kwargs)
 
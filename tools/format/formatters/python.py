@@ -24,6 +24,9 @@ from tools.format.formatters.base import batched_file_formatter
 class FormatPython(batched_file_formatter.BatchedFileFormatter):
   """Format Python sources."""
 
+  # Each batch is processed by two Python interpreters.
+  expected_seconds_per_action = 0.5
+
   def __init__(self, *args, **kwargs):
     super(FormatPython, self).__init__(*args, **kwargs)
 
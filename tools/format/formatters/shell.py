@@ -12,7 +12,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """This module defines a formatter for shell (i.e. bash, bats) sources."""
+import pathlib
+import re
 import sys
+import tempfile
+from typing import List
 
 from labm8.py import bazelutil
 from tools.format.formatters.base import batched_file_formatter
@@ -26,26 +30,55 @@ class FormatShell(batched_file_formatter.BatchedFileFormatter):
     arch = "mac" if sys.platform == "darwin" else "linux"
     self.shfmt = bazelutil.DataPath(f"shfmt_{arch}/file/shfmt")
 
-  def RunMany(self, paths):
-    # To enable shfmt to parse bats tests we must insert a newline before the
-    # opening brace.
-    # See https://www.gitmemory.com/issue/bats-core/bats-core/192/528315083
+  def RunMany(self, paths: List[pathlib.Path]):
     bats_paths = [p for p in paths if p.suffix == ".bats"]
-    if bats_paths:
-      error = self._Exec(
-        ["perl", "-pi", "-e", "s/^(\@test.*) \{$/$1\n{/"] + bats_paths
-      )
-      if error:
-        return error
-
-    error = self._Exec([self.shfmt, "-i", "2", "-ci", "-w"] + paths)
-    if error:
-      return error
-
-    # Reverse the temporary reformatting of bats tests.
-    if bats_paths:
-      error = self._Exec(
-        ["perl", "-pi", "-e", "s/^\{\R//; s/(\@test.*$)/$1 {/"] + bats_paths
-      )
-      if error:
-        return error
+    if not bats_paths:
+      self._Exec([self.shfmt, "-i", "2", "-ci", "-w"] + paths)
+      return
+
+    # Bats tests are formatted as temporary copies which have been
+    # pre-processed so that shfmt can parse them. The formatted copies are
+    # then post-processed and written back only if they differ from the
+    # original.
+    with tempfile.TemporaryDirectory(
+      prefix="format_shell_", dir=self.cache_path
+    ) as d:
+      bats_copies = []
+      for i, path in enumerate(bats_paths):
+        copy = pathlib.Path(d) / str(i) / path.name
+        copy.parent.mkdir()
+        copy.write_bytes(_PreprocessBats(path.read_bytes()))
+        bats_copies.append(copy)
+
+      try:
+        self._Exec(
+          [self.shfmt, "-i", "2", "-ci", "-w"]
+          + [p for p in paths if p.suffix != ".bats"]
+          + bats_copies
+        )
+      except self.FormatError as e:
+        # Report errors against the original paths, not the copies.
+        message = str(e)
+        for path, copy in zip(bats_paths, bats_copies):
+          message = message.replace(str(copy), str(path))
+        raise self.FormatError(message)
+
+      for path, copy in zip(bats_paths, bats_copies):
+        self._WriteIfChanged(path, [_PostprocessBats(copy.read_bytes())])
+
+
+# To enable shfmt to parse bats tests we must insert a newline before the
+# opening brace of each test, and remove it again after formatting.
+# See https://www.gitmemory.com/issue/bats-core/bats-core/192/528315083
+_BATS_TEST_RE = re.compile(rb"^(@test.*) \{$", re.MULTILINE)
+_SHFMT_BATS_TEST_RE = re.compile(rb"^(@test.*)\n\{\n", re.MULTILINE)
+
+
+def _PreprocessBats(text: bytes) -> bytes:
+  """Prepare the text of a bats file for formatting with shfmt."""
+  return _BATS_TEST_RE.sub(rb"\1\n{", text)
+
+
+def _PostprocessBats(text: bytes) -> bytes:
+  """Reverse the preprocessing of a bats file formatted by shfmt."""
+  return _SHFMT_BATS_TEST_RE.sub(rb"\1 {\n", text)
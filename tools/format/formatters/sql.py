@@ -12,26 +12,153 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """This module defines a formatter for SQL sources."""
-import sqlparse
+import concurrent.futures
+import multiprocessing
+import threading
+from typing import List
+from typing import Optional
+from typing import Tuple
+
 from labm8.py import fs
+from sqlparse import engine
+from sqlparse import filters
+from sqlparse import formatter
 from tools.format.formatters.base import file_formatter
 
 
 class FormatSql(file_formatter.FileFormatter):
-  """Format SQL files."""
+  """Format SQL files.
+
+  sqlparse is pure Python and its runtime grows superlinearly with the size of
+  its input, so large files are split into top-level statements which are
+  formatted in parallel by a pool of worker processes. The output is identical
+  to that of formatting the entire file in a single call to sqlparse.format().
+  """
 
-  def __init__(self, *args, **kwargs):
-    super(FormatSql, self).__init__(*args, **kwargs)
+  # The size of file, in characters, above which statements are formatted in
+  # parallel.
+  parallel_threshold = 128 * 1024
+  # The approximate number of characters of statements to format in a single
+  # job.
+  chunk_size = 32 * 1024
 
   def RunOne(self, path):
-    try:
-      formatted = (
-        sqlparse.format(
-          fs.Read(path), reindent=True, keyword_case="upper"
-        ).rstrip()
-        + "\n"
+    text = fs.Read(path)
+    if len(text) > self.parallel_threshold:
+      chunks = _Chunk(_SplitStatements(text), self.chunk_size)
+      results = _GetProcessPool().map(_FormatStatements, chunks)
+    else:
+      chunks = [[text]]
+      results = map(_FormatStatements, chunks)
+
+    formatted = []
+    # Whether the previous statement ended with a newline, or None if there is
+    # no previous statement.
+    last_ends_with_newline = None
+    # The offset of the current chunk into the text.
+    offset = 0
+    for chunk in chunks:
+      try:
+        chunk_text, ends_with_newline = next(results)
+      except _StatementError as e:
+        statement_offset = offset + sum(
+          len(s) for s in _SplitStatements("".join(chunk))[: e.index]
+        )
+        line = text.count("\n", 0, statement_offset) + 1
+        raise self.FormatError(
+          f"sqlparse failed for: {path}\n"
+          f"    Statement at line {line} (offset {statement_offset}): "
+          f"{e.message}"
+        )
+      if ends_with_newline is not None:
+        # Separate statements in the same way as sqlparse's reindent filter.
+        if last_ends_with_newline is not None:
+          formatted.append("\n" if last_ends_with_newline else "\n\n")
+        formatted.append(chunk_text)
+        last_ends_with_newline = ends_with_newline
+      offset += sum(len(s) for s in chunk)
+
+    self._WriteIfChanged(path, ["".join(formatted).rstrip(), "\n"])
+
+
+# The options passed to sqlparse.format().
+_OPTIONS = formatter.validate_options({"reindent": True, "keyword_case": "upper"})
+
+# A pool of worker processes for formatting statements, shared by all
+# instances of the formatter.
+_process_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+_process_pool_lock = threading.Lock()
+
+
+class _StatementError(Exception):
+  """An error raised by sqlparse while formatting a statement."""
+
+  def __init__(self, index: int, message: str):
+    super(_StatementError, self).__init__(index, message)
+    # The index of the statement within the formatted text.
+    self.index = index
+    self.message = message
+
+
+def _GetProcessPool() -> concurrent.futures.ProcessPoolExecutor:
+  """Return the shared pool of worker processes, creating it if required."""
+  global _process_pool
+  with _process_pool_lock:
+    if _process_pool is None:
+      # Worker processes are spawned rather than forked, since the formatter
+      # runs in a multithreaded process.
+      _process_pool = concurrent.futures.ProcessPoolExecutor(
+        mp_context=multiprocessing.get_context("spawn")
       )
-    except:
-      return f"sqlparse failed for: {path}"
+    return _process_pool
+
+
+def _SplitStatements(text: str) -> List[str]:
+  """Split text into top-level statements.
+
+  This is sqlparse.split() without stripping the statements, so that
+  "".join(_SplitStatements(text)) == text.
+  """
+  return [str(statement) for statement in engine.FilterStack().run(text)]
+
+
+def _Chunk(statements: List[str], chunk_size: int) -> List[List[str]]:
+  """Group consecutive statements into chunks of at least chunk_size chars."""
+  chunks, chunk, size = [], [], 0
+  for statement in statements:
+    chunk.append(statement)
+    size += len(statement)
+    if size >= chunk_size:
+      chunks.append(chunk)
+      chunk, size = [], 0
+  if chunk:
+    chunks.append(chunk)
+  return chunks
+
+
+def _FormatStatements(statements: List[str]) -> Tuple[str, Optional[bool]]:
+  """Format a list of consecutive statements.
+
+  This is the equivalent of sqlparse.format(), but additionally returns whether
+  the last statement ended with a newline, which sqlparse uses to determine
+  the separator before the next statement.
+
+  Returns:
+    A tuple of the formatted text, and whether the last statement ended with a
+    newline, or None if there were no statements.
 
-    fs.Write(path, formatted.encode("utf-8"))
+  Raises:
+    _StatementError: If sqlparse fails.
+  """
+  stack = formatter.build_filter_stack(engine.FilterStack(), dict(_OPTIONS))
+  formatted = []
+  statement = None
+  try:
+    for statement in stack.run("".join(statements)):
+      formatted.append(filters.SerializerUnicode.process(statement))
+  except Exception as e:
+    raise _StatementError(len(formatted), f"{type(e).__name__}: {e}")
+  return (
+    "".join(formatted),
+    str(statement).endswith("\n") if statement is not None else None,
+  )
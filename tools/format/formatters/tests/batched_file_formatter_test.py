@@ -0,0 +1,160 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format/formatters/base:batched_file_formatter."""
+import pathlib
+import time
+from typing import List
+
+from labm8.py import test
+from tools.format.formatters.base import base_formatter
+from tools.format.formatters.base import batched_file_formatter
+
+FLAGS = test.FLAGS
+
+
+class FormatSlow(batched_file_formatter.BatchedFileFormatter):
+  """A formatter which hangs on any file named "slow"."""
+
+  def __init__(self, *args, **kwargs):
+    super(FormatSlow, self).__init__(*args, **kwargs)
+    # The batches passed to RunMany().
+    self.batches: List[List[pathlib.Path]] = []
+
+  def RunMany(self, paths: List[pathlib.Path]) -> None:
+    self.batches.append(paths)
+    self._Exec(
+      [
+        "sh",
+        "-c",
+        'for f in "$@"; do case $f in *slow) sleep 60;; esac; done',
+        "sh",
+      ]
+      + paths
+    )
+
+
+class FormatUpper(batched_file_formatter.BatchedFileFormatter):
+  """A formatter which converts files to upper case, and fails on "bad"."""
+
+  def __init__(self, *args, **kwargs):
+    super(FormatUpper, self).__init__(*args, **kwargs)
+    # The batches passed to RunMany().
+    self.batches: List[List[pathlib.Path]] = []
+
+  def RunMany(self, paths: List[pathlib.Path]) -> None:
+    self.batches.append(paths)
+    for path in paths:
+      if path.name == "bad":
+        raise self.FormatError(f"Bad file: {path}")
+    for path in paths:
+      path.write_bytes(path.read_bytes().upper())
+
+
+@test.Fixture(scope="function")
+def timeout():
+  """Set a short formatter timeout for the duration of a test."""
+  old_timeout = FLAGS.formatter_timeout
+  FLAGS.formatter_timeout = 1
+  yield
+  FLAGS.formatter_timeout = old_timeout
+
+
+def test_GetTimeout_per_formatter_override():
+  old_timeouts = FLAGS.formatter_timeouts
+  FLAGS.formatter_timeouts = ["FormatFoo=10", "FormatSlow=5.5"]
+  try:
+    assert FormatSlow.GetTimeout() == 5.5
+  finally:
+    FLAGS.formatter_timeouts = old_timeouts
+
+
+def test_Action_timed_out_file_is_isolated(timeout, tempdir: pathlib.Path):
+  formatter = FormatSlow(tempdir)
+  paths = [tempdir / name for name in ["a", "b", "slow", "c"]]
+
+  start_time = time.time()
+  succeeded, _, errors = formatter.Action(paths, [None] * len(paths))
+
+  assert time.time() - start_time < 30
+  assert succeeded == [tempdir / "a", tempdir / "b", tempdir / "c"]
+  assert len(errors) == 1
+  assert isinstance(errors[0], FormatSlow.FormatTimeoutError)
+  assert str(tempdir / "slow") in str(errors[0])
+  # The hung file timed out twice: once in the batch, and once alone.
+  assert sum(tempdir / "slow" in batch for batch in formatter.batches) == 2
+
+
+def test_FormatText_preserves_line_endings(tempdir: pathlib.Path):
+  formatter = FormatUpper(tempdir)
+  assert formatter.FormatText("a\r\nb\rc\n", "text") == "A\r\nB\rC\n"
+
+
+def test_FormatContents_formats_files_in_one_batch(tempdir: pathlib.Path):
+  formatter = FormatUpper(tempdir)
+  formatted, errors = formatter.FormatContents(
+    {"a": b"a\n", "b/c": b"c\r\n", "b/d/e": b"e"}
+  )
+  assert formatted == {"a": b"A\n", "b/c": b"C\r\n", "b/d/e": b"E"}
+  assert errors == {}
+  assert len(formatter.batches) == 1
+
+
+def test_FormatContents_errors(tempdir: pathlib.Path):
+  formatter = FormatUpper(tempdir)
+  formatted, errors = formatter.FormatContents(
+    {"a": b"a", "b/bad": b"bad", "c": b"c"}
+  )
+  assert formatted == {"a": b"A", "c": b"C"}
+  assert list(errors) == ["b/bad"]
+  assert isinstance(errors["b/bad"], FormatUpper.FormatError)
+
+
+class FormatReversedErrors(base_formatter.BaseFormatter):
+  """A formatter which fails every file, and reports the errors in reverse
+  order, without naming the file "unnamed"."""
+
+  def __init__(self, *args, **kwargs):
+    super(FormatReversedErrors, self).__init__(*args, **kwargs)
+    self.paths: List[pathlib.Path] = []
+
+  def __call__(self, path: pathlib.Path, cached_mtime=None):
+    self.paths.append(path)
+
+  def Finalize(self):
+    errors = [
+      self.FormatError(
+        "Batch failed" if path.name == "unnamed" else f"Bad file: {path}"
+      )
+      for path in reversed(self.paths)
+    ]
+    return lambda: ([], [], errors)
+
+
+def test_FormatContents_attributes_errors_by_path(tempdir: pathlib.Path):
+  formatter = FormatReversedErrors(tempdir)
+  _, errors = formatter.FormatContents(
+    {"a": b"", "b": b"", "c/unnamed": b"", "d/unnamed": b""}
+  )
+  assert str(errors["a"]).startswith("Bad file: ")
+  assert str(errors["a"]).endswith("/a")
+  assert str(errors["b"]).endswith("/b")
+  # The errors which do not name a file are reported against the files which
+  # are not named by any error.
+  for relpath in ("c/unnamed", "d/unnamed"):
+    assert str(errors[relpath]).count("Batch failed") == 2
+    assert relpath in str(errors[relpath])
+
+
+if __name__ == "__main__":
+  test.Main()
@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Unit tests for //tools/format/formatters:json."""
+import os
+import pathlib
+
 from labm8.py import test
 from tools.format.formatters import json
 
@@ -44,5 +47,56 @@ def test_small_json_array():
   )
 
 
+class FormatJsonStreaming(json.FormatJson):
+  """A JSON formatter which formats every file by streaming."""
+
+  streaming_threshold = -1
+
+
+def test_streaming_empty_json_file():
+  with test.Raises(json.FormatJson.FormatError):
+    FormatJsonStreaming.Format("")
+
+
+def test_streaming_extra_data():
+  with test.Raises(json.FormatJson.FormatError):
+    FormatJsonStreaming.Format("[1] [2]")
+
+
+def test_streaming_matches_in_memory():
+  text = """\
+[1, -2.5e3, "a\\"b\u00e9", null, true, [[], {}],
+ {"z": {"b": [1, {"y": 2, "x": 1}], "a": NaN}, "a": false}]"""
+  assert FormatJsonStreaming.Format(text) == json.FormatJson.Format(text)
+
+
+@test.Parametrize("formatter_class", (json.FormatJson, FormatJsonStreaming))
+def test_formatted_file_is_not_rewritten(
+  formatter_class, tempdir: pathlib.Path, tempdir2: pathlib.Path
+):
+  path = tempdir2 / "a.json"
+  path.write_text('{\n  "a": [\n    1\n  ]\n}\n')
+  stat = os.stat(path)
+
+  formatter_class(tempdir).RunOne(path)
+
+  assert os.stat(path).st_ino == stat.st_ino
+  assert os.stat(path).st_mtime_ns == stat.st_mtime_ns
+
+
+@test.Parametrize("formatter_class", (json.FormatJson, FormatJsonStreaming))
+def test_shorter_output_is_truncated(
+  formatter_class, tempdir: pathlib.Path, tempdir2: pathlib.Path
+):
+  path = tempdir2 / "a.json"
+  path.write_text("[" + " " * 100 + "1]")
+  path.chmod(0o640)
+
+  formatter_class(tempdir).RunOne(path)
+
+  assert path.read_text() == "[\n  1\n]\n"
+  assert path.stat().st_mode & 0o777 == 0o640
+
+
 if __name__ == "__main__":
   test.Main()
@@ -18,6 +18,30 @@ from tools.format.formatters import shell
 FLAGS = test.FLAGS
 
 
+@test.Parametrize(
+  "text",
+  [
+    b"",
+    b"#!/usr/bin/env bash\nfoo() {\n  echo hello\n}\n",
+    b'@test "a" {\n  run a\n}\n\n@test "b { c" {\n  run b\n}\n',
+    b'load helper\n\nsetup() {\n  true\n}\n\n@test "a" {\n  true\n}',
+  ],
+)
+def test_PreprocessBats_PostprocessBats_roundtrip(text: bytes):
+  """Test that bats pre-processing is reversed, without running shfmt."""
+  assert shell._PostprocessBats(shell._PreprocessBats(text)) == text
+
+
+def test_PreprocessBats():
+  assert shell._PreprocessBats(b'@test "a" {\n  true\n}\n') == (
+    b'@test "a"\n{\n  true\n}\n'
+  )
+  # Files without tests are not modified.
+  assert shell._PreprocessBats(b"foo() {\n  true\n}\n") == (
+    b"foo() {\n  true\n}\n"
+  )
+
+
 def test_small_shell_program():
   """Test pre-processing a small shell program."""
   text = shell.FormatShell.Format(
@@ -53,5 +53,26 @@ FROM foo;
   )
 
 
+class FormatSqlParallel(sql.FormatSql):
+  """A SQL formatter which formats every statement in a separate job."""
+
+  parallel_threshold = -1
+  chunk_size = 1
+
+
+def test_parallel_format_matches_serial():
+  text = """\
+-- A comment.
+select a,b from t where x=1;
+insert into t values (1,'a;b');   /* c */
+
+create table foo (a int, b text);
+BEGIN;
+update t set a=1 where b in (select c from d);
+END;
+select 1"""
+  assert FormatSqlParallel.Format(text) == sql.FormatSql.Format(text)
+
+
 if __name__ == "__main__":
   test.Main()
@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Unit tests for //tools/format/formatters:text."""
+import os
+import pathlib
+
 from labm8.py import test
 from tools.format.formatters import text
 
@@ -30,6 +33,23 @@ def test_add_newline():
   assert text.FormatText.Format("Hello") == "Hello\n"
 
 
+def test_strip_carriage_returns():
+  assert text.FormatText.Format("Hello\r\nWorld \r\n") == "Hello\nWorld\n"
+
+
+def test_formatted_file_is_not_rewritten(
+  tempdir: pathlib.Path, tempdir2: pathlib.Path
+):
+  path = tempdir2 / "a.txt"
+  path.write_text("Hello\nWorld\n")
+  stat = os.stat(path)
+
+  text.FormatText(tempdir).RunOne(path)
+
+  assert os.stat(path).st_ino == stat.st_ino
+  assert os.stat(path).st_mtime_ns == stat.st_mtime_ns
+
+
 @test.XFail(reason="I have not yet implemented EOF clean-up")
 def test_multiple_newlines_at_end_of_file():
   assert text.FormatText.Format("Hello\n\n") == "Hello\n"
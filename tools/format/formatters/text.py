@@ -11,40 +11,19 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""This module defines a formatter for JSON files."""
-import subprocess
-import tempfile
-
+"""This module defines a formatter for text files."""
 from tools.format.formatters.base import file_formatter
 
 
 class FormatText(file_formatter.FileFormatter):
-  """Format text files."""
+  """Format text files.
 
-  def __init__(self, *args, **kwargs):
-    super(FormatText, self).__init__(*args, **kwargs)
-    self.sed = self._Which("sed")
+  Trailing whitespace is stripped from every line, and a newline is added to
+  the end of the file if required.
+  """
 
   def RunOne(self, path):
-    with tempfile.NamedTemporaryFile(dir=self.cache_path) as tmpfile:
-      add_newline = subprocess.Popen(
-        [self.sed, "-e", "$a\\"],
-        stdout=tmpfile,
-        stderr=subprocess.DEVNULL,
-        stdin=subprocess.PIPE,
-      )
-      strip_trailing_whitespace = subprocess.Popen(
-        [self.sed, "s/[[:space:]]*$//", str(path)],
-        stdout=add_newline.stdin,
-        stderr=subprocess.DEVNULL,
-      )
-      add_newline.communicate()
-
-      tmpfile.seek(0)
-      with open(path, "wb") as f:
-        f.write(tmpfile.read())
-
-      if strip_trailing_whitespace.returncode:
-        return f"sed 's/[[:space:]]*$//' failed for: {path}"
-      if add_newline.returncode:
-        return f"sed -e '$a\\' failed for: {path}"
+    with open(path, "rb") as f:
+      # Iterating over a file yields lines including their trailing newline,
+      # which is stripped along with any other trailing whitespace.
+      self._WriteIfChanged(path, (line.rstrip() + b"\n" for line in f))
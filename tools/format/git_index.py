@@ -0,0 +1,237 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module defines reading the stat data of files from the git index.
+
+Git records the mtime, size, and other stat data of every tracked file in its
+index, and keeps this data up to date with the working tree. For a file which
+git considers clean, the stat data in the index is the stat data of the file,
+so it can be used in place of a stat() of the file. This lets the formatter
+determine that the files of a clean checkout have not changed since they were
+last formatted without touching the filesystem.
+"""
+import os
+import pathlib
+import struct
+import subprocess
+from typing import Dict
+from typing import Iterable
+from typing import NamedTuple
+from typing import Tuple
+
+from labm8.py import app
+
+FLAGS = app.FLAGS
+
+# The layout of the fixed-size part of an index entry: ctime and mtime seconds
+# and nanoseconds, dev, ino, mode, uid, gid, size, the object hash, and flags.
+_ENTRY = struct.Struct(">10I20sH")
+# Index entry flags.
+_FLAG_ASSUME_VALID = 0x8000
+_FLAG_EXTENDED = 0x4000
+_FLAG_STAGE = 0x3000
+_EXTENDED_FLAG_SKIP_WORKTREE = 0x4000
+# The file type bits of a mode, and the type of a regular file.
+_MODE_TYPE = 0o170000
+_MODE_REGULAR = 0o100000
+
+
+class IndexEntry(NamedTuple):
+  """The stat data of a file in the git index."""
+
+  # The path of the file, relative to the root of the repository.
+  path: str
+  mtime_seconds: int
+  mtime_nanoseconds: int
+  size: int
+  # Whether git compares the file with its stat data. Git does not stat files
+  # which are marked "assume unchanged" or "skip worktree", or which have
+  # unmerged changes.
+  tracked: bool
+  # Whether the file is a regular file.
+  regular: bool
+
+
+def ReadIndex(index_path: pathlib.Path) -> Iterable[IndexEntry]:
+  """Read the entries of a git index file.
+
+  Versions 2, 3, and 4 of the index format are supported.
+
+  Args:
+    index_path: The path of the index file, e.g. ".git/index".
+
+  Returns:
+    An iterator over the entries of the index.
+
+  Raises:
+    ValueError: If the index cannot be parsed.
+  """
+  with open(index_path, "rb") as f:
+    data = f.read()
+  if len(data) < 12 or data[:4] != b"DIRC":
+    raise ValueError(f"Not a git index: {index_path}")
+  version, entry_count = struct.unpack_from(">II", data, 4)
+  if version not in {2, 3, 4}:
+    raise ValueError(f"Unsupported git index version: {version}")
+
+  offset = 12
+  path = b""
+  for _ in range(entry_count):
+    fields = _ENTRY.unpack_from(data, offset)
+    flags = fields[11]
+    start = offset
+    offset += _ENTRY.size
+    extended_flags = 0
+    if flags & _FLAG_EXTENDED:
+      (extended_flags,) = struct.unpack_from(">H", data, offset)
+      offset += 2
+
+    if version == 4:
+      # The path is prefix-compressed against the path of the previous entry:
+      # a varint number of bytes to remove, followed by the NUL-terminated
+      # suffix to append.
+      strip, offset = _ReadVarint(data, offset)
+      end = data.index(b"\0", offset)
+      path = path[: len(path) - strip] + data[offset:end]
+      offset = end + 1
+    else:
+      # The NUL-terminated path is padded with NULs to a multiple of 8 bytes.
+      end = data.index(b"\0", offset)
+      path = data[offset:end]
+      offset = start + ((offset - start + len(path) + 8) & ~7)
+
+    yield IndexEntry(
+      path=os.fsdecode(path),
+      mtime_seconds=fields[2],
+      mtime_nanoseconds=fields[3],
+      size=fields[9],
+      tracked=not (
+        flags & (_FLAG_ASSUME_VALID | _FLAG_STAGE)
+        or extended_flags & _EXTENDED_FLAG_SKIP_WORKTREE
+      ),
+      regular=fields[6] & _MODE_TYPE == _MODE_REGULAR,
+    )
+
+
+def _ReadVarint(data: bytes, offset: int) -> Tuple[int, int]:
+  """Read a git offset varint, and return the value and the new offset."""
+  byte = data[offset]
+  offset += 1
+  value = byte & 0x7F
+  while byte & 0x80:
+    byte = data[offset]
+    offset += 1
+    value = ((value + 1) << 7) | (byte & 0x7F)
+  return value, offset
+
+
+def GetCleanFileStats(
+  directory: pathlib.Path,
+) -> Dict[str, Tuple[int, int]]:
+  """Read the stat data of the clean files in a directory of a git repository.
+
+  Only the files in the directory and its subdirectories are checked, so the
+  cost is proportional to the size of the directory rather than the size of
+  the repository. Files in nested repositories, such as submodules, are not
+  included, since they are recorded in their own index.
+
+  A file is clean if git has found that it is unchanged since it was added to
+  the index. The stat data of a clean file in the index is the stat data of the
+  file on disk. Git determines which files are clean by comparing their stat
+  data, which is fast, and can be avoided entirely if git is configured to use
+  a filesystem monitor.
+
+  Files are excluded if their mtime in the index is not later than the mtime
+  of the index, because git cannot tell if a "racily clean" file was modified
+  in the same clock tick that it was added. Files with a whole number of
+  seconds mtime are excluded, since their mtime may have been truncated.
+
+  Args:
+    directory: A directory in the git repository.
+
+  Returns:
+    A map from the absolute paths of clean files in the directory to a tuple
+    of their mtime, in microseconds, and their size. If the directory is not in
+    a git repository, or the index cannot be read, the map is empty.
+  """
+  try:
+    git_root, prefix, index_path = subprocess.check_output(
+      [
+        "git",
+        "rev-parse",
+        "--show-toplevel",
+        "--show-prefix",
+        "--git-path",
+        "index",
+      ],
+      cwd=directory,
+      universal_newlines=True,
+      stderr=subprocess.DEVNULL,
+    ).splitlines()
+    index_path = pathlib.Path(directory) / index_path
+    index_mtime = os.stat(index_path).st_mtime_ns
+    # The files in the directory which are not clean, relative to the root of
+    # the repository.
+    dirty = set(
+      subprocess.check_output(
+        [
+          "git",
+          "--literal-pathspecs",
+          "diff-files",
+          "--name-only",
+          "-z",
+          "--ignore-submodules=all",
+          "--",
+          prefix or ".",
+        ],
+        cwd=git_root,
+        stderr=subprocess.DEVNULL,
+      )
+      .decode("utf-8", "surrogateescape")
+      .split("\0")[:-1]
+    )
+    entries = list(ReadIndex(index_path))
+  except (
+    IndexError,
+    OSError,
+    ValueError,
+    struct.error,
+    subprocess.CalledProcessError,
+  ) as e:
+    app.Log(1, "Unable to read the git index of %s: %s", directory, e)
+    return {}
+
+  stats = {}
+  for entry in entries:
+    if (
+      entry.path.startswith(prefix)
+      and entry.tracked
+      and entry.regular
+      and entry.mtime_nanoseconds
+      and entry.mtime_seconds * 10 ** 9 + entry.mtime_nanoseconds
+      < index_mtime
+      and entry.path not in dirty
+    ):
+      stats[os.path.join(git_root, entry.path)] = (
+        GetMtime(entry.mtime_seconds, entry.mtime_nanoseconds),
+        entry.size,
+      )
+  app.Log(2, "Read the stat data of %d clean files from git", len(stats))
+  return stats
+
+
+def GetMtime(seconds: int, nanoseconds: int) -> int:
+  """Return an mtime in microseconds, as computed from os.stat().st_mtime."""
+  # This replicates the floating point arithmetic of os.stat(), so that the
+  # mtimes agree with those computed from stat() by the formatter.
+  return int((seconds + nanoseconds * 1e-9) * 1e6)
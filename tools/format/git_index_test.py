@@ -0,0 +1,137 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format:git_index."""
+import os
+import pathlib
+import subprocess
+import time
+
+from labm8.py import test
+from tools.format import git_index
+from tools.format import git_test_util
+from tools.format.git_test_util import Git
+
+FLAGS = test.FLAGS
+
+
+@test.Fixture(scope="function", params=(2, 3, 4))
+def git_repo(request, tempdir: pathlib.Path) -> pathlib.Path:
+  """A git repository with committed files, using each index version."""
+  with git_test_util.GitRepository(tempdir):
+    (tempdir / "dir").mkdir()
+    for relpath in ["a.txt", "dir/b.txt", "dir/c d.txt"]:
+      (tempdir / relpath).write_text(relpath)
+      # Give the files an mtime in the past, so that they are not racily
+      # clean.
+      mtime = time.time() - 60
+      os.utime(tempdir / relpath, (mtime, mtime))
+    os.symlink("a.txt", tempdir / "link")
+    Git("add", ".")
+    Git("commit", "-q", "-m", "initial")
+    if request.param == 3:
+      # Version 3 is used only if an entry has extended flags, such as an
+      # "intent to add" entry.
+      (tempdir / "new.txt").write_text("new")
+      Git("add", "--intent-to-add", "new.txt")
+    Git("update-index", "--index-version", str(request.param))
+    assert (tempdir / ".git/index").read_bytes()[:8] == b"DIRC" + bytes(
+      [0, 0, 0, request.param]
+    )
+    yield tempdir
+
+
+def test_ReadIndex(git_repo: pathlib.Path):
+  entries = {
+    entry.path: entry
+    for entry in git_index.ReadIndex(git_repo / ".git" / "index")
+  }
+
+  assert set(entries) - {"new.txt"} == {
+    "a.txt",
+    "dir/b.txt",
+    "dir/c d.txt",
+    "link",
+  }
+  stat = os.stat(git_repo / "dir/c d.txt")
+  entry = entries["dir/c d.txt"]
+  assert entry.mtime_seconds * 10 ** 9 + entry.mtime_nanoseconds == (
+    stat.st_mtime_ns
+  )
+  assert entry.size == stat.st_size
+  assert entry.tracked
+  assert entry.regular
+  assert not entries["link"].regular
+
+
+def test_ReadIndex_invalid(tempdir: pathlib.Path):
+  (tempdir / "index").write_bytes(b"not an index")
+  with test.Raises(ValueError):
+    list(git_index.ReadIndex(tempdir / "index"))
+
+
+def test_GetCleanFileStats(git_repo: pathlib.Path):
+  # A modified file is not clean.
+  (git_repo / "a.txt").write_text("modified")
+
+  stats = git_index.GetCleanFileStats(git_repo)
+
+  assert sorted(stats) == [
+    str(git_repo / "dir/b.txt"),
+    str(git_repo / "dir/c d.txt"),
+  ]
+  for path, (mtime, size) in stats.items():
+    stat = os.stat(path)
+    assert mtime == int(stat.st_mtime * 1e6)
+    assert size == stat.st_size
+
+
+def test_GetCleanFileStats_directory(git_repo: pathlib.Path):
+  # Only the files in the directory are read.
+  (git_repo / "dir/c d.txt").write_text("modified")
+
+  stats = git_index.GetCleanFileStats(git_repo / "dir")
+
+  assert sorted(stats) == [str(git_repo / "dir/b.txt")]
+
+
+def test_GetCleanFileStats_racily_clean(git_repo: pathlib.Path):
+  # A file with an mtime after the index was written.
+  mtime = time.time() + 60
+  os.utime(git_repo / "a.txt", (mtime, mtime))
+  # Exits with an error if any files are modified, such as "new.txt".
+  subprocess.call(["git", "update-index", "-q", "--refresh"])
+  os.utime(git_repo / ".git/index", (mtime - 1, mtime - 1))
+
+  stats = git_index.GetCleanFileStats(git_repo)
+
+  assert str(git_repo / "a.txt") not in stats
+
+
+def test_GetCleanFileStats_not_a_git_repository(tempdir: pathlib.Path):
+  assert git_index.GetCleanFileStats(tempdir) == {}
+
+
+def test_GetMtime(tempdir: pathlib.Path):
+  """Test that mtimes agree with those computed from os.stat()."""
+  path = tempdir / "file"
+  path.touch()
+  for mtime_ns in [1600000000123456789, 1600000000999999999, 1000000001]:
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    assert git_index.GetMtime(*divmod(mtime_ns, 10 ** 9)) == int(
+      os.stat(path).st_mtime * 1e6
+    )
+
+
+if __name__ == "__main__":
+  test.Main()
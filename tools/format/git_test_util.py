@@ -0,0 +1,46 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module defines utilities for the tests of modules which use git."""
+import contextlib
+import pathlib
+import subprocess
+from typing import Iterator
+
+from labm8.py import fs
+
+
+def Git(*args: str) -> str:
+  """Run a git command in the current directory and return its output."""
+  return subprocess.check_output(
+    ["git", "-c", "user.name=test", "-c", "user.email=test@test"] + list(args),
+    universal_newlines=True,
+  )
+
+
+@contextlib.contextmanager
+def GitRepository(directory: pathlib.Path) -> Iterator[pathlib.Path]:
+  """A context manager which creates a git repository and changes into it.
+
+  The previous working directory is restored on exit, even if the code under
+  test changed directory.
+
+  Args:
+    directory: The directory to create the repository in.
+
+  Returns:
+    The directory of the repository.
+  """
+  with fs.chdir(directory):
+    Git("init", "-q")
+    yield directory
@@ -11,19 +11,68 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-"""Python wrappers for interfacing with git."""
+"""Python wrappers for interfacing with git.
+
+Commands are run through a shared git client, which reads and writes objects
+using long-lived git processes rather than starting a process per object.
+"""
+import atexit
+import glob
 import os
 import pathlib
-import subprocess
 import sys
+from typing import Dict
 from typing import Iterable
 from typing import List
-from typing import Tuple
+from typing import NamedTuple
 
 from labm8.py import app
+from tools.git import git_client
 
 FLAGS = app.FLAGS
 
+# The modes of regular files in the git index.
+_REGULAR_FILE_MODES = {"100644", "100755"}
+
+# The shared git clients, keyed by the directory that they run in.
+_clients: Dict[pathlib.Path, git_client.GitClient] = {}
+
+
+class IndexEntry(NamedTuple):
+  """A file in the git index."""
+
+  # The path of the file, relative to the repo root.
+  path: str
+  # The file mode, as an octal string, e.g. "100644".
+  mode: str
+  # The hash of the blob containing the contents of the file.
+  sha: str
+  # Whether the file in the working tree differs from the index.
+  partially_staged: bool = False
+
+
+def GetGitClient() -> git_client.GitClient:
+  """Get the shared git client of the current working directory.
+
+  The client's git processes are kept open until the program exits.
+  """
+  directory = pathlib.Path.cwd()
+  client = _clients.get(directory)
+  if client is None:
+    client = git_client.GitClient(directory)
+    _clients[directory] = client
+    atexit.register(client.Close)
+  return client
+
+
+def _RunOrDie(*args: str, input: bytes = None) -> bytes:
+  """Run a git command and return its output, or terminate on error."""
+  try:
+    return GetGitClient().Run(*args, input=input)
+  except git_client.GitError as e:
+    print(f"ERROR: {e}", file=sys.stderr)
+    sys.exit(1)
+
 
 def GetGitRootOrDie() -> pathlib.Path:
   """Get the root directory of the current git repository.
@@ -32,11 +81,9 @@ def GetGitRootOrDie() -> pathlib.Path:
     The absolute path of the git repository of the current working directory.
   """
   try:
-    top_level = subprocess.check_output(
-      ["git", "rev-parse", "--show-toplevel"], universal_newlines=True
-    ).rstrip()
-    return pathlib.Path(top_level)
-  except subprocess.CalledProcessError:
+    top_level = GetGitClient().Run("rev-parse", "--show-toplevel")
+    return pathlib.Path(os.fsdecode(top_level.rstrip(b"\n")))
+  except git_client.GitError:
     print("ERROR: Unable to get git directory root")
     sys.exit(1)
 
@@ -52,63 +99,194 @@ def GetModifiedFilesOrDie(staged: bool) -> List[str]:
   Returns:
     A list of paths relative to the repo root.
   """
-  cmd = ["git", "diff", "--name-only"]
+  args = ["diff", "--name-only", "-z"]
   if staged:
-    cmd.append("--cached")
-  try:
-    output = subprocess.check_output(cmd, universal_newlines=True)
-  except subprocess.CalledProcessError as e:
-    print(f"ERROR: command failed: {' '.join(cmd)}", file=sys.stderr)
-    sys.exit(1)
+    args.append("--cached")
+  return _SplitPaths(_RunOrDie(*args))
 
-  lines = output.split("\n")
-  staged_file_relpaths = lines[:-1]  # Last line is blank.
-  return staged_file_relpaths
 
+def GetMergeBaseOrDie(ref: str) -> str:
+  """Get the best common ancestor of a ref and HEAD.
+
+  Args:
+    ref: A git ref, e.g. "origin/master".
 
-def GetStagedPathsOrDie(
-  path_generator,
-) -> Tuple[List[pathlib.Path], List[pathlib.Path]]:
+  Returns:
+    The hash of the merge base commit.
   """
+  return _RunOrDie("merge-base", ref, "HEAD").decode("ascii").rstrip()
+
+
+def GetChangedFilesSinceOrDie(ref: str) -> List[str]:
+  """List the files that have changed since the merge base of a ref and HEAD.
+
+  This includes the changes of commits on the current branch, and staged and
+  unstaged changes in the working tree. Deleted files and submodules are
+  excluded.
 
   Args:
-    path_generator:
+    ref: A git ref, e.g. "origin/master".
 
   Returns:
-
+    A list of paths relative to the repo root.
   """
-  staged_paths, partially_staged_paths = [], []
+  merge_base = GetMergeBaseOrDie(ref)
+  return _SplitPaths(
+    _RunOrDie(
+      "diff",
+      "--name-only",
+      "-z",
+      "--diff-filter=d",
+      "--ignore-submodules=all",
+      merge_base,
+    )
+  )
+
+
+def _SplitPaths(output: bytes) -> List[str]:
+  """Split the output of a git command which lists paths with -z."""
+  # Paths are NUL-terminated, so that names containing newlines or quotes are
+  # not escaped.
+  return os.fsdecode(output).split("\0")[:-1]
 
-  staged_relpaths = GetModifiedFilesOrDie(staged=True)
-  unstaged_relpaths = GetModifiedFilesOrDie(staged=False)
-  partially_staged_relpaths = list(
-    set(staged_relpaths).intersection(set(unstaged_relpaths))
+
+def GetChangedPathsSinceOrDie(
+  ref: str, path_generator
+) -> Iterable[pathlib.Path]:
+  """Enumerate the paths of files that have changed since a git ref.
+
+  The paths are read from git, rather than by walking the tree, so the cost is
+  proportional to the number of changed files.
+
+  Args:
+    ref: A git ref, e.g. "origin/master".
+    path_generator: The path generator used to exclude ignored paths.
+
+  Returns:
+    An iterator over absolute paths.
+  """
+  git_root = GetGitRootOrDie()
+  # The path generator expands globs, so escape any glob characters in names.
+  return path_generator.GeneratePaths(
+    [
+      glob.escape(str(git_root / relpath))
+      for relpath in GetChangedFilesSinceOrDie(ref)
+    ]
   )
 
-  for relpath in staged_relpaths:
-    paths = list(path_generator.GeneratePaths([relpath]))
-    # A staged path can resolve to multiple real paths if it is a submodule
-    # that is being altered. Ignore those.
-    if len(paths) > 1:
-      continue
-    if paths:
-      staged_paths.append(paths[0])
-
-  for relpath in partially_staged_relpaths:
-    paths = list(path_generator.GeneratePaths([relpath]))
-    # A staged path can resolve to multiple real paths if it is a submodule
-    # that is being altered. Ignore those.
-    if len(paths) > 1:
+
+def GetStagedFilesOrDie() -> List[IndexEntry]:
+  """List the regular files with staged changes, and their staged blobs.
+
+  Deleted files, symlinks, and submodules are excluded.
+
+  Returns:
+    A list of index entries.
+  """
+  return [
+    entry
+    for entry in _GetStagedEntriesOrDie()
+    if entry.mode in _REGULAR_FILE_MODES
+  ]
+
+
+def _GetStagedEntriesOrDie() -> List[IndexEntry]:
+  """List the files with staged changes, other than deletions.
+
+  A single `git status` reports both the staged and the unstaged changes of
+  every file.
+  """
+  output = _RunOrDie(
+    "status",
+    "--porcelain=v2",
+    "-z",
+    "--untracked-files=no",
+    "--ignore-submodules=all",
+  )
+  fields = iter(os.fsdecode(output).split("\0")[:-1])
+  entries = []
+  for line in fields:
+    # Changed files are reported as "1 <XY> <sub> <mH> <mI> <mW> <hH> <hI>
+    # <path>", where X and Y are the staged and unstaged status, or "." if
+    # unchanged. Renames have a "2" prefix, an extra score field, and are
+    # followed by the original path. Unmerged files have a "u" prefix.
+    if line[0] == "1":
+      _, xy, _, _, mode, _, _, sha, path = line.split(" ", 8)
+    elif line[0] == "2":
+      _, xy, _, _, mode, _, _, sha, _, path = line.split(" ", 9)
+      next(fields)
+    else:
       continue
-    if paths:
-      partially_staged_paths.append(paths[0])
+    if xy[0] not in ".D":
+      entries.append(
+        IndexEntry(path=path, mode=mode, sha=sha, partially_staged=xy[1] != ".")
+      )
+  return entries
+
+
+def ReadBlobsOrDie(shas: Iterable[str]) -> Iterable[bytes]:
+  """Read the contents of blobs from the git object database.
+
+  Args:
+    shas: The hashes of the blobs to read.
+
+  Returns:
+    An iterator over the contents of the blobs, in the order of the hashes.
+  """
+  client = GetGitClient()
+  for sha in shas:
+    try:
+      yield client.ReadBlob(sha)
+    except git_client.GitError as e:
+      print(f"ERROR: {e}", file=sys.stderr)
+      sys.exit(1)
+
 
-  return staged_paths, partially_staged_paths
+def WriteBlobOrDie(data: bytes) -> str:
+  """Write a blob to the git object database.
 
+  The data is written verbatim, without applying any git attribute filters.
 
-def GitAddOrDie(paths: Iterable[pathlib.Path]):
+  Args:
+    data: The contents of the blob.
+
+  Returns:
+    The hash of the blob.
+  """
   try:
-    subprocess.check_call(["git", "add"] + [str(x) for x in paths])
-  except subprocess.CalledProcessError:
-    print(f"ERROR: git add faled: {paths}", file=sys.stderr)
+    return GetGitClient().WriteBlob(data)
+  except git_client.GitError as e:
+    print(f"ERROR: {e}", file=sys.stderr)
     sys.exit(1)
+
+
+def UpdateIndexOrDie(entries: Iterable[IndexEntry]) -> None:
+  """Set the blobs of files in the git index, without touching the working tree.
+
+  Args:
+    entries: The index entries to write.
+  """
+  index_info = "".join(
+    f"{entry.mode} {entry.sha}\t{entry.path}\0" for entry in entries
+  )
+  _RunOrDie(
+    "update-index",
+    "-z",
+    "--index-info",
+    input=index_info.encode("utf-8", "surrogateescape"),
+  )
+
+
+def CheckoutIndexOrDie(relpaths: Iterable[str]) -> None:
+  """Overwrite files in the working tree with their contents in the index.
+
+  Args:
+    relpaths: The paths of the files to check out, relative to the repo root.
+  """
+  _RunOrDie(
+    "checkout-index",
+    "-f",
+    "-z",
+    "--stdin",
+    input=b"".join(os.fsencode(relpath) + b"\0" for relpath in relpaths),
+  )
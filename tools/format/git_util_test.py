@@ -0,0 +1,118 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format:git_util."""
+import os
+import pathlib
+
+from labm8.py import test
+from tools.format import git_test_util
+from tools.format import git_util
+from tools.format import path_generator as path_generators
+from tools.format.git_test_util import Git
+
+FLAGS = test.FLAGS
+
+
+@test.Fixture(scope="function")
+def git_repo(tempdir: pathlib.Path) -> pathlib.Path:
+  """A git repository with a "main" branch and a "feature" branch."""
+  with git_test_util.GitRepository(tempdir):
+    (tempdir / "a.txt").write_text("a\n")
+    (tempdir / "b.txt").write_text("b\n")
+    (tempdir / "c.txt").write_text("c\n")
+    Git("add", ".")
+    Git("commit", "-q", "-m", "initial")
+    Git("branch", "-M", "main")
+    Git("checkout", "-q", "-b", "feature")
+    yield tempdir
+
+
+def test_GetChangedFilesSinceOrDie_no_changes(git_repo: pathlib.Path):
+  assert git_util.GetChangedFilesSinceOrDie("main") == []
+
+
+def test_GetChangedFilesSinceOrDie(git_repo: pathlib.Path):
+  # A committed change on the branch.
+  (git_repo / "a.txt").write_text("A\n")
+  Git("commit", "-q", "-am", "a")
+  # A change on main after the branch point, which is not included.
+  Git("checkout", "-q", "main")
+  (git_repo / "b.txt").write_text("B\n")
+  Git("commit", "-q", "-am", "b")
+  Git("checkout", "-q", "feature")
+  # A staged new file, an unstaged change, and a deleted file.
+  (git_repo / "new file.txt").write_text("d\n")
+  Git("add", "new file.txt")
+  (git_repo / "b.txt").write_text("b2\n")
+  os.unlink(git_repo / "c.txt")
+
+  assert sorted(git_util.GetChangedFilesSinceOrDie("main")) == [
+    "a.txt",
+    "b.txt",
+    "new file.txt",
+  ]
+
+
+def test_GetChangedPathsSinceOrDie(git_repo: pathlib.Path):
+  (git_repo / "a.txt").write_text("A\n")
+  (git_repo / "[b].txt").write_text("b\n")
+  (git_repo / "ignored.txt").write_text("b\n")
+  (git_repo / ".formatignore").write_text("ignored.txt\n")
+  (git_repo / "sub").mkdir()
+  Git("add", ".")
+  # Paths are relative to the repo root, not the working directory.
+  os.chdir(git_repo / "sub")
+
+  path_generator = path_generators.PathGenerator(".formatignore")
+  paths = git_util.GetChangedPathsSinceOrDie("main", path_generator)
+  assert sorted(paths) == [
+    git_repo / ".formatignore",
+    git_repo / "[b].txt",
+    git_repo / "a.txt",
+  ]
+
+
+def test_GetStagedFilesOrDie(git_repo: pathlib.Path):
+  (git_repo / "unstaged.txt").write_text("u\n")
+  Git("add", "unstaged.txt")
+  Git("commit", "-q", "-m", "unstaged")
+  # A fully staged change, a partially staged change, a staged rename, a
+  # staged deletion, a staged symlink, and an unstaged change.
+  (git_repo / "a.txt").write_text("A\n")
+  (git_repo / "new.txt").write_text("new\n")
+  Git("add", "a.txt", "new.txt")
+  (git_repo / "new.txt").write_text("new2\n")
+  Git("mv", "b.txt", "renamed.txt")
+  os.symlink("a.txt", git_repo / "link.txt")
+  Git("add", "link.txt")
+  Git("rm", "-q", "c.txt")
+  (git_repo / "unstaged.txt").write_text("U\n")
+
+  entries = sorted(git_util.GetStagedFilesOrDie())
+  assert [(e.path, e.partially_staged) for e in entries] == [
+    ("a.txt", False),
+    ("new.txt", True),
+    ("renamed.txt", False),
+  ]
+  assert entries[0].mode == "100644"
+  assert Git("cat-file", "-p", entries[1].sha) == "new\n"
+
+
+def test_WriteBlobOrDie_ReadBlobsOrDie(git_repo: pathlib.Path):
+  shas = [git_util.WriteBlobOrDie(data) for data in [b"a\n", b"b\n"]]
+  assert list(git_util.ReadBlobsOrDie(shas)) == [b"a\n", b"b\n"]
+
+
+if __name__ == "__main__":
+  test.Main()
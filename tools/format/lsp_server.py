@@ -0,0 +1,433 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module defines a Language Server Protocol server for formatting.
+
+The server implements the textDocument/formatting and
+textDocument/rangeFormatting requests for every file type in the suffix
+mapping, using JSON-RPC over stdin and stdout. Editors send the contents of
+their buffers to the server, and the server replies with the edits that are
+required to format them.
+
+Example usage:
+
+    $ format --lsp
+"""
+import collections
+import concurrent.futures
+import difflib
+import json
+import pathlib
+import re
+import sys
+import threading
+import urllib.parse
+from typing import Any
+from typing import BinaryIO
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from labm8.py import app
+from tools.format import app_paths
+from tools.format import suffix_matcher
+from tools.format.default_suffix_mapping import (
+  mapping as default_suffix_mapping,
+)
+from tools.format.formatters.base import base_formatter
+
+FLAGS = app.FLAGS
+
+# A line of text and its line ending, if any.
+_LINE_RE = re.compile(r"[^\r\n]*(?:\r\n|\r|\n)|[^\r\n]+")
+
+# JSON-RPC error codes.
+_PARSE_ERROR = -32700
+_INVALID_PARAMS = -32602
+_METHOD_NOT_FOUND = -32601
+_INVALID_REQUEST = -32600
+_INTERNAL_ERROR = -32603
+_SERVER_NOT_INITIALIZED = -32002
+
+# The requests which are handled by formatting a document.
+_FORMATTING_METHODS = {"textDocument/formatting", "textDocument/rangeFormatting"}
+
+
+class LanguageServer(object):
+  """A language server which formats documents.
+
+  Formatter instances are created on first use and kept for the lifetime of the
+  server, so that the cost of initializing a formatter is paid only once.
+  Formatting requests are handled concurrently by a pool of threads. Requests
+  for the same document are serialized, as are requests which use the same
+  formatter instance.
+  """
+
+  def __init__(
+    self,
+    stdin: BinaryIO,
+    stdout: BinaryIO,
+    cache_path: Optional[pathlib.Path] = None,
+    suffix_mapping: Dict[
+      str, base_formatter.BaseFormatter
+    ] = default_suffix_mapping,
+    max_workers: Optional[int] = None,
+  ):
+    """Constructor.
+
+    Args:
+      stdin: The stream to read messages from.
+      stdout: The stream to write messages to.
+      cache_path: The cache directory for formatters. Defaults to the
+        application cache.
+      suffix_mapping: A mapping from suffix to formatter class.
+      max_workers: The maximum number of requests to handle concurrently.
+    """
+    self.stdin = stdin
+    self.stdout = stdout
+    self.cache_path = cache_path or app_paths.GetCacheDir()
+    self.suffix_mapping = suffix_mapping
+    self.suffix_matcher = suffix_matcher.SuffixMatcher(suffix_mapping)
+
+    # A map from document URI to the current contents of the document.
+    self.documents: Dict[str, str] = {}
+    self.initialized = False
+    self.shutdown = False
+
+    self._executor = concurrent.futures.ThreadPoolExecutor(
+      max_workers=max_workers
+    )
+    # Guards the maps of locks and formatter instances.
+    self._lock = threading.Lock()
+    self._document_locks: Dict[str, threading.Lock] = collections.defaultdict(
+      threading.Lock
+    )
+    self._formatters: Dict[
+      type, Tuple[base_formatter.BaseFormatter, threading.Lock]
+    ] = {}
+    # Guards writes to stdout.
+    self._write_lock = threading.Lock()
+
+  def Run(self) -> int:
+    """Handle messages until the client exits.
+
+    Malformed messages are reported to the client, and do not stop the
+    server.
+
+    Returns:
+      The exit code of the server: zero if the client requested a shutdown
+      before exiting, else one.
+    """
+    try:
+      while True:
+        try:
+          message = ReadMessage(self.stdin)
+        except ValueError as e:
+          # The ID of the message is unknown, so the error is reported with a
+          # null ID.
+          app.Error("Failed to read message: %s", e)
+          self.Reply(None, error=(_PARSE_ERROR, f"Parse error: {e}"))
+          continue
+        if message is None or message.get("method") == "exit":
+          break
+        try:
+          self.Dispatch(message)
+        except (KeyError, IndexError, TypeError) as e:
+          self.ReplyInvalidParams(message, e)
+    finally:
+      self._executor.shutdown()
+    return 0 if self.shutdown else 1
+
+  def Dispatch(self, message: Dict[str, Any]) -> None:
+    """Handle a single message from the client."""
+    method = message.get("method")
+    id = message.get("id")
+    params = message.get("params") or {}
+
+    if method is None:
+      # A response to a request from the server. We never send any.
+      return
+    elif method == "initialize":
+      self.initialized = True
+      self.Reply(id, result=self.Capabilities())
+    elif not self.initialized:
+      if id is not None:
+        self.Reply(
+          id, error=(_SERVER_NOT_INITIALIZED, "Server not initialized")
+        )
+    elif method == "shutdown":
+      self.shutdown = True
+      self.Reply(id, result=None)
+    elif self.shutdown:
+      if id is not None:
+        self.Reply(id, error=(_INVALID_REQUEST, "Server is shutting down"))
+    elif method == "textDocument/didOpen":
+      document = params["textDocument"]
+      self.documents[document["uri"]] = document["text"]
+    elif method == "textDocument/didChange":
+      # Documents are synchronized in full, so the last change contains the
+      # entire contents of the document.
+      self.documents[params["textDocument"]["uri"]] = params["contentChanges"][
+        -1
+      ]["text"]
+    elif method == "textDocument/didClose":
+      self.documents.pop(params["textDocument"]["uri"], None)
+    elif method in _FORMATTING_METHODS:
+      # The contents of the document are read now, so that the edits returned
+      # apply to the version of the document at the time of the request.
+      uri = params["textDocument"]["uri"]
+      text = self.documents.get(uri)
+      range = params.get("range")
+      if range:
+        range = (_PositionKey(range["start"]), _PositionKey(range["end"]))
+      self._executor.submit(self._HandleFormatting, id, uri, text, range)
+    elif id is not None:
+      self.Reply(id, error=(_METHOD_NOT_FOUND, f"Unknown method: {method}"))
+
+  @staticmethod
+  def Capabilities() -> Dict[str, Any]:
+    """Return the response to an initialize request."""
+    return {
+      "capabilities": {
+        # Full document synchronization.
+        "textDocumentSync": {"openClose": True, "change": 1},
+        "documentFormattingProvider": True,
+        "documentRangeFormattingProvider": True,
+      },
+      "serverInfo": {"name": "format"},
+    }
+
+  def ReplyInvalidParams(self, message: Dict[str, Any], error: Exception):
+    """Report a message whose params could not be handled.
+
+    Requests receive an error response. Notifications have no response, so the
+    error is logged.
+    """
+    text = (
+      f"Invalid params for {message.get('method')}: "
+      f"{type(error).__name__}: {error}"
+    )
+    if message.get("id") is None:
+      app.Error("%s", text)
+    else:
+      self.Reply(message["id"], error=(_INVALID_PARAMS, text))
+
+  def Reply(
+    self,
+    id: Any,
+    result: Any = None,
+    error: Optional[Tuple[int, str]] = None,
+  ) -> None:
+    """Send a response to a request."""
+    message = {"jsonrpc": "2.0", "id": id}
+    if error:
+      message["error"] = {"code": error[0], "message": error[1]}
+    else:
+      message["result"] = result
+    with self._write_lock:
+      WriteMessage(self.stdout, message)
+
+  def Format(self, uri: str, text: str) -> str:
+    """Format the text of a document.
+
+    Args:
+      uri: The URI of the document, which determines the formatter to use.
+      text: The contents of the document.
+
+    Returns:
+      The formatted text. If there is no formatter for the document, the text
+      is returned unmodified.
+
+    Raises:
+      InitError: If the formatter fails to initialize.
+      FormatError: If the formatter fails.
+    """
+    filename = UriToPath(uri).name
+    key = self.suffix_matcher.Match(filename)
+    if key is None:
+      return text
+    formatter_class = self.suffix_mapping[key]
+
+    with self._lock:
+      if formatter_class not in self._formatters:
+        self._formatters[formatter_class] = (
+          formatter_class(self.cache_path),
+          threading.Lock(),
+        )
+      form, lock = self._formatters[formatter_class]
+    with lock:
+      return form.FormatText(text, filename)
+
+  def _HandleFormatting(
+    self,
+    id: Any,
+    uri: str,
+    text: Optional[str],
+    range: Optional[Tuple[Tuple[int, int], Tuple[int, int]]],
+  ) -> None:
+    """Handle a formatting or range formatting request.
+
+    Args:
+      id: The ID of the request.
+      uri: The URI of the document.
+      text: The contents of the document, or None if it is not open.
+      range: The start and end positions of the range to format, as
+        <line, character> tuples, or None to format the entire document.
+    """
+    if text is None:
+      self.Reply(id, error=(_INTERNAL_ERROR, f"Document not open: {uri}"))
+      return
+
+    with self._lock:
+      document_lock = self._document_locks[uri]
+    try:
+      with document_lock:
+        formatted = self.Format(uri, text)
+    except (
+      base_formatter.BaseFormatter.InitError,
+      base_formatter.BaseFormatter.FormatError,
+    ) as e:
+      self.Reply(id, error=(_INTERNAL_ERROR, str(e)))
+      return
+    except Exception as e:
+      app.Error("Unhandled error formatting %s: %s", uri, e)
+      self.Reply(id, error=(_INTERNAL_ERROR, f"{type(e).__name__}: {e}"))
+      return
+
+    edits = ComputeEdits(text, formatted)
+    if range:
+      edits = [edit for edit in edits if _Overlaps(edit["range"], *range)]
+    self.Reply(id, result=edits)
+
+
+def ReadMessage(stream: BinaryIO) -> Optional[Dict[str, Any]]:
+  """Read a JSON-RPC message from a stream.
+
+  Returns:
+    The decoded message, or None if the stream is closed.
+
+  Raises:
+    ValueError: If the message headers or body are malformed.
+  """
+  content_length = None
+  while True:
+    line = stream.readline()
+    if not line:
+      return None
+    line = line.strip()
+    if not line:
+      break
+    name, _, value = line.decode("ascii").partition(":")
+    if name.strip().lower() == "content-length":
+      content_length = int(value)
+  if content_length is None:
+    raise ValueError("Message has no Content-Length header")
+  message = json.loads(stream.read(content_length).decode("utf-8"))
+  if not isinstance(message, dict):
+    raise ValueError("Message is not a JSON object")
+  return message
+
+
+def WriteMessage(stream: BinaryIO, message: Dict[str, Any]) -> None:
+  """Write a JSON-RPC message to a stream."""
+  body = json.dumps(message).encode("utf-8")
+  stream.write(f"Content-Length: {len(body)}\r\n\r\n".encode("ascii") + body)
+  stream.flush()
+
+
+def UriToPath(uri: str) -> pathlib.PurePosixPath:
+  """Return the path component of a document URI."""
+  return pathlib.PurePosixPath(
+    urllib.parse.unquote(urllib.parse.urlparse(uri).path)
+  )
+
+
+def ComputeEdits(old: str, new: str) -> List[Dict[str, Any]]:
+  """Compute the list of text edits which transforms old into new.
+
+  The edits replace whole lines, so that only lines which the formatter
+  changed are included in the edits.
+
+  Returns:
+    A list of LSP TextEdit objects.
+  """
+  old_lines = SplitLines(old)
+  new_lines = SplitLines(new)
+  matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+  return [
+    {
+      "range": {
+        "start": _Position(old_lines, i1),
+        "end": _Position(old_lines, i2),
+      },
+      "newText": "".join(new_lines[j1:j2]),
+    }
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+    if tag != "equal"
+  ]
+
+
+def SplitLines(text: str) -> List[str]:
+  """Split text into lines, keeping line endings.
+
+  Unlike str.splitlines(), only "\\n", "\\r\\n" and "\\r" end a line, as
+  they do for LSP positions. Other characters, such as form feeds and unicode
+  line separators, do not.
+  """
+  return _LINE_RE.findall(text)
+
+
+def _Position(lines: List[str], line: int) -> Dict[str, int]:
+  """Return the LSP position of the start of a line.
+
+  If the last line of the text has no trailing newline, the position after the
+  last line is the end of that line, rather than the start of the next.
+  """
+  if line == len(lines) and lines and not lines[-1].endswith(("\n", "\r")):
+    # LSP positions are measured in UTF-16 code units.
+    return {
+      "line": line - 1,
+      "character": len(lines[-1].encode("utf-16-le")) // 2,
+    }
+  return {"line": line, "character": 0}
+
+
+def _PositionKey(position: Dict[str, int]) -> Tuple[int, int]:
+  """Return an LSP position as a tuple which orders by position."""
+  return position["line"], position["character"]
+
+
+def _Overlaps(
+  edit_range: Dict[str, Any], start: Tuple[int, int], end: Tuple[int, int]
+) -> bool:
+  """Return whether the range of an edit overlaps the range [start, end).
+
+  The end positions of LSP ranges are exclusive, so an edit which ends where
+  the range starts does not overlap it. An insertion overlaps a range if it is
+  within or at the boundaries of the range.
+  """
+  edit_start = _PositionKey(edit_range["start"])
+  edit_end = _PositionKey(edit_range["end"])
+  if edit_start == edit_end:
+    return start <= edit_start <= end
+  return edit_start < end and edit_end > start
+
+
+def Main() -> int:
+  """Run a language server on stdin and stdout.
+
+  Returns:
+    The exit code of the server.
+  """
+  return LanguageServer(sys.stdin.buffer, sys.stdout.buffer).Run()
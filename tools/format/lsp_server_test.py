@@ -0,0 +1,260 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format:lsp_server."""
+import io
+import pathlib
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Union
+
+from labm8.py import test
+from tools.format import lsp_server
+from tools.format.formatters import text
+
+FLAGS = test.FLAGS
+
+
+def ApplyEdits(old: str, edits: List[Dict[str, Any]]) -> str:
+  """Apply a list of non-overlapping LSP text edits to a string."""
+  lines = lsp_server.SplitLines(old)
+
+  def Offset(position):
+    return sum(len(l) for l in lines[: position["line"]]) + position["character"]
+
+  for edit in sorted(
+    edits, key=lambda e: Offset(e["range"]["start"]), reverse=True
+  ):
+    start, end = Offset(edit["range"]["start"]), Offset(edit["range"]["end"])
+    old = old[:start] + edit["newText"] + old[end:]
+  return old
+
+
+def Serve(
+  tempdir: pathlib.Path, messages: List[Union[Dict[str, Any], bytes]]
+):
+  """Run a server on the given messages and return the responses by id.
+
+  Messages which are bytes are written to the server without encoding.
+  """
+  stdin = io.BytesIO()
+  for message in messages:
+    if isinstance(message, bytes):
+      stdin.write(message)
+    else:
+      lsp_server.WriteMessage(stdin, message)
+  stdin.seek(0)
+  stdout = io.BytesIO()
+
+  server = lsp_server.LanguageServer(
+    stdin, stdout, cache_path=tempdir, suffix_mapping={".txt": text.FormatText}
+  )
+  returncode = server.Run()
+
+  stdout.seek(0)
+  responses = {}
+  while True:
+    response = lsp_server.ReadMessage(stdout)
+    if response is None:
+      break
+    responses[response["id"]] = response
+  return returncode, responses
+
+
+def Request(id: int, method: str, **params):
+  return {"jsonrpc": "2.0", "id": id, "method": method, "params": params}
+
+
+def Notification(method: str, **params):
+  return {"jsonrpc": "2.0", "method": method, "params": params}
+
+
+@test.Parametrize(
+  "old,new",
+  [
+    ("", "a\n"),
+    ("a\n", ""),
+    ("a\nb\nc\n", "a\nB\nc\n"),
+    ("a\nb", "a\nb\n"),
+    ("a  \nb\n\n\nc  ", "a\nb\n\n\nc\n"),
+    ("\U0001F600 x", "\U0001F600 y"),
+    ("a\r\nb  \r\n", "a\r\nb\r\n"),
+    ("a\x0cb  \n\u2028c\x1d  \n", "a\x0cb\n\u2028c\x1d\n"),
+  ],
+)
+def test_ComputeEdits_roundtrip(old: str, new: str):
+  assert ApplyEdits(old, lsp_server.ComputeEdits(old, new)) == new
+
+
+def test_SplitLines():
+  assert lsp_server.SplitLines("a\nb\r\nc\rd\x0be\x0c\u2028f") == [
+    "a\n",
+    "b\r\n",
+    "c\r",
+    "d\x0be\x0c\u2028f",
+  ]
+
+
+def test_ComputeEdits_line_separators():
+  # Only "\n", "\r\n", and "\r" separate lines in LSP positions.
+  edits = lsp_server.ComputeEdits("a\x0cb\nc  \n", "a\x0cb\nc\n")
+  assert [e["range"]["start"]["line"] for e in edits] == [1]
+
+
+def test_ComputeEdits_minimal():
+  old = "a\nb  \nc\nd\ne  \n"
+  edits = lsp_server.ComputeEdits(old, "a\nb\nc\nd\ne\n")
+  assert [e["range"]["start"]["line"] for e in edits] == [1, 4]
+
+
+def test_ComputeEdits_utf16_end_position():
+  (edit,) = lsp_server.ComputeEdits("\U0001F600", "x\n")
+  assert edit["range"]["end"] == {"line": 0, "character": 2}
+
+
+def test_LanguageServer_range_formatting_end_is_exclusive(
+  tempdir: pathlib.Path,
+):
+  uri = "file:///src/a.txt"
+  _, responses = Serve(
+    tempdir,
+    [
+      Request(1, "initialize", capabilities={}),
+      Notification(
+        "textDocument/didOpen",
+        textDocument={"uri": uri, "version": 1, "text": "a  \nb\nc  \n"},
+      ),
+      # The edit of the first line ends at the start of the second line.
+      Request(
+        2,
+        "textDocument/rangeFormatting",
+        textDocument={"uri": uri},
+        range={
+          "start": {"line": 1, "character": 0},
+          "end": {"line": 2, "character": 0},
+        },
+      ),
+      Notification("exit"),
+    ],
+  )
+  assert responses[2]["result"] == []
+
+
+def test_LanguageServer_formatting(tempdir: pathlib.Path):
+  uri = "file:///src/a.txt"
+  returncode, responses = Serve(
+    tempdir,
+    [
+      Request(1, "initialize", capabilities={}),
+      Notification("initialized"),
+      Notification(
+        "textDocument/didOpen",
+        textDocument={"uri": uri, "version": 1, "text": "a  \nb\nc  "},
+      ),
+      Request(2, "textDocument/formatting", textDocument={"uri": uri}),
+      Request(
+        3,
+        "textDocument/rangeFormatting",
+        textDocument={"uri": uri},
+        range={
+          "start": {"line": 0, "character": 0},
+          "end": {"line": 0, "character": 1},
+        },
+      ),
+      Request(4, "shutdown"),
+      Notification("exit"),
+    ],
+  )
+
+  assert returncode == 0
+  assert responses[1]["result"]["capabilities"]["documentFormattingProvider"]
+  assert ApplyEdits("a  \nb\nc  ", responses[2]["result"]) == "a\nb\nc\n"
+  assert ApplyEdits("a  \nb\nc  ", responses[3]["result"]) == "a\nb\nc  "
+  assert responses[4]["result"] is None
+
+
+def test_LanguageServer_unknown_suffix(tempdir: pathlib.Path):
+  uri = "file:///src/a.unknown"
+  _, responses = Serve(
+    tempdir,
+    [
+      Request(1, "initialize", capabilities={}),
+      Notification(
+        "textDocument/didOpen",
+        textDocument={"uri": uri, "version": 1, "text": "a  \n"},
+      ),
+      Request(2, "textDocument/formatting", textDocument={"uri": uri}),
+      Notification("exit"),
+    ],
+  )
+  assert responses[2]["result"] == []
+
+
+def test_LanguageServer_document_not_open(tempdir: pathlib.Path):
+  returncode, responses = Serve(
+    tempdir,
+    [
+      Request(1, "initialize", capabilities={}),
+      Request(
+        2, "textDocument/formatting", textDocument={"uri": "file:///a.txt"}
+      ),
+      Notification("exit"),
+    ],
+  )
+  # Exit without a shutdown request.
+  assert returncode == 1
+  assert "error" in responses[2]
+
+
+def test_LanguageServer_not_initialized(tempdir: pathlib.Path):
+  _, responses = Serve(tempdir, [Request(1, "shutdown")])
+  assert responses[1]["error"]["code"] == -32002
+
+
+def test_LanguageServer_malformed_messages(tempdir: pathlib.Path):
+  returncode, responses = Serve(
+    tempdir,
+    [
+      Request(1, "initialize", capabilities={}),
+      b"Content-Length: 5\r\n\r\n{bad}",
+      b"Content-Length: 2\r\n\r\n[]",
+      Request(2, "shutdown"),
+      Notification("exit"),
+    ],
+  )
+  assert returncode == 0
+  assert responses[None]["error"]["code"] == -32700
+  assert responses[2]["result"] is None
+
+
+def test_LanguageServer_invalid_params(tempdir: pathlib.Path):
+  returncode, responses = Serve(
+    tempdir,
+    [
+      Request(1, "initialize", capabilities={}),
+      # A notification has no response, so the error is only logged.
+      Notification("textDocument/didOpen", textDocument={"uri": "a"}),
+      Notification("textDocument/didChange", contentChanges=[]),
+      Request(2, "textDocument/formatting"),
+      Request(3, "shutdown"),
+      Notification("exit"),
+    ],
+  )
+  assert returncode == 0
+  assert responses[2]["error"]["code"] == -32602
+  assert responses[3]["result"] is None
+
+
+if __name__ == "__main__":
+  test.Main()
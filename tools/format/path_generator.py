@@ -12,17 +12,38 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """This module generates filesystem paths from program arguments."""
+import fnmatch
 import glob
 import os
 import pathlib
+import re
+from typing import Dict
 from typing import Iterable
 from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Pattern
 from typing import Set
 
 from labm8.py import app
 
 FLAGS = app.FLAGS
 
+# Matches a "path = <path>" line in a .gitmodules file.
+_GITMODULES_PATH_RE = re.compile(r"^\s*path\s*=\s*(.+?)\s*$")
+
+
+class IgnoreRule(NamedTuple):
+  """A compiled pattern of an ignore file."""
+
+  # The directory containing the ignore file, with a trailing separator.
+  directory: str
+  # A regular expression which matches the relative paths of ignored files,
+  # with a trailing separator.
+  regex: Pattern
+  # Whether the pattern is an un-ignore pattern.
+  unignore: bool
+
 
 class PathGenerator(object):
   """A a class for generating filesystem paths from program arguments.
@@ -33,8 +54,18 @@ class PathGenerator(object):
   def __init__(self, ignore_file_name: str, skip_git_submodules: bool = True):
     self.ignore_file_name = ignore_file_name
     self.skip_git_submodules = skip_git_submodules
-    self.ignored_paths: Set[pathlib.Path] = set()
-    self.visited_ignore_files: Set[pathlib.Path] = set()
+    # The ignore rules which apply to the contents of every visited directory,
+    # and whether every visited directory is ignored. Paths are stored as
+    # strings rather than pathlib.Path instances, which are several times
+    # larger.
+    self.ignore_rules: Dict[str, List[IgnoreRule]] = {}
+    self.ignored_directories: Dict[str, bool] = {}
+    # The string paths of git submodules, read from the .gitmodules files of
+    # the git repositories which have been visited.
+    self.git_submodules: Set[str] = set()
+    # The directories which are known to be, or not to be, the root of a git
+    # repository.
+    self.git_visited_directories: Set[str] = set()
 
   def GeneratePaths(self, args: List[str]) -> Iterable[pathlib.Path]:
     """Enumerate file paths from a list of arguments.
@@ -56,54 +87,177 @@ class PathGenerator(object):
       An iterator over absolute pathlib.Path instances. Every path returned
       is a unique file that exists
     """
-    visited_paths = set()
+    # Paths are deduplicated so that arguments which overlap, such as "a a/b",
+    # or a glob which matches both a directory and its contents, yield every
+    # file once. Rather than recording every path that is yielded, which costs
+    # hundreds of bytes per file on large trees, we record the directories
+    # which have been walked, which are not walked again, and the files which
+    # were named individually.
+    walked_directories: Set[str] = set()
+    visited_files: Set[str] = set()
 
     for arg in args:
       arg_path = pathlib.Path(arg).absolute()
 
-      # Sorting the result of globbing here rather than using the more efficient
-      # glob.iglob() gives us a stable and expected iteration order, but has a
-      # memory overhead as we must fully expand the glob before iterating
-      # through the results.
-      for path in sorted(glob.glob(arg, recursive=True)):
+      # Globs are expanded lazily, in a stable order, so that the first paths
+      # are yielded as soon as they are found, without first expanding the
+      # entire glob.
+      for path in SortedGlob(arg):
         path = pathlib.Path(path).absolute()
 
         if path.is_dir():
+          # Don't visit a git submodule unless it was explicitly requested as
+          # an argument. This prevents glob expansion from descending into
+          # submodules.
+          if self.skip_git_submodules and path != arg_path:
+            self.VisitEnclosingGitRepository(path.parent)
+            if str(path) in self.git_submodules:
+              continue
           # Iterate over the contents of directory arguments.
-          for root, dirs, files in os.walk(path):
-            root = pathlib.Path(root).absolute()
-
-            if self.skip_git_submodules:
-              # Don't visit a git submodule unless it was explicitly requested
-              # as as argument. This prevents glob expansion from descending
-              # into submodules.
-              if root != arg_path and (root / ".git").is_file():
-                break
-              # Don't descend into git submodules.
-              dirs[:] = [d for d in dirs if not (root / d / ".git").is_file()]
-
-            # Only iterate through the directory contents if the directory is
-            # not ignored.
-            if not self.IsIgnored(root):
-              # As with the glob expansion above, we sort the order of files
-              # when iterating through directories so that we have a sensible
-              # and stable iteration order. This has a performance hit for
-              # very large directories.
-              for file in sorted(files):
-                path = root / file
-                if path not in visited_paths and not self.IsIgnored(path):
-                  visited_paths.add(path)
-                  yield path
+          for path in self.WalkDirectory(path, walked_directories):
+            if not (visited_files and str(path) in visited_files):
+              yield path
         else:
-          if path not in visited_paths and not self.IsIgnored(path):
-            visited_paths.add(path)
+          path_str = str(path)
+          if (
+            str(path.parent) not in walked_directories
+            and path_str not in visited_files
+            and not self.IsIgnored(path)
+          ):
+            visited_files.add(path_str)
             yield path
 
+  def WalkDirectory(
+    self, directory: pathlib.Path, walked_directories: Set[str]
+  ) -> Iterable[pathlib.Path]:
+    """Enumerate the files in a directory and its subdirectories.
+
+    Files are yielded in a stable order: the files in a directory, sorted by
+    name, followed by the contents of each of its subdirectories, sorted by
+    name. Directories are read using os.scandir(), and the file types that it
+    returns are used to tell files from directories, without a stat() of
+    every path. As with os.walk(), symbolic links to directories are not
+    followed, and directories which cannot be read are skipped. Git
+    directories are never walked, and git submodules are not walked if
+    skip_git_submodules is set.
+
+    Args:
+      directory: The absolute path of the directory to walk.
+      walked_directories: The set of directories which have been walked.
+        Directories in this set are skipped, and walked directories are added
+        to it.
+
+    Returns:
+      An iterator over the absolute paths of files which are not ignored.
+    """
+    # Never descend into git directories.
+    if ".git" in directory.parts:
+      return
+    if self.skip_git_submodules:
+      self.VisitEnclosingGitRepository(directory.parent)
+
+    # A stack of directories to walk, in reverse order.
+    stack = [str(directory)]
+    while stack:
+      root = stack.pop()
+      if root in walked_directories:
+        # This directory and its subdirectories were walked by a previous
+        # argument.
+        continue
+      walked_directories.add(root)
+
+      dirs, files = [], []
+      try:
+        with os.scandir(root) as it:
+          for entry in it:
+            try:
+              is_dir = entry.is_dir()
+            except OSError:
+              is_dir = False
+            if entry.name == ".git":
+              # This directory is the root of a git repository, or of a
+              # submodule. Never descend into git directories.
+              if self.skip_git_submodules:
+                self.VisitGitRepository(root)
+            elif not is_dir:
+              files.append(entry.name)
+            elif not entry.is_symlink():
+              dirs.append(entry.name)
+      except OSError:
+        continue
+
+      # Don't descend into ignored directories, since all of their contents
+      # are ignored.
+      if self.IsDirectoryIgnored(root):
+        continue
+      # Read the ignore file of the directory, if the listing contains one.
+      self.GetIgnoreRules(root, has_ignore_file=self.ignore_file_name in files)
+
+      if self.skip_git_submodules and self.git_submodules:
+        # Don't descend into git submodules.
+        dirs = [
+          d
+          for d in dirs
+          if os.path.join(root, d) not in self.git_submodules
+        ]
+      stack.extend(os.path.join(root, d) for d in sorted(dirs, reverse=True))
+
+      for file in sorted(files):
+        path = os.path.join(root, file)
+        if not self._MatchIgnoreRules(path, root):
+          yield pathlib.Path(path)
+
+  def VisitEnclosingGitRepository(self, directory: pathlib.Path) -> None:
+    """Visit the git repository which contains a directory, if any.
+
+    Args:
+      directory: An absolute path.
+    """
+    for parent in [directory] + list(directory.parents):
+      parent_str = str(parent)
+      if parent_str in self.git_visited_directories:
+        return
+      if os.path.lexists(os.path.join(parent_str, ".git")):
+        self.VisitGitRepository(parent_str)
+        return
+      self.git_visited_directories.add(parent_str)
+
+  def VisitGitRepository(self, git_root: str) -> None:
+    """Record the submodules of a git repository.
+
+    Submodules are read from the .gitmodules file at the root of the
+    repository, which records the path of every submodule. This is
+    considerably cheaper than testing every directory for a .git file.
+
+    Args:
+      git_root: The absolute path of the root of a git repository.
+    """
+    if git_root in self.git_visited_directories:
+      return
+    self.git_visited_directories.add(git_root)
+
+    gitmodules = os.path.join(git_root, ".gitmodules")
+    try:
+      with open(gitmodules) as f:
+        for line in f:
+          match = _GITMODULES_PATH_RE.match(line)
+          if match:
+            path = match.group(1).strip('"')
+            app.Log(4, "found git submodule %s in %s", path, git_root)
+            self.git_submodules.add(
+              os.path.normpath(os.path.join(git_root, path))
+            )
+    except OSError:
+      # A repository with no submodules has no .gitmodules file.
+      pass
+
   def IsIgnored(self, path: pathlib.Path) -> bool:
     """Determine if the path is ignored.
 
-    Do this by visiting all "ignore files" on the filesystem path, starting with
-    the current directory and working up to the filesystem root.
+    Do this by matching the path against the patterns of all "ignore files" on
+    the filesystem path, starting with the current directory and working up to
+    the filesystem root. A path is ignored if it matches an ignore pattern, or
+    if any of its parent directories are ignored.
 
     Args:
       path: An absolute path.
@@ -115,52 +269,293 @@ class PathGenerator(object):
     if ".git" in path.parts:
       return True
 
-    for parent in path.parents:
-      ignore_file = parent / self.ignore_file_name
-      if ignore_file.is_file() and ignore_file not in self.visited_ignore_files:
-        self.VisitIgnoreFile(ignore_file)
-        self.visited_ignore_files.add(ignore_file)
+    parent = str(path.parent)
+    if parent == str(path):
+      # The filesystem root.
+      return False
+    return self.IsDirectoryIgnored(parent) or self._MatchIgnoreRules(
+      str(path), parent
+    )
 
-    if path in self.ignored_paths:
-      return True
+  def IsDirectoryIgnored(self, directory: str) -> bool:
+    """Determine if a directory, and so all of its contents, are ignored.
 
-    for parent in path.parents:
-      if parent in self.ignored_paths:
-        return True
+    The result is memoized for every directory, so that the ignore rules of a
+    directory are only evaluated once per run, no matter how many files it
+    contains.
 
-    return False
+    Args:
+      directory: An absolute path.
 
-  def VisitIgnoreFile(self, ignore_file: pathlib.Path) -> None:
-    """Visit an ignore file and expand patterns in it.
+    Returns:
+      True if the directory should be ignored, else False.
+    """
+    ignored = self.ignored_directories.get(directory)
+    if ignored is None:
+      parent = os.path.dirname(directory)
+      ignored = parent != directory and (
+        self.IsDirectoryIgnored(parent)
+        or self._MatchIgnoreRules(directory, parent)
+      )
+      self.ignored_directories[directory] = ignored
+    return ignored
+
+  def _MatchIgnoreRules(self, path: str, parent: str) -> bool:
+    """Return whether a path matches the ignore rules of its parents.
+
+    Args:
+      path: An absolute path.
+      parent: The parent directory of the path.
+
+    Returns:
+      True if the last ignore rule that the path matches is an ignore pattern,
+      False if it is an un-ignore pattern or if no rules match.
+    """
+    ignored = False
+    for directory, regex, unignore in self.GetIgnoreRules(parent):
+      if regex.fullmatch(path[len(directory) :] + "/"):
+        ignored = not unignore
+    return ignored
+
+  def GetIgnoreRules(
+    self, directory: str, has_ignore_file: Optional[bool] = None
+  ) -> List[IgnoreRule]:
+    """Return the ignore rules which apply to the contents of a directory.
+
+    These are the rules of the ignore files in the directory and every parent
+    directory, starting with the filesystem root and working down to the
+    directory. Since the last rule that a path matches wins, the rules of a
+    directory take precedence over the rules of its parents. Rules are memoized
+    for every directory.
+
+    Args:
+      directory: An absolute path.
+      has_ignore_file: Whether the directory contains an ignore file. If not
+        provided, the file is opened to find out.
+
+    Returns:
+      A list of rules.
+    """
+    rules = self.ignore_rules.get(directory)
+    if rules is None:
+      ignore_file = pathlib.Path(directory) / self.ignore_file_name
+      rules = []
+      if has_ignore_file is not False:
+        try:
+          rules = self.VisitIgnoreFile(ignore_file)
+        except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+          pass
+      parent = os.path.dirname(directory)
+      if parent != directory:
+        rules = self.GetIgnoreRules(parent) + rules
+      self.ignore_rules[directory] = rules
+    return rules
+
+  def VisitIgnoreFile(self, ignore_file: pathlib.Path) -> List[IgnoreRule]:
+    """Visit an ignore file and compile the patterns in it.
 
     An ignore file is a list of patterns for files to exclude. The syntax of
     files emulates the .gitignore format. For example:
 
         # This is an ignore file. "#" is a comment character.
         hello.txt  # Patterns which match files are excluded.
-        docs  # If a pattern matches a directory,
-        **/*.o  # Globs are expanded, including recursively.
+        docs  # If a pattern matches a directory, its contents are excluded.
+        **/*.o  # Globs are matched, including recursively.
         !important.o  # Lines beggining with '!' are un-ignored.
 
+    Patterns are matched relative to the directory containing the ignore file,
+    using the rules of UNIX glob expansion. Rather than expanding the globs,
+    which would require walking the directory tree, each pattern is compiled
+    to a regular expression which is matched against paths as they are
+    visited.
+
     Args:
       ignore_file: The path of an ignore file.
+
+    Returns:
+      A list of rules, in the order that they appear in the file.
     """
     app.Log(4, "visting ignore file %s", ignore_file)
+    # The prefix of the paths of files in the directory.
+    directory = os.path.join(str(ignore_file.parent), "")
+    rules = []
     with open(ignore_file) as f:
       for line in f:
         components = line.split("#")
         pattern = components[0].strip()
         if pattern and pattern[0] == "!":
           # Un-ignore patterns, if they were previously marked as ignored.
-          for path in glob.iglob(
-            str(ignore_file.parent / pattern[1:]), recursive=True
-          ):
-            path = pathlib.Path(path)
-            if path in self.ignored_paths:
-              self.ignored_paths.remove(path)
+          rules.append(
+            IgnoreRule(directory, _CompileIgnorePattern(pattern[1:]), True)
+          )
         elif pattern:
           # Ignore patterns.
-          for path in glob.iglob(
-            str(ignore_file.parent / pattern), recursive=True
-          ):
-            self.ignored_paths.add(pathlib.Path(path))
+          rules.append(
+            IgnoreRule(directory, _CompileIgnorePattern(pattern), False)
+          )
+    return rules
+
+
+def _CompileIgnorePattern(pattern: str) -> Pattern:
+  """Compile a glob pattern to a regular expression.
+
+  The regular expression matches relative paths, with a trailing separator
+  appended. As with glob.glob(pattern, recursive=True), wildcards do not match
+  hidden names unless the pattern component begins with a ".", and "**"
+  matches zero or more directories. Unlike glob expansion, a pattern which
+  matches the directory itself, such as "**", matches everything inside it,
+  including hidden names.
+
+  Args:
+    pattern: A glob pattern, relative to a directory.
+
+  Returns:
+    A compiled regular expression.
+  """
+  components = [c for c in pattern.split("/") if c and c != "."]
+  if not components:
+    # The pattern matches the directory itself, so everything inside it.
+    return re.compile(".*", re.DOTALL)
+  regex = []
+  for component in components:
+    if component == "**":
+      regex.append(r"(?:(?!\.)[^/]+/)*")
+    else:
+      if component[0] != ".":
+        regex.append(r"(?!\.)")
+      regex.append(_TranslateGlob(component))
+      regex.append("/")
+  regex = re.compile("".join(regex), re.DOTALL)
+  if regex.fullmatch(""):
+    # The pattern matches the directory itself, so everything inside it.
+    return re.compile(".*", re.DOTALL)
+  return regex
+
+
+def _TranslateGlob(component: str) -> str:
+  """Translate a glob pattern for a single path component to a regular
+  expression. This is fnmatch.translate(), except that wildcards do not
+  match path separators."""
+  i, n = 0, len(component)
+  regex = []
+  while i < n:
+    c = component[i]
+    i += 1
+    if c == "*":
+      regex.append("[^/]*")
+    elif c == "?":
+      regex.append("[^/]")
+    elif c == "[":
+      j = i
+      if j < n and component[j] == "!":
+        j += 1
+      if j < n and component[j] == "]":
+        j += 1
+      while j < n and component[j] != "]":
+        j += 1
+      if j >= n:
+        regex.append("\\[")
+      else:
+        chars = component[i:j].replace("\\", "\\\\")
+        i = j + 1
+        if chars[0] == "!":
+          chars = "^" + chars[1:]
+        elif chars[0] == "^":
+          chars = "\\" + chars
+        regex.append(f"[{chars}]")
+    else:
+      regex.append(re.escape(c))
+  return "".join(regex)
+
+
+def SortedGlob(pattern: str) -> Iterable[str]:
+  """Expand a glob pattern, in a stable order.
+
+  This is equivalent to glob.iglob(pattern, recursive=True), except that the
+  contents of each directory are visited in sorted order, so that the order of
+  the results is stable. Unlike sorted(glob.glob()), the results are yielded as
+  soon as they are found.
+
+  Args:
+    pattern: A glob pattern.
+
+  Returns:
+    An iterator over the paths which match the pattern.
+  """
+  for path in _Glob(pattern):
+    # A recursive wildcard in the current directory matches the current
+    # directory, as the empty path, which is not a result.
+    if path:
+      yield path
+
+
+def _Glob(pattern: str) -> Iterable[str]:
+  """Expand a glob pattern. See SortedGlob()."""
+  dirname, basename = os.path.split(pattern)
+  if not glob.has_magic(pattern):
+    if basename:
+      if os.path.lexists(pattern):
+        yield pattern
+    elif os.path.isdir(dirname):
+      # A pattern ending with a slash matches only directories.
+      yield pattern
+    return
+
+  if dirname and dirname != pattern and glob.has_magic(dirname):
+    dirs = _Glob(dirname)
+  else:
+    dirs = [dirname]
+  for directory in dirs:
+    if basename == "**":
+      # A recursive wildcard matches the directory itself, and everything
+      # below it.
+      if not directory or os.path.isdir(directory):
+        yield os.path.join(directory, "")
+      names = _ListDirRecursive(directory)
+    elif glob.has_magic(basename):
+      names = _ListDir(directory, basename)
+    else:
+      names = (
+        [basename] if os.path.lexists(os.path.join(directory, basename)) else []
+      )
+    for name in names:
+      yield os.path.join(directory, name)
+
+
+def _ListDir(directory: str, pattern: str) -> List[str]:
+  """Return the sorted names in a directory which match a glob pattern."""
+  try:
+    with os.scandir(directory or os.curdir) as it:
+      names = [entry.name for entry in it]
+  except OSError:
+    return []
+  if not _IsHidden(pattern):
+    names = [name for name in names if not _IsHidden(name)]
+  return sorted(fnmatch.filter(names, pattern))
+
+
+def _ListDirRecursive(directory: str) -> Iterable[str]:
+  """Enumerate the relative paths of the non-hidden contents of a directory,
+  recursively, in sorted order."""
+  try:
+    with os.scandir(directory or os.curdir) as it:
+      entries = sorted(
+        (entry for entry in it if not _IsHidden(entry.name)),
+        key=lambda entry: entry.name,
+      )
+  except OSError:
+    return
+  for entry in entries:
+    yield entry.name
+    try:
+      is_dir = entry.is_dir()
+    except OSError:
+      is_dir = False
+    if is_dir:
+      for name in _ListDirRecursive(os.path.join(directory, entry.name)):
+        yield os.path.join(entry.name, name)
+
+
+def _IsHidden(name: str) -> bool:
+  """Return whether a file name is hidden from glob wildcards."""
+  return name[0] == "."
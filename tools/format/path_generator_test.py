@@ -12,8 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Unit tests for //tools/format:path_generator."""
+import glob
 import os
 import pathlib
+import tracemalloc
 
 from labm8.py import fs
 from labm8.py import test
@@ -35,6 +37,14 @@ def MakeFiles(relpaths):
     path.touch()
 
 
+def MakeGitModules(relpaths):
+  """Create a .gitmodules file in the current directory which declares the
+  given list of submodule paths."""
+  with open(".gitmodules", "w") as f:
+    for path in relpaths:
+      f.write(f'[submodule "{path}"]\n\tpath = {path}\n')
+
+
 def test_GeneratePaths_non_existent_path(
   path_generator: path_generator_lib.PathGenerator, tempdir: pathlib.Path
 ):
@@ -222,9 +232,11 @@ def test_GeneratePaths_ignore_git_submodule(
       "src/submod/c/c",  # should be ignored
     ]
   )
+  MakeGitModules(["src/submod"])
 
   paths = set(path_generator.GeneratePaths(["."]))
   assert paths == {
+    tempdir / ".gitmodules",
     tempdir / "README",
     tempdir / "src/a",
     tempdir / "src/b",
@@ -250,6 +262,7 @@ def test_GeneratePaths_explicitly_requested_submodule(
       "src/submod/c/c",  # should be ignored
     ]
   )
+  MakeGitModules(["src/submod"])
 
   paths = set(path_generator.GeneratePaths(["src/submod"]))
   assert paths == {
@@ -279,6 +292,7 @@ def test_GeneratePaths_ignored_in_glob_expansion(
       "src/submod/c/c",  # should be ignored
     ]
   )
+  MakeGitModules(["src/submod"])
 
   paths = list(path_generator.GeneratePaths(["src/*"]))
 
@@ -289,5 +303,293 @@ def test_GeneratePaths_ignored_in_glob_expansion(
   ]
 
 
+def test_GeneratePaths_ignore_git_submodule_of_parent_directory(
+  path_generator: path_generator_lib.PathGenerator, tempdir: pathlib.Path
+):
+  """Test that submodules are read from the repository of a subdirectory."""
+  MakeFiles(
+    [
+      tempdir / ".git/config",
+      tempdir / "src/a",
+      tempdir / "src/submod/.git",
+      tempdir / "src/submod/a",
+    ]
+  )
+  os.chdir(tempdir)
+  MakeGitModules(["src/submod"])
+  os.chdir(tempdir / "src")
+
+  paths = list(path_generator.GeneratePaths(["."]))
+
+  assert paths == [tempdir / "src/a"]
+
+
+def test_GeneratePaths_ignore_git_submodule_of_nested_repository(
+  path_generator: path_generator_lib.PathGenerator, tempdir: pathlib.Path
+):
+  """Test that the submodules of a repository found during a walk are not
+  visited."""
+  MakeFiles(
+    [
+      tempdir / "repo/.git/config",
+      tempdir / "repo/a",
+      tempdir / "repo/submod/.git",
+      tempdir / "repo/submod/a",
+    ]
+  )
+  os.chdir(tempdir / "repo")
+  MakeGitModules(["submod"])
+  os.chdir(tempdir)
+
+  paths = list(path_generator.GeneratePaths(["."]))
+
+  assert paths == [tempdir / "repo/.gitmodules", tempdir / "repo/a"]
+
+
+def test_GeneratePaths_overlapping_arguments(
+  path_generator: path_generator_lib.PathGenerator, tempdir: pathlib.Path
+):
+  """Test that files matched by multiple arguments are visited once."""
+  os.chdir(tempdir)
+  MakeFiles(["a", "b/c", "b/d/e"])
+
+  paths = list(
+    path_generator.GeneratePaths(["a", "b/c", ".", "b", "b/d/e", "**"])
+  )
+
+  assert paths == [
+    tempdir / "a",
+    tempdir / "b/c",
+    tempdir / "b/d/e",
+  ]
+
+
+def test_GeneratePaths_directory_order(
+  path_generator: path_generator_lib.PathGenerator, tempdir: pathlib.Path
+):
+  """Test that the files in a directory precede those in subdirectories."""
+  MakeFiles(
+    [tempdir / "b" / "a", tempdir / "a" / "z", tempdir / "z", tempdir / "c"]
+  )
+
+  paths = list(path_generator.GeneratePaths([str(tempdir)]))
+
+  assert paths == [
+    tempdir / "c",
+    tempdir / "z",
+    tempdir / "a/z",
+    tempdir / "b/a",
+  ]
+
+
+def test_GeneratePaths_is_lazy(
+  path_generator: path_generator_lib.PathGenerator, tempdir: pathlib.Path
+):
+  """Test that paths are yielded before the entire tree is walked."""
+  MakeFiles([tempdir / "a", tempdir / "b/c"])
+
+  paths = path_generator.GeneratePaths([str(tempdir)])
+  assert next(paths) == tempdir / "a"
+  # Remove a directory which has not been walked yet.
+  fs.rm(tempdir / "b")
+  assert list(paths) == []
+
+
+def test_GeneratePaths_nested_ignore_files(
+  path_generator: path_generator_lib.PathGenerator, tempdir: pathlib.Path
+):
+  """Test that ignore files in subdirectories are matched relative to the
+  directory that contains them."""
+  os.chdir(tempdir)
+  MakeFiles(["a.o", "src/.formatignore", "src/a.o", "src/b/a.o", "src/b/c"])
+  fs.Write("src/.formatignore", "**/*.o\nb/c".encode("utf-8"))
+
+  paths = list(path_generator.GeneratePaths(["."]))
+
+  assert paths == [
+    tempdir / "a.o",
+    tempdir / "src/.formatignore",
+  ]
+
+
+def test_GeneratePaths_ignore_list_current_directory(
+  path_generator: path_generator_lib.PathGenerator, tempdir: pathlib.Path
+):
+  """Test that "." ignores the entire directory."""
+  os.chdir(tempdir)
+  MakeFiles(["a", "src/.formatignore", "src/a", "src/b/c"])
+  fs.Write("src/.formatignore", ".".encode("utf-8"))
+
+  paths = list(path_generator.GeneratePaths(["a", "src", "src/b/c"]))
+
+  assert paths == [tempdir / "a"]
+
+
+def test_GeneratePaths_nested_ignore_file_unignores_parent_pattern(
+  path_generator: path_generator_lib.PathGenerator, tempdir: pathlib.Path
+):
+  """Test that the rules of an ignore file in a subdirectory take precedence
+  over the rules of its parent directories."""
+  os.chdir(tempdir)
+  MakeFiles([".formatignore", "src/.formatignore", "src/a.o", "src/c.o"])
+  fs.Write(".formatignore", "**/*.o".encode("utf-8"))
+  fs.Write("src/.formatignore", "!c.o".encode("utf-8"))
+
+  paths = list(path_generator.GeneratePaths(["."]))
+
+  assert paths == [
+    tempdir / ".formatignore",
+    tempdir / "src/.formatignore",
+    tempdir / "src/c.o",
+  ]
+  assert not path_generator.IsIgnored(tempdir / "src/c.o")
+  assert path_generator.IsIgnored(tempdir / "src/a.o")
+
+
+def test_GeneratePaths_ignore_list_recursive_glob_current_directory(
+  path_generator: path_generator_lib.PathGenerator, tempdir: pathlib.Path
+):
+  """Test that "**" ignores the entire directory, including hidden files."""
+  os.chdir(tempdir)
+  MakeFiles(["src/.formatignore", "src/.hidden", "src/a", "src/.b/c"])
+  fs.Write("src/.formatignore", "**".encode("utf-8"))
+
+  assert list(path_generator.GeneratePaths(["src"])) == []
+
+
+IGNORE_PATTERNS = (
+  "*",
+  "**/*",
+  "**/a.o",
+  "**/*.o",
+  "a/**",
+  "a/**/*.o",
+  "*/*.o",
+  ".*",
+  "a/.hidden/*",
+  "[ab]/b.o",
+  "[!a]/b.o",
+  "a/?.o",
+  "a/b.o",
+  "missing/*",
+)
+
+
+@test.Parametrize("pattern", IGNORE_PATTERNS)
+def test_CompileIgnorePattern_matches_glob(tempdir: pathlib.Path, pattern: str):
+  """Test that an ignore pattern matches the same paths as glob.glob()."""
+  os.chdir(tempdir)
+  MakeFiles(
+    ["a/b.o", "a/c/a.o", "a/.hidden/a.o", "b/b.o", ".a.o", "a.o", "c.txt"]
+  )
+  relpaths = {
+    os.path.relpath(os.path.join(root, name))
+    for root, dirs, files in os.walk(".")
+    for name in dirs + files
+  }
+
+  regex = path_generator_lib._CompileIgnorePattern(pattern)
+  matches = {path for path in relpaths if regex.fullmatch(path + "/")}
+
+  assert matches == {
+    os.path.normpath(path) for path in glob.glob(pattern, recursive=True)
+  }
+
+
+@test.Parametrize(
+  "pattern",
+  (
+    "*",
+    "**",
+    "**/*",
+    "**/",
+    "*/*.py",
+    "a/**/*.py",
+    "a/**",
+    ".*",
+    "a/.hidden/*",
+    "[ab]/b.py",
+    "a/b.py",
+    "missing/*",
+    "a/b.py/*",
+  ),
+)
+def test_SortedGlob_matches_glob(tempdir: pathlib.Path, pattern: str):
+  """Test that SortedGlob() matches the same paths as glob.glob()."""
+  os.chdir(tempdir)
+  MakeFiles(
+    [
+      "a/b.py",
+      "a/c/d.py",
+      "a/.hidden/e.py",
+      "b/b.py",
+      ".f.py",
+      "g.txt",
+    ]
+  )
+
+  paths = list(path_generator_lib.SortedGlob(pattern))
+
+  assert sorted(paths) == sorted(glob.glob(pattern, recursive=True))
+
+
+def test_SortedGlob_order(tempdir: pathlib.Path):
+  """Test that directories are expanded in sorted order."""
+  os.chdir(tempdir)
+  MakeFiles(["b/a", "a/b", "a/a/a"])
+
+  assert list(path_generator_lib.SortedGlob("**")) == [
+    "a",
+    "a/a",
+    "a/a/a",
+    "a/b",
+    "b",
+    "b/a",
+  ]
+
+
+def test_benchmark_GeneratePaths(
+  benchmark,
+  path_generator: path_generator_lib.PathGenerator,
+  tempdir: pathlib.Path,
+):
+  """Benchmark the time and peak memory use of enumerating a tree."""
+  MakeFiles(
+    [tempdir / f"dir{i}" / f"file{j}.py" for i in range(100) for j in range(100)]
+  )
+
+  def Benchmark():
+    return sum(1 for _ in path_generator.GeneratePaths([str(tempdir)]))
+
+  tracemalloc.start()
+  try:
+    assert Benchmark() == 10000
+    _, peak_memory = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  benchmark.extra_info["peak_memory_bytes"] = peak_memory
+
+  benchmark(Benchmark)
+
+
+
+def test_benchmark_GeneratePaths_ignore_file(
+  benchmark,
+  path_generator: path_generator_lib.PathGenerator,
+  tempdir: pathlib.Path,
+):
+  """Benchmark enumerating a tree with recursive ignore patterns."""
+  MakeFiles(
+    [tempdir / f"dir{i}" / f"file{j}.py" for i in range(100) for j in range(100)]
+  )
+  fs.Write(tempdir / ".formatignore", "**/file1*.py".encode("utf-8"))
+
+  def Benchmark():
+    return sum(1 for _ in path_generator.GeneratePaths([str(tempdir)]))
+
+  assert Benchmark() == 8901
+
+  benchmark(Benchmark)
+
 if __name__ == "__main__":
   test.Main()
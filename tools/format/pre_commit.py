@@ -12,24 +12,45 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """This module defines the git pre-commit mode behavior for format."""
+import collections
+import concurrent.futures
 import os
+import pathlib
 import sys
+import time
+from typing import Dict
 from typing import Iterable
+from typing import List
+from typing import Tuple
 
 import build_info
 from labm8.py import app
 from labm8.py import fs
 from tools.format import app_paths
+from tools.format import format_cache
+from tools.format import format_outcome
 from tools.format import format_paths
 from tools.format import git_util
 from tools.format import path_generator as path_generators
+from tools.format import suffix_matcher
+from tools.format.default_suffix_mapping import (
+  mapping as default_suffix_mapping,
+)
+from tools.format.formatters.base import base_formatter
 
 
 FLAGS = app.FLAGS
 
 
 def Main():
-  """Run the pre-commit mode formatter."""
+  """Run the pre-commit mode formatter.
+
+  The staged contents of files are read from the git index, formatted, and the
+  formatted contents are written back to the index. Files which are fully
+  staged are also updated in the working tree. The working tree copies of
+  partially staged files are left alone, so that their unstaged changes are
+  not committed.
+  """
   # Get and change into the root directory of this repository.
   git_root = git_util.GetGitRootOrDie()
   os.chdir(git_root)
@@ -37,51 +58,182 @@ def Main():
   path_generator = path_generators.PathGenerator(
     ".formatignore", skip_git_submodules=FLAGS.skip_git_submodules
   )
+  matcher = suffix_matcher.SuffixMatcher(default_suffix_mapping)
 
-  # In --pre_commit mode, we take the union of staged and partially-staged
-  # files to format.
-  staged_paths, partially_staged_paths = git_util.GetStagedPathsOrDie(
-    path_generator
+  staged_files = [
+    entry
+    for entry in git_util.GetStagedFilesOrDie()
+    if matcher.Match(os.path.basename(entry.path)) is not None
+    and not path_generator.IsIgnored(git_root / entry.path)
+  ]
+  formatted = FormatStagedFilesOrDie(staged_files, matcher)
+
+  # Write the list of changed files that is read by the git commit message hook,
+  # if used.
+  WriteModifiedFilesListForCommitMessage(
+    sorted(entry.path for entry in formatted)
   )
 
-  paths = set(staged_paths).union(set(partially_staged_paths))
+  if not formatted:
+    return
 
-  modified_paths = format_paths.FormatPathsOrDie(paths)
+  git_util.UpdateIndexOrDie(
+    entry._replace(sha=git_util.WriteBlobOrDie(data))
+    for entry, data in formatted.items()
+  )
+  # The working tree copies of fully staged files are the same as the staged
+  # copies, so update them to match the index.
+  checked_out = [
+    entry.path for entry in formatted if not entry.partially_staged
+  ]
+  git_util.CheckoutIndexOrDie(checked_out)
+  if FLAGS.with_cache:
+    CacheCheckedOutFiles(git_root, checked_out)
 
-  modified_paths = set(modified_paths)
+  print("✅  Modified files that will be automatically committed:")
+  for entry in sorted(formatted):
+    print("   ", entry.path)
 
-  # Write the list of changed files that is read by the git commit message hook,
-  # if used.
-  WriteModifiedFilesListForCommitMessage(
-    sorted([os.path.relpath(path, git_root) for path in modified_paths])
+  need_review = sorted(
+    entry.path for entry in formatted if entry.partially_staged
   )
+  if need_review:
+    print(
+      "⚠️  Partially staged files were formatted in the index only. Their "
+      "working tree copies are not formatted:",
+      file=sys.stderr,
+    )
+    for path in need_review:
+      print("   ", path, file=sys.stderr)
 
-  if modified_paths:
-    need_review = modified_paths.intersection(set(partially_staged_paths))
-    to_commit = modified_paths - need_review
 
-    if to_commit:
-      print("✅  Modified files that will be automatically committed:")
-      for path in sorted(to_commit):
-        print("   ", os.path.relpath(path, git_root))
-      git_util.GitAddOrDie(to_commit)
+def FormatStagedFilesOrDie(
+  staged_files: List[git_util.IndexEntry],
+  matcher: suffix_matcher.SuffixMatcher,
+) -> Dict[git_util.IndexEntry, bytes]:
+  """Format the staged contents of files in memory, and terminate on error.
 
-    if need_review:
-      print(
-        "!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!",
-        file=sys.stderr,
-      )
-      print(
-        "⚠️  Partially staged modified files that must be inspected:",
-        file=sys.stderr,
+  The files of each formatter are written to a scratch directory and formatted
+  together, so that batched formatters process them in as few runs as they
+  can. Formatters run concurrently.
+
+  Args:
+    staged_files: The staged files to format.
+    matcher: The matcher of file names to formatters.
+
+  Returns:
+    A map from the index entries of the files which were modified by
+    formatting to their formatted contents.
+  """
+  # Group the files by formatter, so that each formatter is initialized once.
+  files_by_formatter: Dict[
+    type, List[Tuple[git_util.IndexEntry, bytes]]
+  ] = collections.defaultdict(list)
+  blobs = git_util.ReadBlobsOrDie(entry.sha for entry in staged_files)
+  for entry, data in zip(staged_files, blobs):
+    try:
+      data.decode("utf-8")
+    except UnicodeDecodeError:
+      app.Log(1, "Skipping binary file %s", entry.path)
+      continue
+    key = matcher.Match(os.path.basename(entry.path))
+    files_by_formatter[default_suffix_mapping[key]].append((entry, data))
+
+  formatted: Dict[git_util.IndexEntry, bytes] = {}
+
+  def FormatFiles(
+    formatter_class: type, files: List[Tuple[git_util.IndexEntry, bytes]]
+  ) -> List[format_outcome.FormatOutcome]:
+    """Format a list of files with a formatter, and return their outcomes."""
+    name = formatter_class.__name__
+    try:
+      form = formatter_class(app_paths.GetCacheDir())
+    except base_formatter.BaseFormatter.InitError as e:
+      return [
+        format_outcome.FormatOutcome(
+          path=None,
+          status=format_outcome.FormatStatus.ERROR,
+          formatter=name,
+          error=e,
+        )
+      ]
+
+    start_time = time.time()
+    # The files are named by their paths relative to the repository root, so
+    # that formatters see the same file names as they would in the tree.
+    formatted_files, errors = form.FormatContents(
+      {entry.path: data for entry, data in files}
+    )
+    # Apportion the runtime of the formatter between the files.
+    duration = (time.time() - start_time) / len(files)
+
+    outcomes = []
+    for entry, data in files:
+      path = pathlib.Path(entry.path).absolute()
+      if entry.path in errors:
+        outcomes.append(
+          format_outcome.FormatOutcome(
+            path=path,
+            status=format_outcome.FormatStatus.ERROR,
+            formatter=name,
+            error=errors[entry.path],
+          )
+        )
+        continue
+      formatted_data = formatted_files[entry.path]
+      if formatted_data != data:
+        formatted[entry] = formatted_data
+      outcomes.append(
+        format_outcome.FormatOutcome(
+          path=path,
+          status=(
+            format_outcome.FormatStatus.MODIFIED
+            if formatted_data != data
+            else format_outcome.FormatStatus.UNCHANGED
+          ),
+          formatter=name,
+          duration=duration,
+          bytes_before=len(data),
+          bytes_after=len(formatted_data),
+        )
       )
-      for path in sorted(need_review):
-        print("   ", os.path.relpath(path, git_root), file=sys.stderr)
+    return outcomes
+
+  with concurrent.futures.ThreadPoolExecutor(
+    max_workers=max(len(files_by_formatter), 1)
+  ) as executor:
+    futures = [
+      executor.submit(FormatFiles, formatter_class, files)
+      for formatter_class, files in files_by_formatter.items()
+    ]
+    format_paths.ReportOutcomesOrDie(
+      outcome
+      for future in concurrent.futures.as_completed(futures)
+      for outcome in future.result()
+    )
+
+  return formatted
+
+
+def CacheCheckedOutFiles(git_root: pathlib.Path, relpaths: List[str]) -> None:
+  """Record the mtimes of formatted files which were checked out of the index.
 
-      print("", file=sys.stderr)
-      print("[action] Selectively add unstaged changes using:", file=sys.stderr)
-      print("    git add --patch --", *need_review, file=sys.stderr)
-      sys.exit(3)
+  Checking out a file changes its mtime, so without this the next run of
+  format on the working tree would format the files again.
+
+  Args:
+    git_root: The root directory of the repository.
+    relpaths: The paths of the files relative to the repository root.
+  """
+  cache = format_cache.FormatCache(app_paths.GetCacheDir())
+  with cache.Session():
+    for relpath in relpaths:
+      path = git_root / relpath
+      try:
+        mtime = int(os.stat(path).st_mtime * 1e6)
+      except OSError:
+        continue
+      cache.SetMtime(path, mtime)
 
 
 def WriteModifiedFilesListForCommitMessage(modified_files: Iterable[str]):
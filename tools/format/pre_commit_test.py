@@ -0,0 +1,102 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format:pre_commit."""
+import pathlib
+
+from labm8.py import test
+from tools.format import app_paths
+from tools.format import format as format_main  # Defines --skip_git_submodules.
+from tools.format import format_cache
+from tools.format import git_test_util
+from tools.format import pre_commit
+from tools.format.git_test_util import Git
+
+FLAGS = test.FLAGS
+
+
+@test.Fixture(scope="function")
+def git_repo(tempdir: pathlib.Path) -> pathlib.Path:
+  """A git repository with a committed text file."""
+  with git_test_util.GitRepository(tempdir):
+    (tempdir / "a.txt").write_text("a\n")
+    Git("add", ".")
+    Git("commit", "-q", "-m", "initial")
+    yield tempdir
+
+
+def test_Main_no_staged_files(git_repo: pathlib.Path):
+  (git_repo / "a.txt").write_text("a  \n")
+
+  pre_commit.Main()
+
+  assert (git_repo / "a.txt").read_text() == "a  \n"
+  assert Git("diff", "--cached", "--name-only") == ""
+
+
+def test_Main_fully_staged_file(git_repo: pathlib.Path):
+  (git_repo / "a.txt").write_text("a  \n")
+  (git_repo / "b.txt").write_text("b  \n")
+  Git("add", ".")
+
+  pre_commit.Main()
+
+  assert Git("show", ":a.txt") == "a\n"
+  assert Git("show", ":b.txt") == "b\n"
+  # The working tree is updated to match the index.
+  assert (git_repo / "a.txt").read_text() == "a\n"
+  assert Git("status", "--porcelain") == "A  b.txt\n"
+  # The checked out files are cached as formatted.
+  cache = format_cache.FormatCache(app_paths.GetCacheDir())
+  for name in ("a.txt", "b.txt"):
+    mtime = int((git_repo / name).stat().st_mtime * 1e6)
+    assert cache.store.Get(str(git_repo / name)) == mtime
+
+
+def test_Main_partially_staged_file(git_repo: pathlib.Path):
+  (git_repo / "a.txt").write_text("a  \n")
+  Git("add", "a.txt")
+  # An unstaged change.
+  (git_repo / "a.txt").write_text("a  \nb\n")
+
+  pre_commit.Main()
+
+  assert Git("show", ":a.txt") == "a\n"
+  # The working tree, including the unstaged change, is not modified.
+  assert (git_repo / "a.txt").read_text() == "a  \nb\n"
+
+
+def test_Main_files_with_the_same_name(git_repo: pathlib.Path):
+  (git_repo / "a.txt").write_text("a  \n")
+  (git_repo / "sub").mkdir()
+  (git_repo / "sub" / "a.txt").write_text("sub  \n")
+  Git("add", ".")
+
+  pre_commit.Main()
+
+  assert Git("show", ":a.txt") == "a\n"
+  assert Git("show", ":sub/a.txt") == "sub\n"
+
+
+def test_Main_ignored_file(git_repo: pathlib.Path):
+  (git_repo / ".formatignore").write_text("a.txt\n")
+  (git_repo / "a.txt").write_text("a  \n")
+  Git("add", ".")
+
+  pre_commit.Main()
+
+  assert Git("show", ":a.txt") == "a  \n"
+
+
+if __name__ == "__main__":
+  test.Main()
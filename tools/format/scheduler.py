@@ -0,0 +1,208 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module defines a cost-aware scheduler for formatter actions."""
+import concurrent.futures
+import itertools
+import queue
+import threading
+import time
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from labm8.py import app
+from tools.format.formatters.base import base_formatter
+
+FLAGS = app.FLAGS
+
+
+class CostModel(object):
+  """A model which estimates the runtime of formatter actions.
+
+  The runtime of an action is modelled as a linear function of the number of
+  bytes that it processes: a fixed per-action overhead (e.g. process startup),
+  plus a per-byte cost. The coefficients of each formatter are fitted using
+  least squares over the historical timings of that formatter, with older
+  samples exponentially decayed so that the model tracks changes in formatter
+  performance.
+
+  The state of the model is a mapping from formatter name to a list of the
+  regression sums [n, sum_x, sum_y, sum_xx, sum_xy], where x is the number of
+  bytes and y is the runtime in seconds. This state is persisted in the format
+  cache between runs.
+  """
+
+  # The factor by which historical samples are decayed on each new sample.
+  decay = 0.95
+
+  def __init__(self, timings: Optional[Dict[str, List[float]]] = None):
+    self.timings: Dict[str, List[float]] = {
+      name: list(sums) for name, sums in (timings or {}).items()
+    }
+    self._lock = threading.Lock()
+
+  def Estimate(
+    self, formatter_name: str, byte_count: int, prior: float = 0
+  ) -> float:
+    """Estimate the runtime of an action.
+
+    Args:
+      formatter_name: The name of the formatter.
+      byte_count: The number of bytes processed by the action.
+      prior: The estimate to return if there is no history for this formatter.
+
+    Returns:
+      The estimated runtime, in seconds.
+    """
+    with self._lock:
+      sums = self.timings.get(formatter_name)
+      if not sums:
+        return prior
+      n, sum_x, sum_y, sum_xx, sum_xy = sums
+
+    if n < 1e-6:
+      return prior
+
+    # Fit the intercept (per-action overhead) and slope (per-byte cost). If
+    # there isn't enough variance in the samples to fit the slope, or the
+    # fitted slope is nonsensical, fall back to the mean runtime.
+    denominator = n * sum_xx - sum_x * sum_x
+    if n >= 2 and denominator > 1e-6:
+      slope = (n * sum_xy - sum_x * sum_y) / denominator
+      intercept = (sum_y - slope * sum_x) / n
+      if slope >= 0:
+        return max(intercept + slope * byte_count, 0)
+    return sum_y / n
+
+  def Record(self, formatter_name: str, byte_count: int, seconds: float):
+    """Record the runtime of an action.
+
+    Args:
+      formatter_name: The name of the formatter.
+      byte_count: The number of bytes processed by the action.
+      seconds: The measured runtime of the action.
+    """
+    x, y = float(byte_count), float(seconds)
+    with self._lock:
+      sums = self.timings.get(formatter_name, [0.0] * 5)
+      self.timings[formatter_name] = [
+        s * self.decay + v for s, v in zip(sums, [1, x, y, x * x, x * y])
+      ]
+
+
+class ActionScheduler(object):
+  """A thread pool which runs formatter actions in order of expected cost.
+
+  Unlike a concurrent.futures.ThreadPoolExecutor which executes jobs in the
+  order that they are submitted, this scheduler maintains a priority queue of
+  pending actions and each idle worker picks the action with the greatest
+  expected runtime. Expensive actions, such as a JVM-backed batch, are then
+  started as early as possible, and cheap actions fill the gaps between them,
+  minimizing the "long tail" of a run where one worker is busy and the others
+  are idle.
+
+  Example usage:
+
+      with ActionScheduler(cost_model, max_workers=8) as scheduler:
+        future = scheduler.Submit(action, "FormatJava", byte_count=1024)
+        paths, cached_mtimes, errors = future.result()
+  """
+
+  def __init__(self, cost_model: CostModel, max_workers: int):
+    """Constructor.
+
+    Args:
+      cost_model: The model used to estimate the cost of actions. The runtime
+        of every action is recorded in this model.
+      max_workers: The number of worker threads.
+    """
+    self.cost_model = cost_model
+    self._queue = queue.PriorityQueue()
+    # A monotonically increasing sequence number which breaks ties between
+    # actions of equal cost so that they are run in submission order.
+    self._sequence = itertools.count()
+    self._threads = [
+      threading.Thread(target=self._Worker) for _ in range(max_workers)
+    ]
+    for thread in self._threads:
+      thread.start()
+
+  def Submit(
+    self,
+    action: base_formatter.FormatAction,
+    formatter_name: str,
+    byte_count: int,
+    prior: float = 0,
+  ) -> concurrent.futures.Future:
+    """Schedule an action for execution.
+
+    Args:
+      action: The formatter action to run.
+      formatter_name: The name of the formatter which created the action.
+      byte_count: The number of bytes that the action will process.
+      prior: The expected runtime of the action if there is no history for
+        the formatter.
+
+    Returns:
+      A future of the action's outcome.
+    """
+    future = concurrent.futures.Future()
+    cost = self.cost_model.Estimate(formatter_name, byte_count, prior)
+    app.Log(
+      4,
+      "Schedule %s action of %d bytes with cost %.3fs",
+      formatter_name,
+      byte_count,
+      cost,
+    )
+    self._queue.put(
+      (-cost, next(self._sequence), future, action, formatter_name, byte_count)
+    )
+    return future
+
+  def _Worker(self) -> None:
+    """The worker thread loop."""
+    while True:
+      _, _, future, action, formatter_name, byte_count = self._queue.get()
+      # A job without a future is the sentinel value marking the end of jobs.
+      if future is None:
+        break
+      if not future.set_running_or_notify_cancel():
+        continue
+
+      start_time = time.time()
+      try:
+        outcome = action()
+      except BaseException as e:
+        future.set_exception(e)
+      else:
+        self.cost_model.Record(
+          formatter_name, byte_count, time.time() - start_time
+        )
+        future.set_result(outcome)
+
+  def Shutdown(self) -> None:
+    """Wait for all pending actions to complete and stop the workers."""
+    for _ in self._threads:
+      # Sentinel values have the lowest possible priority so that they are
+      # dequeued only once all pending actions have started.
+      self._queue.put((float("inf"), next(self._sequence), None, None, "", 0))
+    for thread in self._threads:
+      thread.join()
+
+  def __enter__(self) -> "ActionScheduler":
+    return self
+
+  def __exit__(self, *args) -> None:
+    self.Shutdown()
@@ -0,0 +1,99 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format:scheduler."""
+import threading
+
+from labm8.py import test
+from tools.format import scheduler
+
+FLAGS = test.FLAGS
+
+
+def test_CostModel_Estimate_no_history():
+  cost_model = scheduler.CostModel()
+  assert cost_model.Estimate("FormatFoo", 100, prior=5) == 5
+
+
+def test_CostModel_Estimate_single_sample():
+  cost_model = scheduler.CostModel()
+  cost_model.Record("FormatFoo", 100, 2)
+  assert abs(cost_model.Estimate("FormatFoo", 100, prior=5) - 2) < 1e-6
+
+
+def test_CostModel_Estimate_linear_fit():
+  cost_model = scheduler.CostModel()
+  # A formatter with a startup cost of 1s and a per-byte cost of 0.01s.
+  for byte_count in [100, 200, 300, 400]:
+    cost_model.Record("FormatFoo", byte_count, 1 + byte_count * 0.01)
+  assert abs(cost_model.Estimate("FormatFoo", 1000) - 11) < 1e-6
+
+
+def test_CostModel_timings_round_trip():
+  cost_model = scheduler.CostModel()
+  cost_model.Record("FormatFoo", 100, 2)
+  restored = scheduler.CostModel(cost_model.timings)
+  assert abs(restored.Estimate("FormatFoo", 100) - 2) < 1e-6
+
+
+def test_ActionScheduler_runs_most_expensive_first():
+  """Test that pending actions are dequeued in order of decreasing cost."""
+  started = []
+  blocker_started = threading.Event()
+  blocker = threading.Event()
+
+  def MakeAction(name):
+    def Action():
+      started.append(name)
+      if name == "blocker":
+        blocker_started.set()
+        blocker.wait()
+      return name
+
+    return Action
+
+  with scheduler.ActionScheduler(
+    scheduler.CostModel(), max_workers=1
+  ) as action_scheduler:
+    # Occupy the only worker so that the remaining actions are queued.
+    futures = [action_scheduler.Submit(MakeAction("blocker"), "A", 0)]
+    blocker_started.wait()
+    futures.append(action_scheduler.Submit(MakeAction("cheap"), "B", 0, 1))
+    futures.append(action_scheduler.Submit(MakeAction("costly"), "C", 0, 10))
+    futures.append(action_scheduler.Submit(MakeAction("medium"), "D", 0, 5))
+    blocker.set()
+
+  assert [f.result() for f in futures] == [
+    "blocker",
+    "cheap",
+    "costly",
+    "medium",
+  ]
+  assert started == ["blocker", "costly", "medium", "cheap"]
+
+
+def test_ActionScheduler_propagates_exceptions():
+  def Action():
+    raise ValueError("bad")
+
+  with scheduler.ActionScheduler(
+    scheduler.CostModel(), max_workers=2
+  ) as action_scheduler:
+    future = action_scheduler.Submit(Action, "A", 0)
+
+  with test.Raises(ValueError):
+    future.result()
+
+
+if __name__ == "__main__":
+  test.Main()
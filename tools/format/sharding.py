@@ -0,0 +1,439 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module defines the sharding of a format run across many processes.
+
+Paths are assigned to shards by a hash of their path relative to the working
+directory, so every process which is run on the same tree with the same
+arguments agrees on the shards. Each shard can record the outcomes of its
+files in a manifest, and the manifests of all shards are merged to produce the
+outcome of the entire run. For example, to format a tree on two machines:
+
+    machine1 $ format --num_shards=2 --shard_index=0 \
+        --shard_manifest=shard0.jsonl .
+    machine2 $ format --num_shards=2 --shard_index=1 \
+        --shard_manifest=shard1.jsonl .
+    $ format --merge_shard_manifests=shard0.jsonl,shard1.jsonl
+
+Or, to run the shards in worker processes on the local machine:
+
+    $ format --shard_workers=8 .
+"""
+import json
+import os
+import pathlib
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+from labm8.py import app
+from tools.format import format_outcome
+from tools.format import format_paths
+
+FLAGS = app.FLAGS
+
+app.DEFINE_integer(
+  "num_shards",
+  1,
+  "The number of shards to divide the paths to format into. Use with "
+  "--shard_index to format a single shard.",
+  lower_bound=1,
+)
+app.DEFINE_integer(
+  "shard_index",
+  0,
+  "The index of the shard to format, in the range [0, --num_shards).",
+  lower_bound=0,
+)
+app.DEFINE_output_path(
+  "shard_manifest",
+  None,
+  "Write the outcomes of the formatted files to this manifest, which can be "
+  "merged with the manifests of other shards using --merge_shard_manifests.",
+)
+app.DEFINE_list(
+  "merge_shard_manifests",
+  [],
+  "Merge the manifests written by every shard of a sharded format run, print "
+  "the modified files and errors, and exit.",
+)
+app.DEFINE_integer(
+  "shard_workers",
+  0,
+  "Format the paths in this many worker processes, each formatting a single "
+  "shard, and merge their outcomes.",
+  lower_bound=0,
+)
+
+# Matches the flags of the coordinator which are not passed to the workers, in
+# either the "--flag=value" or the "--flag value" form. The value is captured
+# in the first form.
+_COORDINATOR_FLAG_RE = re.compile(
+  r"^--?(?:shard_workers|num_shards|shard_index|shard_manifest)(=.*)?$"
+)
+
+# The number of seconds between checks of whether shard workers have exited.
+_WORKER_POLL_INTERVAL = 0.1
+
+
+class ShardManifest(NamedTuple):
+  """The manifest of a single shard."""
+
+  shard_index: int
+  num_shards: int
+  outcomes: List[format_outcome.FormatOutcome]
+  # Whether the shard ran to completion. The manifest of a shard which crashed
+  # contains only the outcomes that were recorded before the crash.
+  complete: bool
+
+
+class ShardError(Exception):
+  """An error which was recorded in a shard manifest."""
+
+
+def GetShardIndex(relpath: str, num_shards: int) -> int:
+  """Return the shard of a path.
+
+  Args:
+    relpath: The path of a file, relative to the root of the sharded run.
+    num_shards: The number of shards.
+
+  Returns:
+    The index of the shard, in the range [0, num_shards).
+  """
+  # The hash must be stable across processes and machines, which rules out
+  # the builtin hash().
+  return zlib.crc32(relpath.encode("utf-8")) % num_shards
+
+
+def FilterShard(
+  paths: Iterable[pathlib.Path],
+  shard_index: int,
+  num_shards: int,
+  root: Optional[pathlib.Path] = None,
+) -> Iterable[pathlib.Path]:
+  """Filter an iterable of absolute paths for those in the given shard.
+
+  Args:
+    paths: An iterator of absolute paths.
+    shard_index: The shard to select.
+    num_shards: The number of shards.
+    root: The root of the sharded run. Defaults to the working directory.
+
+  Returns:
+    An iterator of paths.
+  """
+  root = root or pathlib.Path.cwd()
+  for path in paths:
+    if GetShardIndex(_RelPath(path, root), num_shards) == shard_index:
+      yield path
+
+
+def RecordOutcomes(
+  outcomes: Iterable[format_outcome.FormatOutcome],
+  manifest_path: pathlib.Path,
+  shard_index: int,
+  num_shards: int,
+  root: Optional[pathlib.Path] = None,
+) -> Iterable[format_outcome.FormatOutcome]:
+  """Record outcomes in a shard manifest as they pass through this iterator.
+
+  The manifest is a JSON lines file with a header line, a line for every
+  outcome, and a final line which marks the shard as complete. Paths are
+  recorded relative to the root of the run, so that manifests written on
+  different machines can be merged.
+
+  Args:
+    outcomes: An iterator of outcomes.
+    manifest_path: The path of the manifest to write.
+    shard_index: The index of the shard.
+    num_shards: The number of shards.
+    root: The root of the sharded run. Defaults to the working directory.
+
+  Returns:
+    An iterator of the outcomes.
+  """
+  root = root or pathlib.Path.cwd()
+  with open(manifest_path, "w") as f:
+    _WriteJsonLine(f, {"shard_index": shard_index, "num_shards": num_shards})
+    for outcome in outcomes:
+      relpath = None if outcome.path is None else _RelPath(outcome.path, root)
+      _WriteJsonLine(
+        f,
+        {
+          "path": relpath,
+          "status": outcome.status.value,
+          "formatter": outcome.formatter,
+          "duration": outcome.duration,
+          "bytes_before": outcome.bytes_before,
+          "bytes_after": outcome.bytes_after,
+          "cache_hit": outcome.cache_hit,
+          "error": None if outcome.error is None else str(outcome.error),
+        },
+      )
+      yield outcome
+    _WriteJsonLine(f, {"complete": True})
+
+
+def ReadManifest(
+  manifest_path: pathlib.Path, root: Optional[pathlib.Path] = None
+) -> ShardManifest:
+  """Read a shard manifest.
+
+  Args:
+    manifest_path: The path of the manifest.
+    root: The root that paths are resolved relative to. Defaults to the
+      working directory.
+
+  Returns:
+    The manifest.
+
+  Raises:
+    ValueError: If the manifest cannot be parsed.
+  """
+  root = root or pathlib.Path.cwd()
+  with open(manifest_path) as f:
+    try:
+      lines = [json.loads(line) for line in f]
+      header, records = lines[0], lines[1:]
+      complete = bool(records) and records[-1] == {"complete": True}
+      if complete:
+        records = records[:-1]
+      return ShardManifest(
+        shard_index=header["shard_index"],
+        num_shards=header["num_shards"],
+        outcomes=[
+          format_outcome.FormatOutcome(
+            path=_ResolvePath(record["path"], root),
+            status=format_outcome.FormatStatus(record["status"]),
+            formatter=record["formatter"],
+            duration=record["duration"],
+            bytes_before=record["bytes_before"],
+            bytes_after=record["bytes_after"],
+            cache_hit=record["cache_hit"],
+            error=(
+              None if record["error"] is None else ShardError(record["error"])
+            ),
+          )
+          for record in records
+        ],
+        complete=complete,
+      )
+    except (IndexError, KeyError, TypeError, ValueError) as e:
+      raise ValueError(f"Invalid shard manifest {manifest_path}: {e}")
+
+
+def MergeManifestsOrDie(
+  manifest_paths: Iterable[pathlib.Path], root: Optional[pathlib.Path] = None
+) -> List[format_outcome.FormatOutcome]:
+  """Merge the manifests of every shard of a run.
+
+  Args:
+    manifest_paths: The paths of the manifests, one for every shard.
+    root: The root that paths are resolved relative to. Defaults to the
+      working directory.
+
+  Returns:
+    The outcomes of all shards, ordered by path.
+  """
+  manifests: Dict[int, ShardManifest] = {}
+  num_shards = None
+  for manifest_path in manifest_paths:
+    try:
+      manifest = ReadManifest(manifest_path, root)
+    except (OSError, ValueError) as e:
+      app.FatalWithoutStackTrace("%s", e)
+    if num_shards is None:
+      num_shards = manifest.num_shards
+    elif manifest.num_shards != num_shards:
+      app.FatalWithoutStackTrace(
+        "Shard manifest %s has %d shards, expected %d",
+        manifest_path,
+        manifest.num_shards,
+        num_shards,
+      )
+    if manifest.shard_index in manifests:
+      app.FatalWithoutStackTrace(
+        "Duplicate manifest for shard %d: %s",
+        manifest.shard_index,
+        manifest_path,
+      )
+    if not manifest.complete:
+      app.FatalWithoutStackTrace(
+        "Shard manifest is incomplete: %s", manifest_path
+      )
+    manifests[manifest.shard_index] = manifest
+
+  missing = sorted(set(range(num_shards or 0)) - set(manifests))
+  if missing:
+    app.FatalWithoutStackTrace(
+      "Missing manifests for shards: %s", ", ".join(str(i) for i in missing)
+    )
+
+  return sorted(
+    (outcome for m in manifests.values() for outcome in m.outcomes),
+    key=lambda outcome: str(outcome.path or ""),
+  )
+
+
+def FormatShardOrDie(
+  paths: Iterable[pathlib.Path],
+  shard_index: int,
+  num_shards: int,
+  manifest_path: Optional[pathlib.Path] = None,
+  dry_run: bool = False,
+) -> List[pathlib.Path]:
+  """Format a single shard of the given paths, and terminate on error.
+
+  Args:
+    paths: An iterator of absolute paths.
+    shard_index: The shard to format.
+    num_shards: The number of shards.
+    manifest_path: If set, record the outcomes of the shard in this manifest.
+    dry_run: Print the paths that would be formatted, without formatting them.
+
+  Returns:
+    The list of modified paths.
+  """
+  outcomes = format_paths.FormatPaths(
+    FilterShard(paths, shard_index, num_shards), dry_run=dry_run
+  ).Outcomes()
+  if manifest_path:
+    outcomes = RecordOutcomes(outcomes, manifest_path, shard_index, num_shards)
+  return format_paths.ReportOutcomesOrDie(outcomes)
+
+
+def RunShardWorkersOrDie(
+  argv: List[str], worker_count: int
+) -> List[pathlib.Path]:
+  """Run a sharded format in local worker processes, and merge the outcomes.
+
+  Args:
+    argv: The command line arguments of this program.
+    worker_count: The number of shards, each formatted by a worker process.
+
+  Returns:
+    The list of modified paths.
+  """
+  argv = _RemoveCoordinatorFlags(argv)
+  with tempfile.TemporaryDirectory(prefix="phd_format_shards_") as d:
+    d = pathlib.Path(d)
+    manifest_paths = [d / f"shard_{i}.jsonl" for i in range(worker_count)]
+    log_paths = [d / f"shard_{i}.log" for i in range(worker_count)]
+
+    processes = []
+    try:
+      for i in range(worker_count):
+        with open(log_paths[i], "w") as log:
+          processes.append(
+            subprocess.Popen(
+              [sys.executable]
+              + argv
+              + [
+                f"--num_shards={worker_count}",
+                f"--shard_index={i}",
+                f"--shard_manifest={manifest_paths[i]}",
+              ],
+              stdout=subprocess.DEVNULL,
+              stderr=log,
+            )
+          )
+
+      # A worker which exits with an error after completing its shard reports
+      # the errors in its manifest. Any other failure is reported here, as
+      # soon as the worker exits.
+      running = dict(enumerate(processes))
+      while running:
+        for i, process in list(running.items()):
+          if process.poll() is None:
+            continue
+          del running[i]
+          if process.returncode and not _IsComplete(manifest_paths[i]):
+            print(log_paths[i].read_text(), file=sys.stderr, end="")
+            app.FatalWithoutStackTrace(
+              "Shard worker %d failed with returncode %d",
+              i,
+              process.returncode,
+            )
+        if running:
+          time.sleep(_WORKER_POLL_INTERVAL)
+    finally:
+      # Stop the remaining workers if a worker failed, or if this process was
+      # interrupted.
+      for process in processes:
+        if process.poll() is None:
+          process.terminate()
+      for process in processes:
+        process.wait()
+
+    outcomes = MergeManifestsOrDie(manifest_paths)
+  return format_paths.ReportOutcomesOrDie(outcomes)
+
+
+def _RemoveCoordinatorFlags(argv: List[str]) -> List[str]:
+  """Remove the flags of the coordinator from a list of arguments.
+
+  Arguments after a "--", which ends the flags, are not removed.
+  """
+  args = []
+  i = 0
+  while i < len(argv):
+    arg = argv[i]
+    if arg == "--":
+      args += argv[i:]
+      break
+    match = _COORDINATOR_FLAG_RE.match(arg)
+    if not match:
+      args.append(arg)
+    elif match.group(1) is None:
+      # The value is the next argument.
+      i += 1
+    i += 1
+  return args
+
+
+def _RelPath(path: pathlib.Path, root: pathlib.Path) -> str:
+  """Return the relative path of a path with forward slash separators."""
+  return pathlib.PurePath(os.path.relpath(path, root)).as_posix()
+
+
+def _ResolvePath(
+  relpath: Optional[str], root: pathlib.Path
+) -> Optional[pathlib.Path]:
+  """Return the absolute path of a relative path, or None."""
+  if relpath is None:
+    return None
+  return pathlib.Path(os.path.normpath(root / relpath))
+
+
+def _WriteJsonLine(f, data: Dict[str, Any]) -> None:
+  """Write a single line of a JSON lines file."""
+  f.write(json.dumps(data))
+  f.write("\n")
+
+
+def _IsComplete(manifest_path: pathlib.Path) -> bool:
+  """Return whether a manifest exists and is complete."""
+  try:
+    return ReadManifest(manifest_path).complete
+  except (OSError, ValueError):
+    return False
@@ -0,0 +1,188 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format:sharding."""
+import pathlib
+import subprocess
+import time
+
+from labm8.py import test
+from tools.format import format_outcome
+from tools.format import sharding
+
+FLAGS = test.FLAGS
+
+OUTCOMES = [
+  format_outcome.FormatOutcome(
+    path=pathlib.Path("/src/a.py"),
+    status=format_outcome.FormatStatus.MODIFIED,
+    formatter="FormatPython",
+    duration=1.5,
+    bytes_before=10,
+    bytes_after=8,
+    cache_hit=True,
+  ),
+  format_outcome.FormatOutcome(
+    path=None,
+    status=format_outcome.FormatStatus.ERROR,
+    formatter="FormatPython",
+    error=ValueError("error"),
+  ),
+]
+
+
+def test_GetShardIndex_is_stable():
+  assert sharding.GetShardIndex("a/b.py", 1) == 0
+  assert sharding.GetShardIndex("a/b.py", 16) == sharding.GetShardIndex(
+    "a/b.py", 16
+  )
+
+
+def test_FilterShard_partitions_paths(tempdir: pathlib.Path):
+  paths = [tempdir / f"dir{i % 3}" / f"file{i}.py" for i in range(100)]
+  shards = [
+    list(sharding.FilterShard(paths, i, 4, root=tempdir)) for i in range(4)
+  ]
+  assert sorted(p for shard in shards for p in shard) == sorted(paths)
+  # Every shard is non-empty.
+  assert all(shards)
+
+
+def test_RecordOutcomes_ReadManifest(tempdir: pathlib.Path):
+  manifest_path = tempdir / "manifest.jsonl"
+  root = pathlib.Path("/src")
+  outcomes = list(
+    sharding.RecordOutcomes(OUTCOMES, manifest_path, 1, 2, root=root)
+  )
+  assert outcomes == OUTCOMES
+
+  manifest = sharding.ReadManifest(manifest_path, root=pathlib.Path("/other"))
+  assert manifest.shard_index == 1
+  assert manifest.num_shards == 2
+  assert manifest.complete
+  a, error = manifest.outcomes
+  assert a.path == pathlib.Path("/other/a.py")
+  assert a.status == format_outcome.FormatStatus.MODIFIED
+  assert a.duration == 1.5
+  assert (a.bytes_before, a.bytes_after, a.cache_hit) == (10, 8, True)
+  assert error.path is None
+  assert str(error.error) == "error"
+
+
+def test_ReadManifest_incomplete(tempdir: pathlib.Path):
+  manifest_path = tempdir / "manifest.jsonl"
+  outcomes = sharding.RecordOutcomes(OUTCOMES, manifest_path, 0, 1)
+  next(outcomes)
+  outcomes.close()
+  assert not sharding.ReadManifest(manifest_path).complete
+
+
+def test_ReadManifest_invalid(tempdir: pathlib.Path):
+  (tempdir / "manifest.jsonl").write_text("not json\n")
+  with test.Raises(ValueError):
+    sharding.ReadManifest(tempdir / "manifest.jsonl")
+
+
+def test_MergeManifestsOrDie(tempdir: pathlib.Path):
+  root = pathlib.Path("/src")
+  for i in range(2):
+    list(
+      sharding.RecordOutcomes(
+        [OUTCOMES[0]._replace(path=root / f"{i}.py")],
+        tempdir / f"{i}.jsonl",
+        i,
+        2,
+        root=root,
+      )
+    )
+  outcomes = sharding.MergeManifestsOrDie(
+    [tempdir / "1.jsonl", tempdir / "0.jsonl"], root=root
+  )
+  assert [o.path for o in outcomes] == [root / "0.py", root / "1.py"]
+
+
+def test_MergeManifestsOrDie_missing_shard(tempdir: pathlib.Path):
+  list(sharding.RecordOutcomes([], tempdir / "0.jsonl", 0, 2))
+  with test.Raises(SystemExit):
+    sharding.MergeManifestsOrDie([tempdir / "0.jsonl"])
+
+
+def test_FormatShardOrDie(tempdir: pathlib.Path, tempdir2: pathlib.Path):
+  paths = [tempdir / f"{i}.txt" for i in range(10)]
+  for path in paths:
+    path.write_text("a  \n")
+
+  modified = []
+  for i in range(3):
+    modified += sharding.FormatShardOrDie(
+      paths, i, 3, manifest_path=tempdir2 / f"{i}.jsonl"
+    )
+  assert sorted(modified) == sorted(paths)
+  assert all(path.read_text() == "a\n" for path in paths)
+
+  outcomes = sharding.MergeManifestsOrDie(
+    [tempdir2 / f"{i}.jsonl" for i in range(3)]
+  )
+  assert sorted(o.path for o in outcomes) == sorted(paths)
+
+
+def test_RunShardWorkersOrDie_terminates_workers(
+  monkeypatch, tempdir: pathlib.Path
+):
+  processes = []
+
+  class Popen(subprocess.Popen):
+    def __init__(self, *args, **kwargs):
+      super(Popen, self).__init__(*args, **kwargs)
+      processes.append(self)
+
+  monkeypatch.setattr(sharding.subprocess, "Popen", Popen)
+  # The first worker fails immediately, and the others would run for a minute.
+  script = tempdir / "worker.py"
+  script.write_text(
+    "import sys, time\n"
+    "if '--shard_index=0' in sys.argv:\n"
+    "  sys.exit(1)\n"
+    "time.sleep(60)\n"
+  )
+  start_time = time.time()
+  with test.Raises(SystemExit):
+    sharding.RunShardWorkersOrDie([str(script)], 3)
+  assert time.time() - start_time < 30
+  assert len(processes) == 3
+  assert all(process.poll() is not None for process in processes)
+
+
+@test.Parametrize(
+  "argv,expected",
+  [
+    (["format", "--shard_workers=4", "a"], ["format", "a"]),
+    (["format", "--shard_workers", "4", "a"], ["format", "a"]),
+    (
+      ["format", "-num_shards", "2", "--shard_index=1", "--v=1", "a"],
+      ["format", "--v=1", "a"],
+    ),
+    (["format", "--shard_manifest", "m.jsonl", "a"], ["format", "a"]),
+    # Arguments after "--" are paths, not flags.
+    (
+      ["format", "--shard_workers", "4", "--", "--shard_index", "a"],
+      ["format", "--", "--shard_index", "a"],
+    ),
+  ],
+)
+def test_RemoveCoordinatorFlags(argv, expected):
+  assert sharding._RemoveCoordinatorFlags(argv) == expected
+
+
+if __name__ == "__main__":
+  test.Main()
@@ -0,0 +1,184 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module defines a profiler for the startup time of a Python program.
+
+The program is run in a subprocess with PYTHONPROFILEIMPORTTIME set, which is
+equivalent to python -X importtime, and the import times that the interpreter
+reports are parsed into a summary of where the startup time is spent.
+"""
+import collections
+import os
+import re
+import subprocess
+import sys
+import time
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+from labm8.py import app
+
+FLAGS = app.FLAGS
+
+# A line of output from python -X importtime, e.g.
+#     "import time:       229 |        591 |   encodings.utf_8"
+_IMPORT_TIME_RE = re.compile(
+  r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$", re.MULTILINE
+)
+
+# Any line of output from python -X importtime, including the header.
+_IMPORT_TIME_LINE_RE = re.compile(r"^import time:.*\n?", re.MULTILINE)
+
+# Matches the --profile_startup flag in its boolean forms.
+_PROFILE_STARTUP_FLAG_RE = re.compile(r"^--?profile_startup(=.*)?$")
+
+
+class ModuleImport(NamedTuple):
+  """The time taken to import a module."""
+
+  name: str
+  # The time spent importing the module, excluding its nested imports.
+  self_seconds: float
+  # The time spent importing the module, including its nested imports.
+  cumulative_seconds: float
+  # The nesting depth of the import. Modules imported directly by the program
+  # have a depth of zero.
+  depth: int
+
+
+class StartupProfile(NamedTuple):
+  """The startup profile of a program."""
+
+  cmd: List[str]
+  returncode: int
+  wall_seconds: float
+  imports: List[ModuleImport]
+
+  @property
+  def import_seconds(self) -> float:
+    """The total time spent importing modules."""
+    return sum(i.cumulative_seconds for i in self.imports if i.depth == 0)
+
+  @property
+  def module_names(self) -> List[str]:
+    """The names of all imported modules."""
+    return [i.name for i in self.imports]
+
+  def GetPackageSeconds(self) -> Dict[str, float]:
+    """Return the total import time of each top-level package."""
+    package_seconds = collections.defaultdict(float)
+    for module in self.imports:
+      package_seconds[module.name.split(".")[0]] += module.self_seconds
+    return package_seconds
+
+  def PrintReport(self, n: int = 15, file=sys.stderr) -> None:
+    """Print a human-readable summary of the profile.
+
+    Args:
+      n: The number of modules and packages to list.
+      file: The file to print to.
+    """
+    print("Startup profile of:", " ".join(self.cmd), file=file)
+    print(f"  Wall time: {self.wall_seconds * 1000:.0f} ms", file=file)
+    print(
+      f"  Import time: {self.import_seconds * 1000:.0f} ms "
+      f"({len(self.imports)} modules)",
+      file=file,
+    )
+
+    print("\nSlowest imports by the program:", file=file)
+    top_level = [i for i in self.imports if i.depth == 0]
+    for module in sorted(top_level, key=lambda i: -i.cumulative_seconds)[:n]:
+      print(
+        f"  {module.cumulative_seconds * 1000:8.1f} ms  {module.name}",
+        file=file,
+      )
+
+    print("\nSlowest packages, including all of their modules:", file=file)
+    package_seconds = self.GetPackageSeconds()
+    packages = sorted(package_seconds, key=lambda p: -package_seconds[p])
+    for package in packages[:n]:
+      print(
+        f"  {package_seconds[package] * 1000:8.1f} ms  {package}", file=file
+      )
+
+
+def ParseImportTimes(output: str) -> List[ModuleImport]:
+  """Parse the output of python -X importtime.
+
+  Args:
+    output: The stderr of the profiled program.
+
+  Returns:
+    A list of module imports, in the order that they completed.
+  """
+  return [
+    ModuleImport(
+      name=match.group(4),
+      self_seconds=int(match.group(1)) / 1e6,
+      cumulative_seconds=int(match.group(2)) / 1e6,
+      # The interpreter indents nested imports by two spaces per level, after
+      # a single space separator.
+      depth=(len(match.group(3)) - 1) // 2,
+    )
+    for match in _IMPORT_TIME_RE.finditer(output)
+  ]
+
+
+def ProfileCommand(
+  cmd: List[str], env: Optional[Dict[str, str]] = None
+) -> StartupProfile:
+  """Run a Python program and profile its imports.
+
+  The stdout of the program is passed through. Its stderr is passed through
+  with the import time lines removed.
+
+  Args:
+    cmd: The command to run.
+    env: The environment of the program. Defaults to the current environment.
+
+  Returns:
+    The startup profile of the program.
+  """
+  env = dict(env or os.environ)
+  env["PYTHONPROFILEIMPORTTIME"] = "1"
+  start_time = time.time()
+  process = subprocess.run(
+    cmd, env=env, stderr=subprocess.PIPE, universal_newlines=True
+  )
+  wall_seconds = time.time() - start_time
+
+  sys.stderr.write(_IMPORT_TIME_LINE_RE.sub("", process.stderr))
+  return StartupProfile(
+    cmd=cmd,
+    returncode=process.returncode,
+    wall_seconds=wall_seconds,
+    imports=ParseImportTimes(process.stderr),
+  )
+
+
+def ProfileStartup(argv: Iterable[str]) -> StartupProfile:
+  """Profile this program, run with the given arguments.
+
+  Args:
+    argv: The command line arguments of this program, including the
+      --profile_startup flag, which is removed.
+
+  Returns:
+    The startup profile of the program.
+  """
+  argv = [arg for arg in argv if not _PROFILE_STARTUP_FLAG_RE.match(arg)]
+  return ProfileCommand([sys.executable] + argv)
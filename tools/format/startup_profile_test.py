@@ -0,0 +1,170 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format:startup_profile.
+
+This also enforces the startup budget of the format program, by checking that
+expensive libraries are imported only by the modes which need them. The import
+time of the format program is measured by a benchmark, rather than asserted,
+since it depends on the load of the test machine.
+"""
+import os
+import pathlib
+import sys
+from typing import List
+
+from labm8.py import bazelutil
+from labm8.py import test
+from tools.format import startup_profile
+
+FLAGS = test.FLAGS
+
+FORMAT = bazelutil.DataPath("phd/tools/format/format")
+
+# The maximum number of modules that the format program may import. This is
+# about one and a half times the typical number, to allow for differences
+# between Python versions. Regressions which are too small to exceed the budget
+# are caught by the lists of modules below.
+IMPORT_BUDGET_MODULES = 400
+
+# Modules which must not be imported by modes of the format program which do
+# not use them.
+FORMATTER_MODULES = ["black", "reorder_python_imports", "sqlparse"]
+CACHE_MODULES = ["sqlalchemy"]
+PROTOBUF_MODULES = ["google.protobuf"]
+HUMANIZE_MODULES = ["humanize", "labm8.py.humanize"]
+# The formatters, other than the JSON formatter, which must be imported only
+# when a file of their type is formatted.
+FORMATTERS = [
+  f"tools.format.formatters.{name}"
+  for name in [
+    "bazel",
+    "cxx",
+    "go",
+    "java",
+    "javascript",
+    "protobuf",
+    "python",
+    "shell",
+    "sql",
+    "text",
+  ]
+]
+# The libraries which no startup of the format program may import.
+HEAVY_MODULES = (
+  FORMATTER_MODULES + CACHE_MODULES + PROTOBUF_MODULES + HUMANIZE_MODULES
+)
+
+IMPORT_TIME_OUTPUT = """\
+import time: self [us] | cumulative | imported package
+import time:       229 |        591 |   encodings.utf_8
+import time:      1000 |       2000 | encodings
+hello, world
+import time:        30 |         30 |     a.b.c
+import time:        70 |        100 |   a.b
+import time:       100 |        200 | a
+"""
+
+
+def ProfileFormat(
+  args: List[str], tempdir: pathlib.Path
+) -> startup_profile.StartupProfile:
+  """Profile the startup of the format program, using a scratch cache."""
+  return startup_profile.ProfileCommand(
+    [str(FORMAT)] + args, env=dict(os.environ, TEST_TMPDIR=str(tempdir))
+  )
+
+
+def AssertNotImported(
+  profile: startup_profile.StartupProfile, modules: List[str]
+) -> None:
+  """Check that none of the given modules, or their submodules, are imported."""
+  for module in modules:
+    imported = [
+      name
+      for name in profile.module_names
+      if name == module or name.startswith(f"{module}.")
+    ]
+    assert not imported, f"{module} imported by {' '.join(profile.cmd)}"
+
+
+def test_ParseImportTimes():
+  imports = startup_profile.ParseImportTimes(IMPORT_TIME_OUTPUT)
+  assert [(i.name, i.depth) for i in imports] == [
+    ("encodings.utf_8", 1),
+    ("encodings", 0),
+    ("a.b.c", 2),
+    ("a.b", 1),
+    ("a", 0),
+  ]
+  assert imports[0].self_seconds == 229 / 1e6
+  assert imports[0].cumulative_seconds == 591 / 1e6
+
+
+def test_StartupProfile_import_seconds():
+  profile = startup_profile.StartupProfile(
+    cmd=[],
+    returncode=0,
+    wall_seconds=1,
+    imports=startup_profile.ParseImportTimes(IMPORT_TIME_OUTPUT),
+  )
+  assert round(profile.import_seconds, 6) == 2200e-6
+  package_seconds = profile.GetPackageSeconds()
+  assert round(package_seconds["encodings"], 6) == 1229e-6
+  assert round(package_seconds["a"], 6) == 200e-6
+
+
+def test_ProfileCommand():
+  profile = startup_profile.ProfileCommand(
+    [sys.executable, "-c", "import json"]
+  )
+  assert profile.returncode == 0
+  assert "json" in profile.module_names
+  assert profile.wall_seconds > 0
+
+
+def test_ProfileStartup_removes_flag():
+  profile = startup_profile.ProfileStartup(
+    ["-c", "import sys; assert sys.argv == ['-c']", "--profile_startup"]
+  )
+  assert profile.returncode == 0
+
+
+@test.Parametrize(
+  "args", [["--print_suffixes"], ["--print_cache_path"], ["--help"]]
+)
+def test_format_startup_modules(args: List[str], tempdir: pathlib.Path):
+  """Test that the flag-only modes of format import no heavy libraries."""
+  profile = ProfileFormat(args, tempdir)
+  AssertNotImported(profile, HEAVY_MODULES + FORMATTERS)
+  assert len(profile.module_names) < IMPORT_BUDGET_MODULES
+
+
+def test_format_startup_json_file(
+  tempdir: pathlib.Path, tempdir2: pathlib.Path
+):
+  """Test that formatting a file imports only the formatter it uses."""
+  (tempdir2 / "a.json").write_text("{}\n")
+  profile = ProfileFormat([str(tempdir2)], tempdir)
+  assert profile.returncode == 0
+  AssertNotImported(profile, HEAVY_MODULES + FORMATTERS)
+  assert len(profile.module_names) < IMPORT_BUDGET_MODULES
+
+
+def test_benchmark_format_startup(benchmark, tempdir: pathlib.Path):
+  """Benchmark the startup time of the format program."""
+  benchmark(ProfileFormat, ["--print_suffixes"], tempdir)
+
+
+if __name__ == "__main__":
+  test.Main()
@@ -0,0 +1,149 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""This module defines the matching of file names to suffix mapping keys.
+
+The keys of a suffix mapping are one of three types of rule:
+
+  * Suffixes, which begin with a ".", e.g. ".py" or ".tar.bz2". A suffix
+    matches any name which ends with it, or which is equal to it, e.g.
+    ".formatignore".
+  * Globs, which contain a glob wildcard, e.g. "BUILD.*" or "*.pb.txt". A glob
+    matches a name using the rules of fnmatch.fnmatchcase().
+  * Names, e.g. "BUILD". A name matches only itself.
+
+When a file name is matched by more than one rule, names take precedence over
+globs, which take precedence over suffixes. Globs are tried in the order that
+they appear in the mapping, and the longest matching suffix is used.
+"""
+import fnmatch
+import re
+import threading
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Pattern
+from typing import Tuple
+
+from labm8.py import app
+
+FLAGS = app.FLAGS
+
+# The characters which make a key a glob.
+_GLOB_CHARS = re.compile(r"[*?[]")
+
+
+class SuffixMatcher(object):
+  """A compiled matcher of file names to the keys of a suffix mapping.
+
+  Matching operates on the name of a file, without creating pathlib objects:
+
+      matcher = SuffixMatcher([".py", ".tar.bz2", "BUILD", "BUILD.*"])
+      matcher.Match("foo.tar.bz2")  # ".tar.bz2"
+      matcher.Match("BUILD.bazel")  # "BUILD.*"
+      matcher.Match("foo.c")  # None
+  """
+
+  def __init__(self, keys: Iterable[str]):
+    """Constructor.
+
+    Args:
+      keys: The keys of a suffix mapping. See the module docstring for the
+        supported types of rule. If this is a mapping which discovers keys
+        lazily, such as a LazySuffixMapping, the matcher is built from the
+        keys that the mapping has registered, and the rest are discovered on
+        the first name which none of them match.
+    """
+    # A mapping which discovers keys lazily, until it has been told to
+    # discover the rest of its keys.
+    self._lazy_mapping = None
+    if hasattr(keys, "LoadEntryPoints"):
+      self._lazy_mapping = keys
+      keys = keys.RegisteredKeys()
+    # Serializes the discovery of the keys of a lazy mapping.
+    self._lock = threading.Lock()
+    self._SetKeys(keys)
+
+  def _SetKeys(self, keys: Iterable[str]) -> None:
+    """Compile the rules of the matcher.
+
+    A matcher may be shared between threads, so the rules are compiled before
+    they replace the existing rules in a single assignment, and a concurrent
+    Match() sees either the old rules or the new rules.
+    """
+    # The name and suffix rules, which are matched by dictionary lookups.
+    names: Dict[str, str] = {}
+    # The glob rules, as pairs of <key, compiled regex>.
+    globs: List[Tuple[str, Pattern]] = []
+    for key in keys:
+      if _GLOB_CHARS.search(key):
+        globs.append((key, re.compile(fnmatch.translate(key))))
+      else:
+        names[key] = key
+    # A memo of the longest matching suffix of every name "tail", which is
+    # the part of a name from its first "." onwards. The number of distinct
+    # tails in a tree is small, so this is far smaller than a memo of names.
+    suffixes: Dict[str, Optional[str]] = {}
+    self._rules = (names, globs, suffixes)
+
+  def Match(self, name: str) -> Optional[str]:
+    """Return the key of the rule which matches a file name.
+
+    Args:
+      name: The name of a file, without its directory.
+
+    Returns:
+      The matching key, or None if no rule matches.
+    """
+    key = self._Match(name)
+    if key is None and self._lazy_mapping is not None:
+      # Discover the remaining keys of the mapping, and try again. A thread
+      # which misses while another thread discovers the keys waits for it.
+      with self._lock:
+        if self._lazy_mapping is not None:
+          self._lazy_mapping.LoadEntryPoints()
+          self._SetKeys(self._lazy_mapping.RegisteredKeys())
+          self._lazy_mapping = None
+      key = self._Match(name)
+    return key
+
+  def _Match(self, name: str) -> Optional[str]:
+    """Return the key of the rule which matches a file name, or None."""
+    names, globs, suffixes = self._rules
+    key = names.get(name)
+    if key is not None:
+      return key
+    for key, regex in globs:
+      if regex.match(name):
+        return key
+    i = name.find(".")
+    if i < 0:
+      return None
+    tail = name[i:]
+    try:
+      return suffixes[tail]
+    except KeyError:
+      suffixes[tail] = key = _MatchSuffix(names, tail)
+      return key
+
+
+def _MatchSuffix(names: Dict[str, str], tail: str) -> Optional[str]:
+  """Return the longest suffix rule which matches a name tail, or None."""
+  i = 0
+  while i >= 0:
+    key = names.get(tail[i:])
+    if key is not None:
+      return key
+    i = tail.find(".", i + 1)
+  return None
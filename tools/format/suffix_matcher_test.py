@@ -0,0 +1,152 @@
+# Copyright 2020 Chris Cummins <chrisc.101@gmail.com>.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Unit tests for //tools/format:suffix_matcher."""
+import collections
+import concurrent.futures
+import pathlib
+import time
+
+from labm8.py import test
+from tools.format import default_suffix_mapping
+from tools.format import suffix_matcher
+
+FLAGS = test.FLAGS
+
+
+@test.Fixture(scope="function")
+def matcher() -> suffix_matcher.SuffixMatcher:
+  return suffix_matcher.SuffixMatcher(
+    [
+      ".txt",
+      ".bz2",
+      ".tar.bz2",
+      ".formatignore",
+      "BUILD",
+      "BUILD.*",
+      "*.pb.txt",
+    ]
+  )
+
+
+@test.Parametrize(
+  "name,key",
+  (
+    ("a.txt", ".txt"),
+    ("a.b.txt", ".txt"),
+    ("a.bz2", ".bz2"),
+    # The longest suffix is matched.
+    ("a.tar.bz2", ".tar.bz2"),
+    ("a.b.tar.bz2", ".tar.bz2"),
+    # A suffix matches a name which is equal to it.
+    (".formatignore", ".formatignore"),
+    ("a.formatignore", ".formatignore"),
+    # Names take precedence over globs.
+    ("BUILD", "BUILD"),
+    ("BUILD.bazel", "BUILD.*"),
+    # Globs take precedence over suffixes.
+    ("a.pb.txt", "*.pb.txt"),
+    ("BUILD.txt", "BUILD.*"),
+    ("a", None),
+    ("a.py", None),
+    ("a.", None),
+    ("txt", None),
+    ("a.txt.gz", None),
+    ("ABUILD", None),
+  ),
+)
+def test_SuffixMatcher_Match(
+  matcher: suffix_matcher.SuffixMatcher, name: str, key: str
+):
+  assert matcher.Match(name) == key
+  # Lookups are memoized.
+  assert matcher.Match(name) == key
+
+
+def test_SuffixMatcher_default_mapping():
+  """Test that the matcher agrees with the default mapping on simple names."""
+  matcher = suffix_matcher.SuffixMatcher(default_suffix_mapping.mapping)
+  for name in ["a.py", "a.b.py", "BUILD", "a.BUILD", ".formatignore", "a"]:
+    path = pathlib.Path(name)
+    key = path.suffix or path.name
+    expected = key if key in default_suffix_mapping.mapping else None
+    assert matcher.Match(name) == expected
+  assert matcher.Match("BUILD.bazel") == "BUILD.bazel"
+  assert matcher.Match("foo.BUILD.bazel") == ".BUILD.bazel"
+
+
+def test_SuffixMatcher_lazy_mapping(monkeypatch):
+  """Test that entry points are discovered only when a name is not matched."""
+  entry_point_groups = []
+
+  def GetEntryPoints(group):
+    entry_point_groups.append(group)
+    EntryPoint = collections.namedtuple("EntryPoint", ["name", "value"])
+    return [EntryPoint(".plugin", "tools.format.formatters.text:FormatText")]
+
+  monkeypatch.setattr(default_suffix_mapping, "_GetEntryPoints", GetEntryPoints)
+  mapping = default_suffix_mapping.LazySuffixMapping(
+    {".txt": "tools.format.formatters.text:FormatText"},
+    entry_point_group="group",
+  )
+
+  matcher = suffix_matcher.SuffixMatcher(mapping)
+  assert matcher.Match("a.txt") == ".txt"
+  assert not entry_point_groups
+
+  assert matcher.Match("a.plugin") == ".plugin"
+  assert matcher.Match("a.unknown") is None
+  assert entry_point_groups == ["group"]
+
+
+def test_SuffixMatcher_lazy_mapping_threads(monkeypatch):
+  """Test that threads which miss during discovery wait for the new keys."""
+  EntryPoint = collections.namedtuple("EntryPoint", ["name", "value"])
+
+  def GetEntryPoints(group):
+    time.sleep(0.5)
+    return [EntryPoint(".plugin", "tools.format.formatters.text:FormatText")]
+
+  monkeypatch.setattr(default_suffix_mapping, "_GetEntryPoints", GetEntryPoints)
+  mapping = default_suffix_mapping.LazySuffixMapping(
+    {".txt": "tools.format.formatters.text:FormatText"},
+    entry_point_group="group",
+  )
+  matcher = suffix_matcher.SuffixMatcher(mapping)
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+    keys = list(executor.map(matcher.Match, ["a.plugin", "a.txt"] * 8))
+  assert keys == [".plugin", ".txt"] * 8
+
+
+def test_benchmark_SuffixMatcher_Match(benchmark):
+  """Benchmark the throughput of matching file names."""
+  matcher = suffix_matcher.SuffixMatcher(default_suffix_mapping.mapping)
+  suffixes = [".py", ".cc", ".h", ".txt", ".o", ".tar.gz", "", ".BUILD.bazel"]
+  names = [f"file{i}{suffixes[i % len(suffixes)]}" for i in range(100000)]
+
+  def Benchmark():
+    match = matcher.Match
+    return sum(1 for name in names if match(name) is not None)
+
+  start_time = time.time()
+  assert Benchmark() == 62500
+  benchmark.extra_info["names_per_second"] = int(
+    len(names) / (time.time() - start_time)
+  )
+
+  benchmark(Benchmark)
+
+
+if __name__ == "__main__":
+  test.Main()
@@ -20,6 +20,8 @@ import inotify.adapters
 import inotify.constants
 
 from labm8.py import app
+from labm8.py import humanize
+from tools.format import format_outcome
 from tools.format import format_paths
 from tools.format import path_generator as path_generators
 
@@ -32,13 +34,17 @@ def Format(paths: List[pathlib.Path]):
   # In the future I may want to refactor the FormatPaths class so that it can
   # process multiple "runs" rather than having to create and dispose of a
   # formatter each time we get a new FS event.
-  for event in format_paths.FormatPaths(paths):
+  for outcome in format_paths.FormatPaths(paths).Outcomes():
     timestamp = datetime.datetime.now().strftime("%H:%M:%S")
     prefix = f"[format {timestamp}]"
-    if isinstance(event, Exception):
-      print(prefix, "ERROR:", event)
-    else:
-      print(prefix, event)
+    if outcome.status == format_outcome.FormatStatus.ERROR:
+      print(prefix, "ERROR:", outcome.error)
+    elif outcome.status == format_outcome.FormatStatus.MODIFIED:
+      print(
+        prefix,
+        outcome.path,
+        f"({outcome.formatter}, {humanize.Duration(outcome.duration)})",
+      )
 
 
 def Main(args: List[str]):
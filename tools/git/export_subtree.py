@@ -9,6 +9,7 @@ import git
 from labm8.py import app
 from labm8.py import humanize
 from labm8.py import progress
+from tools.git import git_client
 from tools.git import git_remote
 
 FLAGS = app.FLAGS
@@ -45,7 +46,8 @@ class SubtreeExporter(progress.Progress):
       files_of_interest: The relpaths of the files to export.
       head_ref: The commit to export up to.
     """
-    if destination.is_dirty():
+    self.client = git_client.GitClient(destination.working_tree_dir)
+    if IsDirty(self.client):
       raise OSError(f"Repo `{destination.working_tree_dir}` is dirty")
 
     self.source = source
@@ -78,7 +80,11 @@ class SubtreeExporter(progress.Progress):
 
       for self.ctx.i, commit in enumerate(self.commits_in_order):
         if MaybeExportCommitSubset(
-          commit, self.destination, self.files_of_interest, ctx=self.ctx
+          commit,
+          self.destination,
+          self.files_of_interest,
+          ctx=self.ctx,
+          client=self.client,
         ):
           self.exported_commit_count += 1
 
@@ -120,6 +126,15 @@ def GetCommitsInOrder(
     return []
 
 
+def IsDirty(client: git_client.GitClient) -> bool:
+  """Return whether a repo has uncommitted changes to tracked files.
+
+  This is equivalent to git.Repo.is_dirty(), but runs one git process rather
+  than a diff of the index and a diff of the working tree.
+  """
+  return bool(client.Run("status", "--porcelain", "--untracked-files=no"))
+
+
 def _FormatPythonDatetime(dt):
   """Make python datetime compatabile with git commit date args."""
   return dt.replace(tzinfo=None).replace(microsecond=0).isoformat()
@@ -130,6 +145,7 @@ def MaybeExportCommitSubset(
   repo: git.Repo,
   files_of_interest: Set[str],
   ctx: progress.ProgressContext = progress.NullContext,
+  client: Optional[git_client.GitClient] = None,
 ) -> Optional[git.Commit]:
   """Filter the parts of the given commit that touch the files_of_interest and
   commit them. If the commit doesn't touch anything interesting, nothing is
@@ -137,10 +153,12 @@ def MaybeExportCommitSubset(
 
   Args:
     repo: The git repo to add the commit to.
+    client: A git client of the repo to add the commit to.
 
   Returns:
     A git commit, if one is created, else None.
   """
+  client = client or git_client.GitClient(repo.working_tree_dir)
   try:
     # Apply the diff of the commit to be exported to the repo.
     repo.git.cherry_pick("--no-commit", "--allow-empty", commit)
@@ -181,7 +199,7 @@ def MaybeExportCommitSubset(
     )
     repo.index.remove(list(paths_to_unstage))
 
-  if not repo.is_dirty():
+  if not IsDirty(client):
     ctx.Log(2, "Skipping empty commit %s", commit)
     repo.git.clean("-xfd")
     return
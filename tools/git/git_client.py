@@ -0,0 +1,227 @@
+"""This module defines a git client which reuses long-lived git processes.
+
+Every git command costs a fork and exec, and the startup of git itself. Git's
+batch plumbing commands answer requests read from stdin for as long as their
+input is open, so a client which keeps these processes open can read and write
+any number of objects for the cost of starting each process once:
+
+  * `git cat-file --batch` reads objects.
+  * `git hash-object -w --stdin-paths` writes files to the object database.
+
+Commands which have no batch form are run as one-off processes by Run().
+"""
+import os
+import pathlib
+import subprocess
+import tempfile
+import threading
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Union
+
+from labm8.py import app
+
+FLAGS = app.FLAGS
+
+
+class GitError(OSError):
+  """Error raised if a git command fails."""
+
+
+class GitClient(object):
+  """A client for a git repository.
+
+  The batch processes are started on first use, and kept open until Close() is
+  called. A client can be used as a context manager:
+
+      with GitClient("/path/to/repo") as client:
+        sha = client.WriteBlob(b"Hello, world\\n")
+        client.ReadBlob(sha)  # b"Hello, world\\n"
+
+  Requests are serialized, so a client may be shared between threads.
+  """
+
+  def __init__(self, directory: Optional[Union[str, pathlib.Path]] = None):
+    """Constructor.
+
+    Args:
+      directory: The directory to run git in. Relative paths passed to the
+        client are relative to this directory. Defaults to the current working
+        directory.
+    """
+    self.directory = pathlib.Path(directory or os.getcwd()).absolute()
+    self._lock = threading.RLock()
+    self._cat_file: Optional[subprocess.Popen] = None
+    # The hash-object processes, keyed by whether they apply git attribute
+    # filters to the files that they hash.
+    self._hash_object: Dict[bool, subprocess.Popen] = {}
+    # A scratch directory for the contents of blobs written by WriteBlob().
+    self._tempdir: Optional[tempfile.TemporaryDirectory] = None
+
+  def __enter__(self) -> "GitClient":
+    return self
+
+  def __exit__(self, *args):
+    self.Close()
+
+  def Close(self) -> None:
+    """Terminate the batch processes. The client may be reused afterwards."""
+    with self._lock:
+      if self._cat_file:
+        _CloseProcess(self._cat_file)
+        self._cat_file = None
+      for process in self._hash_object.values():
+        _CloseProcess(process)
+      self._hash_object = {}
+      if self._tempdir:
+        self._tempdir.cleanup()
+        self._tempdir = None
+
+  def Run(self, *args: str, input: Optional[bytes] = None) -> bytes:
+    """Run a one-off git command.
+
+    Args:
+      args: The arguments to git, e.g. "rev-parse", "HEAD".
+      input: Bytes to write to the stdin of the command.
+
+    Returns:
+      The stdout of the command.
+
+    Raises:
+      GitError: If the command fails.
+    """
+    cmd = ["git"] + list(args)
+    process = subprocess.run(
+      cmd,
+      cwd=self.directory,
+      input=input,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE,
+    )
+    if process.returncode:
+      raise GitError(
+        f"Command failed: {' '.join(cmd)}: "
+        f"{process.stderr.decode('utf-8', 'replace').rstrip()}"
+      )
+    return process.stdout
+
+  def ReadBlob(self, name: str) -> bytes:
+    """Read the contents of a blob.
+
+    Args:
+      name: The name of the blob, e.g. a hash or "HEAD:README.md".
+
+    Returns:
+      The contents of the blob.
+
+    Raises:
+      GitError: If the object does not exist or is not a blob.
+    """
+    with self._lock:
+      if not self._cat_file:
+        self._cat_file = self._Popen("cat-file", "--batch")
+      process = self._cat_file
+      process.stdin.write(name.encode("utf-8") + b"\n")
+      process.stdin.flush()
+      # The contents of each object is preceded by a "<sha> <type> <size>"
+      # header line and followed by a newline. Objects which are not found
+      # have a "<name> missing" header.
+      header = process.stdout.readline().split()
+      if len(header) != 3:
+        raise GitError(f"Git object not found: {name}")
+      size = int(header[2])
+      data = process.stdout.read(size + 1)[:size]
+      if header[1] != b"blob":
+        raise GitError(f"Git object is not a blob: {name}")
+      return data
+
+  def HashFiles(
+    self, paths: Iterable[Union[str, pathlib.Path]], filters: bool = True
+  ) -> List[str]:
+    """Write the contents of files to the object database.
+
+    Args:
+      paths: The paths of the files to write.
+      filters: Whether to apply the git attribute filters of the paths to their
+        contents, as `git add` does. If False, the contents are written
+        verbatim.
+
+    Returns:
+      The hashes of the blobs, in the order of the paths.
+
+    Raises:
+      GitError: If a file cannot be written.
+    """
+    with self._lock:
+      if filters not in self._hash_object:
+        args = ["hash-object", "-w", "--stdin-paths"]
+        if not filters:
+          args.append("--no-filters")
+        self._hash_object[filters] = self._Popen(*args)
+      process = self._hash_object[filters]
+
+      shas = []
+      for path in paths:
+        process.stdin.write(_QuotePath(str(path)) + b"\n")
+        process.stdin.flush()
+        line = process.stdout.readline()
+        if not line:
+          # git exits if it cannot read a file, so the process is replaced on
+          # next use.
+          _CloseProcess(self._hash_object.pop(filters))
+          raise GitError(f"Unable to hash file: {path}")
+        shas.append(line.decode("ascii").rstrip())
+      return shas
+
+  def WriteBlob(self, data: bytes) -> str:
+    """Write a blob to the object database.
+
+    The data is written verbatim, without applying git attribute filters.
+
+    Args:
+      data: The contents of the blob.
+
+    Returns:
+      The hash of the blob.
+    """
+    with self._lock:
+      if not self._tempdir:
+        self._tempdir = tempfile.TemporaryDirectory(prefix="git_client_")
+      path = pathlib.Path(self._tempdir.name) / "blob"
+      path.write_bytes(data)
+      return self.HashFiles([path], filters=False)[0]
+
+  def _Popen(self, *args: str) -> subprocess.Popen:
+    """Start a batch process."""
+    return subprocess.Popen(
+      ["git"] + list(args),
+      cwd=self.directory,
+      stdin=subprocess.PIPE,
+      stdout=subprocess.PIPE,
+    )
+
+
+def _CloseProcess(process: subprocess.Popen) -> None:
+  """Close the input of a batch process and wait for it to exit."""
+  try:
+    process.stdin.close()
+  except BrokenPipeError:
+    pass
+  process.stdout.close()
+  process.wait()
+
+
+def _QuotePath(path: str) -> bytes:
+  """Encode a path as a line of input to `git hash-object --stdin-paths`.
+
+  Git reads paths which begin with a double quote as C-style quoted strings,
+  so paths which contain newlines or begin with a quote are quoted.
+  """
+  data = os.fsencode(path)
+  if b"\n" in data or data.startswith(b'"'):
+    for char, escaped in ((b"\\", b"\\\\"), (b'"', b'\\"'), (b"\n", b"\\n")):
+      data = data.replace(char, escaped)
+    data = b'"' + data + b'"'
+  return data
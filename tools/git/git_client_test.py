@@ -0,0 +1,84 @@
+"""Unit tests for //tools/git:git_client."""
+import pathlib
+import subprocess
+
+from labm8.py import test
+from tools.git import git_client
+
+FLAGS = test.FLAGS
+
+
+@test.Fixture(scope="function")
+def client(tempdir: pathlib.Path) -> git_client.GitClient:
+  """A client of an empty git repository."""
+  subprocess.check_call(["git", "init", "-q", str(tempdir)])
+  with git_client.GitClient(tempdir) as client:
+    yield client
+
+
+def test_GitClient_Run(client: git_client.GitClient):
+  output = client.Run("rev-parse", "--show-toplevel")
+  assert pathlib.Path(output.decode("utf-8").rstrip()) == client.directory
+
+
+def test_GitClient_Run_error(client: git_client.GitClient):
+  with test.Raises(git_client.GitError) as e_ctx:
+    client.Run("rev-parse", "--verify", "not-a-ref")
+  assert "not-a-ref" in str(e_ctx.value)
+
+
+def test_GitClient_WriteBlob_ReadBlob(client: git_client.GitClient):
+  blobs = [b"", b"a\n", b"\0binary\n\n", b"x" * 100000]
+  shas = [client.WriteBlob(blob) for blob in blobs]
+  assert len(set(shas)) == len(blobs)
+  # Blobs are read back by the same process, in any order.
+  for sha, blob in reversed(list(zip(shas, blobs))):
+    assert client.ReadBlob(sha) == blob
+  # The blobs are written to the object database.
+  assert client.Run("cat-file", "-p", shas[1]) == b"a\n"
+
+
+def test_GitClient_ReadBlob_not_found(client: git_client.GitClient):
+  with test.Raises(git_client.GitError):
+    client.ReadBlob("0" * 40)
+  # The process is still usable.
+  assert client.ReadBlob(client.WriteBlob(b"a\n")) == b"a\n"
+
+
+def test_GitClient_HashFiles(client: git_client.GitClient):
+  names = ["a.txt", "b c.txt", "new\nline.txt", '"quoted".txt']
+  for name in names:
+    (client.directory / name).write_text(name)
+  shas = client.HashFiles(names)
+  for name, sha in zip(names, shas):
+    assert client.ReadBlob(sha) == name.encode("utf-8")
+
+
+def test_GitClient_HashFiles_missing_file(client: git_client.GitClient):
+  with test.Raises(git_client.GitError):
+    client.HashFiles(["missing.txt"])
+  # A new process is started on next use.
+  (client.directory / "a.txt").write_text("a\n")
+  (sha,) = client.HashFiles(["a.txt"])
+  assert client.ReadBlob(sha) == b"a\n"
+
+
+def test_GitClient_reuses_processes(client: git_client.GitClient):
+  client.WriteBlob(b"a\n")
+  process = client._hash_object[False]
+  client.WriteBlob(b"b\n")
+  assert client._hash_object[False] is process
+
+
+def test_GitClient_Close(client: git_client.GitClient):
+  sha = client.WriteBlob(b"a\n")
+  client.ReadBlob(sha)
+  client.Close()
+  assert client._cat_file is None
+  assert not client._hash_object
+  # The client can be reused after closing.
+  assert client.ReadBlob(sha) == b"a\n"
+
+
+if __name__ == "__main__":
+  test.Main()